@@ -0,0 +1,59 @@
+"""Compares the speed of the JSON codecs in ocdskingfisherprocess.jsoncodec, on the OCDS data in tests/fixtures, or on
+the JSON files given as arguments.
+
+    python benchmarks/json_codecs.py [file.json ...]
+"""
+import collections
+import glob
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from ocdskingfisherprocess.jsoncodec import CODECS, StdlibCodec  # noqa: E402
+
+
+def main():
+    filenames = sys.argv[1:] or glob.glob(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'tests',
+                                                       'fixtures', '*.json'))
+    strings = []
+    documents = []
+    for filename in filenames:
+        with open(filename, encoding='utf-8') as f:
+            s = f.read()
+        try:
+            documents.append(StdlibCodec().loads(s))
+            strings.append(s)
+        except ValueError:
+            print("Skipping {}, which is not valid JSON".format(filename))
+    size = sum(len(s.encode('utf-8')) for s in strings)
+
+    # Enough repetitions for about 10 MB.
+    number = max(1, 10000000 // size)
+    print("{} files, {} bytes, {} repetitions".format(len(strings), size, number))
+    print("{:<8} {:>12} {:>12}".format('codec', 'decode MB/s', 'encode MB/s'))
+
+    # How the database engine used to decode JSONB values.
+    decode = timeit.timeit(lambda: [json.loads(s, object_pairs_hook=collections.OrderedDict) for s in strings],
+                           number=number)
+    print("{:<8} {:>12.1f}".format('ordered', size * number / decode / 1e6))
+
+    for name, codec_class in CODECS.items():
+        try:
+            codec = codec_class()
+        except ImportError:
+            print("{:<8} not installed".format(name))
+            continue
+
+        for s, document in zip(strings, documents):
+            assert codec.loads(s) == document
+
+        decode = timeit.timeit(lambda: [codec.loads(s) for s in strings], number=number)
+        encode = timeit.timeit(lambda: [codec.dumps(d) for d in documents], number=number)
+        print("{:<8} {:>12.1f} {:>12.1f}".format(name, size * number / decode / 1e6, size * number / encode / 1e6))
+
+
+if __name__ == '__main__':
+    main()
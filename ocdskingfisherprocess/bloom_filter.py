@@ -0,0 +1,61 @@
+"""A Bloom filter of MD5 hashes, used to skip looking up data that is definitely new. See DataBase.get_ids_for_hashes.
+
+A Bloom filter can say that a hash was definitely not added, or that it maybe was. A "maybe" for a hash that wasn't
+added is a false positive; the rate of these depends on how many hashes were added, compared to the capacity."""
+
+import math
+import struct
+
+MAGIC = b'KFBF1'
+HEADER = struct.Struct('<QQQ')
+
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate=0.01, num_bits=None, num_hashes=None):
+        if num_bits is None:
+            num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        if num_hashes is None:
+            num_hashes = max(1, int(round(num_bits / max(capacity, 1) * math.log(2))))
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bytearray((num_bits + 7) // 8)
+        # The highest data.id that was added, so that only later rows need adding after loading a snapshot.
+        self.max_data_id = 0
+
+    def _positions(self, hash_md5):
+        # The hash is already uniformly distributed, so derive the positions from its two halves (double hashing).
+        h1 = int(hash_md5[:16], 16)
+        h2 = int(hash_md5[16:32], 16) | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, hash_md5):
+        for position in self._positions(hash_md5):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, hash_md5):
+        for position in self._positions(hash_md5):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(MAGIC)
+            f.write(HEADER.pack(self.num_bits, self.num_hashes, self.max_data_id))
+            f.write(self.bits)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise Exception("Not a data hash filter snapshot: {}".format(filename))
+            num_bits, num_hashes, max_data_id = HEADER.unpack(f.read(HEADER.size))
+            bloom_filter = cls(0, num_bits=num_bits, num_hashes=num_hashes)
+            bloom_filter.max_data_id = max_data_id
+            bits = f.read()
+            if len(bits) != len(bloom_filter.bits):
+                raise Exception("Data hash filter snapshot is truncated: {}".format(filename))
+            bloom_filter.bits = bytearray(bits)
+        return bloom_filter
@@ -0,0 +1,201 @@
+import datetime
+import io
+
+import sqlalchemy as sa
+
+from ocdskingfisherprocess.signals import KINGFISHER_SIGNALS
+from ocdskingfisherprocess.store import Store
+from ocdskingfisherprocess.util import get_json_and_hash_md5_for_data
+
+
+def _copy_value(value):
+    # Escapes a value for COPY's text format.
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _copy_rows(rows):
+    out = io.StringIO()
+    for row in rows:
+        out.write('\t'.join(_copy_value(value) for value in row))
+        out.write('\n')
+    out.seek(0)
+    return out
+
+
+class BulkStore(Store):
+    """A Store for loading lots of files at once, eg. an initial backfill.
+
+    Instead of writing each item in its own transaction, items are held in memory until flush is called (or there are
+    more than flush_rows rows). A flush uses COPY to load everything into temporary staging tables, then merges them
+    into the main tables with a few set-based queries. Data is still de-duplicated by hash_md5.
+
+    Call flush when finished, or the last items will not be stored!"""
+
+    FLUSH_ROWS = 10000
+
+    def __init__(self, config, database, flush_rows=None):
+        super().__init__(config, database)
+        self.flush_rows = flush_rows or self.FLUSH_ROWS
+        self._clear()
+
+    def _clear(self):
+        # filename -> url
+        self.files = {}
+        # filename -> warnings, for files that have been completely stored
+        self.files_done = {}
+        # (filename, number, warnings)
+        self.items = []
+        # (row_type, filename, number, ocid, release_id, data hash_md5, package_data hash_md5)
+        self.rows = []
+        # hash_md5 -> JSON string
+        self.data = {}
+        self.package_data = {}
+
+    def _store_rows(self, filename, url, number, rows, before_db_transaction_ends_callback=None, warnings=None):
+
+        if before_db_transaction_ends_callback:
+            raise Exception("BulkStore can not call a callback before the DB transaction ends")
+
+        staged_rows = []
+        package_data_hash_md5 = None
+        for row_type, row, package_data in rows:
+            data_str, data_hash_md5 = get_json_and_hash_md5_for_data(row)
+            self.data[data_hash_md5] = data_str
+            if row_type != 'compiled_release' and not package_data_hash_md5:
+                package_data_str, package_data_hash_md5 = get_json_and_hash_md5_for_data(package_data)
+                self.package_data[package_data_hash_md5] = package_data_str
+            staged_rows.append((row_type, filename, number, row.get('ocid', ''),
+                                row.get('id', '') if row_type == 'release' else None, data_hash_md5,
+                                package_data_hash_md5 if row_type != 'compiled_release' else None))
+
+        self.files.setdefault(filename, url)
+        self.items.append((filename, number, self.json_codec.dumps(warnings) if warnings else None))
+        self.rows.extend(staged_rows)
+
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def mark_file_store_done(self, filename, warnings=None):
+        self.files_done[filename] = warnings
+
+    def flush(self):
+        if not self.files and not self.files_done:
+            return
+
+        with self.database.get_engine().begin() as connection:
+            self._copy_to_staging_tables(connection)
+            collection_file_item_ids = self._merge_staging_tables(connection)
+
+        self._clear()
+
+        for collection_file_item_id in collection_file_item_ids:
+            KINGFISHER_SIGNALS\
+                .signal('collection-data-store-finished')\
+                .send('anonymous',
+                      collection_id=self.collection_id,
+                      collection_file_item_id=collection_file_item_id
+                      )
+
+    def _copy_to_staging_tables(self, connection):
+        # Temporary tables are not written to the WAL, and are dropped at the end of the transaction.
+        connection.execute(sa.sql.expression.text("""
+            CREATE TEMPORARY TABLE bulk_file (seq SERIAL, filename TEXT, url TEXT, done BOOLEAN, warnings JSONB)
+                ON COMMIT DROP;
+            CREATE TEMPORARY TABLE bulk_item (seq SERIAL, filename TEXT, number INTEGER, warnings JSONB)
+                ON COMMIT DROP;
+            CREATE TEMPORARY TABLE bulk_row (seq SERIAL, row_type TEXT, filename TEXT, number INTEGER, ocid TEXT,
+                release_id TEXT, data_hash_md5 TEXT, package_data_hash_md5 TEXT) ON COMMIT DROP;
+            CREATE TEMPORARY TABLE bulk_data (hash_md5 TEXT, data JSONB) ON COMMIT DROP;
+            CREATE TEMPORARY TABLE bulk_package_data (hash_md5 TEXT, data JSONB) ON COMMIT DROP;
+        """))
+
+        # A file may have been marked done after its items were flushed; it will have no URL here.
+        files = []
+        for filename in list(self.files.keys()) + [f for f in self.files_done.keys() if f not in self.files]:
+            warnings = self.files_done.get(filename)
+            files.append((filename, self.files.get(filename), 't' if filename in self.files_done else 'f',
+                          self.json_codec.dumps(warnings) if warnings else None))
+
+        cursor = connection.connection.cursor()
+        cursor.copy_expert("COPY bulk_file (filename, url, done, warnings) FROM STDIN", _copy_rows(files))
+        cursor.copy_expert("COPY bulk_item (filename, number, warnings) FROM STDIN", _copy_rows(self.items))
+        cursor.copy_expert(
+            "COPY bulk_row (row_type, filename, number, ocid, release_id, data_hash_md5, package_data_hash_md5) "
+            "FROM STDIN",
+            _copy_rows(self.rows))
+        cursor.copy_expert("COPY bulk_data (hash_md5, data) FROM STDIN", _copy_rows(self.data.items()))
+        cursor.copy_expert("COPY bulk_package_data (hash_md5, data) FROM STDIN", _copy_rows(self.package_data.items()))
+        cursor.close()
+
+        connection.execute("ANALYZE bulk_file, bulk_item, bulk_row, bulk_data, bulk_package_data")
+
+    def _merge_staging_tables(self, connection):
+        data = {'collection_id': self.collection_id}
+
+        # Several BulkStores can flush at the same time (see parallel_json_lines). Inserting in order of hash_md5 stops
+        # them deadlocking on each other's new rows.
+        for table in ('data', 'package_data'):
+            connection.execute(sa.sql.expression.text("""
+                INSERT INTO """ + table + """ (hash_md5, data)
+                SELECT hash_md5, data FROM bulk_""" + table + """
+                WHERE NOT EXISTS (SELECT 1 FROM """ + table + """ WHERE hash_md5 = bulk_""" + table + """.hash_md5)
+                ORDER BY hash_md5
+                ON CONFLICT (hash_md5) DO NOTHING
+            """), data)
+
+        connection.execute(sa.sql.expression.text("""
+            INSERT INTO collection_file (collection_id, filename, url)
+            SELECT :collection_id, filename, url FROM bulk_file WHERE url IS NOT NULL ORDER BY seq
+            ON CONFLICT (collection_id, filename) DO NOTHING
+        """), data)
+        connection.execute(sa.sql.expression.text("""
+            UPDATE collection_file SET warnings = bulk_file.warnings, store_end_at = :store_end_at
+            FROM bulk_file
+            WHERE collection_file.collection_id = :collection_id AND collection_file.filename = bulk_file.filename
+            AND bulk_file.done
+        """), dict(data, store_end_at=datetime.datetime.utcnow()))
+
+        # This will fail on the unique constraint if an item has already been stored, like DatabaseStore does.
+        result = connection.execute(sa.sql.expression.text("""
+            INSERT INTO collection_file_item (collection_file_id, number, warnings)
+            SELECT collection_file.id, bulk_item.number, bulk_item.warnings
+            FROM bulk_item
+            JOIN collection_file ON collection_file.collection_id = :collection_id
+                AND collection_file.filename = bulk_item.filename
+            ORDER BY bulk_item.seq
+            RETURNING id
+        """), data)
+        collection_file_item_ids = [row['id'] for row in result]
+
+        joins = """
+            FROM bulk_row
+            JOIN collection_file ON collection_file.collection_id = :collection_id
+                AND collection_file.filename = bulk_row.filename
+            JOIN collection_file_item ON collection_file_item.collection_file_id = collection_file.id
+                AND collection_file_item.number = bulk_row.number
+            JOIN data ON data.hash_md5 = bulk_row.data_hash_md5
+        """
+        package_data_join = " JOIN package_data ON package_data.hash_md5 = bulk_row.package_data_hash_md5 "
+
+        counts = {}
+        result = connection.execute(sa.sql.expression.text("""
+            INSERT INTO release (collection_id, collection_file_item_id, release_id, ocid, data_id, package_data_id)
+            SELECT :collection_id, collection_file_item.id, bulk_row.release_id, bulk_row.ocid, data.id,
+                package_data.id
+        """ + joins + package_data_join + " WHERE bulk_row.row_type = 'release' ORDER BY bulk_row.seq"), data)
+        counts['release'] = result.rowcount
+        result = connection.execute(sa.sql.expression.text("""
+            INSERT INTO record (collection_id, collection_file_item_id, ocid, data_id, package_data_id)
+            SELECT :collection_id, collection_file_item.id, bulk_row.ocid, data.id, package_data.id
+        """ + joins + package_data_join + " WHERE bulk_row.row_type = 'record' ORDER BY bulk_row.seq"), data)
+        counts['record'] = result.rowcount
+        result = connection.execute(sa.sql.expression.text("""
+            INSERT INTO compiled_release (collection_id, collection_file_item_id, ocid, data_id)
+            SELECT :collection_id, collection_file_item.id, bulk_row.ocid, data.id
+        """ + joins + " WHERE bulk_row.row_type = 'compiled_release' ORDER BY bulk_row.seq"), data)
+        counts['compiled_release'] = result.rowcount
+        self.database.add_collection_count_delta(connection, self.collection_id, counts)
+
+        return collection_file_item_ids
@@ -68,7 +68,8 @@ class Checks:
         if self.collection.check_data:
 
             s = sa.sql.select([self.database.release_table]) \
-                .where(self.database.release_table.c.collection_file_item_id == collection_file_item_id)
+                .where((self.database.release_table.c.collection_id == self.collection.database_id) &
+                       (self.database.release_table.c.collection_file_item_id == collection_file_item_id))
             with self.database.get_engine().begin() as connection:
                 releases = connection.execute(s)
             self._process_releases(releases)
@@ -78,7 +79,8 @@ class Checks:
                 return
 
             s = sa.sql.select([self.database.record_table]) \
-                .where(self.database.record_table.c.collection_file_item_id == collection_file_item_id)
+                .where((self.database.record_table.c.collection_id == self.collection.database_id) &
+                       (self.database.record_table.c.collection_file_item_id == collection_file_item_id))
             with self.database.get_engine().begin() as connection:
                 records = connection.execute(s)
             self._process_records(records)
@@ -91,7 +93,8 @@ class Checks:
         if self.collection.check_older_data_with_schema_version_1_1:
 
             s = sa.sql.select([self.database.release_table]) \
-                .where(self.database.release_table.c.collection_file_item_id == collection_file_item_id)
+                .where((self.database.release_table.c.collection_id == self.collection.database_id) &
+                       (self.database.release_table.c.collection_file_item_id == collection_file_item_id))
             with self.database.get_engine().begin() as connection:
                 releases = connection.execute(s)
             self._process_releases_with_override_schema_version_1_1(releases)
@@ -101,7 +104,8 @@ class Checks:
                 return
 
             s = sa.sql.select([self.database.record_table]) \
-                .where(self.database.record_table.c.collection_file_item_id == collection_file_item_id)
+                .where((self.database.record_table.c.collection_id == self.collection.database_id) &
+                       (self.database.record_table.c.collection_file_item_id == collection_file_item_id))
             with self.database.get_engine().begin() as connection:
                 records = connection.execute(s)
             self._process_records_with_override_schema_version_1_1(records)
@@ -113,7 +117,7 @@ class Checks:
     def _process_releases(self, releases):
         for release_row in releases:
             # Do Normal Check?
-            if not self.database.is_release_check_done(release_row['id']):
+            if not self.database.is_release_check_done(release_row['id'], collection_id=self.collection.database_id):
                 self._check_release_row(release_row)
             # Early return?
             if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
@@ -122,7 +126,7 @@ class Checks:
     def _process_records(self, records):
         for record_row in records:
             # Do Normal Check?
-            if not self.database.is_record_check_done(record_row['id']):
+            if not self.database.is_record_check_done(record_row['id'], collection_id=self.collection.database_id):
                 self._check_record_row(record_row)
             # Early return?
             if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
@@ -132,7 +136,8 @@ class Checks:
         for release_row in releases:
             # Do 1.1 check?
             if self._is_schema_version_less_than_1_1(release_row['package_data_id']) \
-                    and not self.database.is_release_check_done(release_row['id'], override_schema_version="1.1"):
+                    and not self.database.is_release_check_done(release_row['id'], override_schema_version="1.1",
+                                                                collection_id=self.collection.database_id):
                 self._check_release_row(release_row, override_schema_version="1.1")
             # Early return?
             if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
@@ -142,7 +147,8 @@ class Checks:
         for record_row in records:
             # Do 1.1 check?
             if self._is_schema_version_less_than_1_1(record_row['package_data_id']) \
-                    and not self.database.is_record_check_done(record_row['id'], override_schema_version="1.1"):
+                    and not self.database.is_record_check_done(record_row['id'], override_schema_version="1.1",
+                                                               collection_id=self.collection.database_id):
                 self._check_record_row(record_row, override_schema_version="1.1")
             # Early return?
             if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
@@ -178,7 +184,8 @@ class Checks:
             checks = [{
                 'release_id': release_row.id,
                 'cove_output': cove_output,
-                'override_schema_version': override_schema_version
+                'override_schema_version': override_schema_version,
+                'collection_id': self.collection.database_id,
             }]
             with self.database.get_engine().begin() as connection:
                 connection.execute(self.database.release_check_table.insert(), checks)
@@ -186,7 +193,8 @@ class Checks:
             checks = [{
                 'release_id': release_row.id,
                 'error': str(err),
-                'override_schema_version': override_schema_version
+                'override_schema_version': override_schema_version,
+                'collection_id': self.collection.database_id,
             }]
             with self.database.get_engine().begin() as connection:
                 connection.execute(self.database.release_check_error_table.insert(), checks)
@@ -203,7 +211,8 @@ class Checks:
             checks = [{
                 'record_id': record_row.id,
                 'cove_output': cove_output,
-                'override_schema_version': override_schema_version
+                'override_schema_version': override_schema_version,
+                'collection_id': self.collection.database_id,
             }]
             with self.database.get_engine().begin() as connection:
                 connection.execute(self.database.record_check_table.insert(), checks)
@@ -211,7 +220,8 @@ class Checks:
             checks = [{
                 'record_id': record_row.id,
                 'error': str(err),
-                'override_schema_version': override_schema_version
+                'override_schema_version': override_schema_version,
+                'collection_id': self.collection.database_id,
             }]
             with self.database.get_engine().begin() as connection:
                 connection.execute(self.database.record_check_error_table.insert(), checks)
@@ -6,6 +6,11 @@ import ocdskingfisherprocess.cli.commands.base
 class DeleteCollectionsCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
     command = 'delete-collections'
 
+    def configure_subparser(self, subparser):
+        subparser.add_argument("--all-orphan-data", action="store_true",
+                               help="Check all data and package data for orphans, not only those that were used by "
+                                    "deleted collections. This takes much longer on a large database.")
+
     def run_command(self, args):
         logger = logging.getLogger('ocdskingfisher.cli.delete-collections')
         logger.info("Starting command")
@@ -17,5 +22,5 @@ class DeleteCollectionsCLICommand(ocdskingfisherprocess.cli.commands.base.CLICom
                 self.database.delete_collection(collection.database_id)
         print("Orphan Data")
         logger.info("Starting to delete orphan data")
-        self.database.delete_orphan_data()
+        self.database.delete_orphan_data(all_data=args.all_orphan_data)
         logger.info("Finishing command")
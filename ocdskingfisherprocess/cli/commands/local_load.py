@@ -1,10 +1,37 @@
 import glob
+import logging
+import multiprocessing
 import os
 
 import ocdskingfisherprocess.cli.commands.base
 import ocdskingfisherprocess.database
+import ocdskingfisherprocess.parallel_json_lines
+import ocdskingfisherprocess.signals.signals
+from ocdskingfisherprocess.bulk_store import BulkStore
 from ocdskingfisherprocess.store import Store
 
+# Each worker process has its own database connection and store, set up by _init_worker.
+_worker_store = None
+
+
+def _init_worker(config, collection_id):
+    global _worker_store
+    database = ocdskingfisherprocess.database.DataBase(config)
+    ocdskingfisherprocess.signals.signals.setup_signals(config, database)
+    _worker_store = Store(config=config, database=database)
+    _worker_store.set_collection(database.get_collection(collection_id))
+
+
+def _store_file(args):
+    file_path, filename, url, file_type, encoding, stored_item_numbers = args
+    try:
+        _worker_store.stored_item_numbers = {filename: stored_item_numbers}
+        _worker_store.store_file_from_local(filename, url, file_type, encoding, file_path)
+        return file_path, None
+    except Exception as e:
+        logging.getLogger('ocdskingfisher.cli').exception("Error storing {}".format(file_path))
+        return file_path, repr(e)
+
 
 class CheckCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
     command = 'local-load'
@@ -18,6 +45,28 @@ class CheckCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
                                help="Keep collection store open (default is to end it straight after)",
                                default=False,
                                action='store_true')
+        subparser.add_argument("--bulk",
+                               help="Load with COPY and set-based queries. Faster for initial loads of many files.",
+                               default=False,
+                               action='store_true')
+        subparser.add_argument("--workers",
+                               help="Number of processes to store files with (default 1)",
+                               default=1,
+                               type=int)
+        subparser.add_argument("--json-lines-workers",
+                               help="Number of processes to store each JSON Lines file with (default 1)",
+                               default=1,
+                               type=int)
+        subparser.add_argument("--sorted",
+                               help="Store files in order of filename, so that files get the same IDs every time.",
+                               default=False,
+                               action='store_true')
+        subparser.add_argument("--resume",
+                               help="Skip files and items that are already stored, eg. after a load was interrupted.",
+                               default=False,
+                               action='store_true')
+        subparser.add_argument("--manifest",
+                               help="File to list stored files in. Files already listed in it are skipped.")
 
     def run_command(self, args):
 
@@ -36,24 +85,139 @@ class CheckCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
             print("We can not find the directory that you requested!")
             quit(-1)
 
-        store = Store(config=self.config, database=self.database)
-        store.set_collection(self.collection)
+        if args.bulk and args.workers > 1:
+            print("You can not use --bulk and --workers together!")
+            quit(-1)
+
+        if args.json_lines_workers > 1:
+            if file_type not in ocdskingfisherprocess.parallel_json_lines.JSON_LINES_DATA_TYPES:
+                print("You can only use --json-lines-workers with JSON Lines file types!")
+                quit(-1)
+            if args.bulk or args.workers > 1:
+                print("You can not use --json-lines-workers with --bulk or --workers!")
+                quit(-1)
 
         glob_path = os.path.join(directory, '*')
-        for file_path in glob.glob(glob_path):
-            print("Processing {}".format(file_path))
-            store.store_file_from_local(
-                file_path[len(directory):],
-                'file:/'+file_path,
-                file_type,
-                encoding,
-                file_path
-            )
+        file_paths = glob.glob(glob_path)
+        if args.sorted:
+            file_paths.sort()
+
+        if args.manifest and os.path.isfile(args.manifest):
+            with open(args.manifest) as f:
+                done = set(line.rstrip('\n') for line in f)
+            number_of_files = len(file_paths)
+            file_paths = [file_path for file_path in file_paths if file_path not in done]
+            print("Skipping {} files listed in the manifest".format(number_of_files - len(file_paths)))
+
+        if args.resume:
+            # Files that were completely stored are skipped without being read.
+            stored_filenames = self.database.get_stored_filenames(self.collection.database_id)
+            number_of_files = len(file_paths)
+            file_paths = [file_path for file_path in file_paths if file_path[len(directory):] not in stored_filenames]
+            print("Skipping {} files that are already stored".format(number_of_files - len(file_paths)))
+            stored_item_numbers = self.database.get_stored_item_numbers(self.collection.database_id)
+        else:
+            stored_item_numbers = {}
+
+        manifest = open(args.manifest, 'a') if args.manifest else None
+
+        try:
+            if args.workers > 1:
+                errors = self._store_files_with_workers(file_paths, directory, file_type, encoding, args.workers,
+                                                        args.sorted, stored_item_numbers, manifest)
+            else:
+                errors = {}
+                self._store_files(file_paths, directory, file_type, encoding, args.bulk, stored_item_numbers,
+                                  manifest, args.json_lines_workers)
+        finally:
+            if manifest:
+                manifest.close()
 
         print("Done")
 
-        if args.keep_collection_store_open:
+        if errors:
+            print("{} files could not be stored:".format(len(errors)))
+            for file_path, error in sorted(errors.items()):
+                print("{}: {}".format(file_path, error))
+            print("Not ending collection store; you may want to use the end-collection-store command")
+        elif args.keep_collection_store_open:
             print("Not ending collection store as requested; you may want to use the end-collection-store command")
         else:
             self.database.mark_collection_store_done(self.collection.database_id)
             print("And collection store ended!")
+
+    def _store_files(self, file_paths, directory, file_type, encoding, bulk, stored_item_numbers, manifest,
+                     json_lines_workers):
+        if bulk:
+            store = BulkStore(config=self.config, database=self.database)
+        else:
+            store = Store(config=self.config, database=self.database)
+        store.set_collection(self.collection)
+        store.stored_item_numbers = stored_item_numbers
+
+        for file_path in file_paths:
+            print("Processing {}".format(file_path))
+            if json_lines_workers > 1:
+                ocdskingfisherprocess.parallel_json_lines.store_file_from_local(
+                    store,
+                    file_path[len(directory):],
+                    'file:/'+file_path,
+                    file_type,
+                    encoding,
+                    file_path,
+                    json_lines_workers
+                )
+            else:
+                store.store_file_from_local(
+                    file_path[len(directory):],
+                    'file:/'+file_path,
+                    file_type,
+                    encoding,
+                    file_path
+                )
+            # With --bulk, files are only stored when flushed.
+            if manifest and not bulk:
+                self._add_to_manifest(manifest, file_path)
+
+        if bulk:
+            store.flush()
+            if manifest:
+                for file_path in file_paths:
+                    self._add_to_manifest(manifest, file_path)
+
+        if self.config.store_data_hash_filter and not bulk:
+            logging.getLogger('ocdskingfisher.cli').info("Data hash filter: {}, false positive rate: {}".format(
+                self.database.data_hash_filter_stats, self.database.get_data_hash_filter_false_positive_rate()))
+
+    def _store_files_with_workers(self, file_paths, directory, file_type, encoding, workers, create_files_first,
+                                  stored_item_numbers, manifest):
+        tasks = []
+        for file_path in file_paths:
+            filename = file_path[len(directory):]
+            tasks.append((file_path, filename, 'file:/'+file_path, file_type, encoding,
+                          stored_item_numbers.get(filename, set())))
+
+        if create_files_first:
+            # The workers finish files in any order, so create the files' rows now.
+            self.database.create_collection_files(self.collection.database_id,
+                                                  [(task[1], task[2]) for task in tasks])
+
+        # Connections must not be shared with the worker processes.
+        self.database.get_engine().dispose()
+
+        errors = {}
+        with multiprocessing.Pool(workers, _init_worker, (self.config, self.collection.database_id)) as pool:
+            for file_path, error in pool.imap_unordered(_store_file, tasks):
+                if error:
+                    errors[file_path] = error
+                    print("Error {}: {}".format(file_path, error))
+                else:
+                    print("Processed {}".format(file_path))
+                    if manifest:
+                        self._add_to_manifest(manifest, file_path)
+
+        return errors
+
+    def _add_to_manifest(self, manifest, file_path):
+        manifest.write(file_path + '\n')
+        manifest.flush()
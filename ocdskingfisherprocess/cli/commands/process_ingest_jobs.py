@@ -0,0 +1,34 @@
+import datetime
+import logging
+import time
+
+import ocdskingfisherprocess.cli.commands.base
+from ocdskingfisherprocess.ingest_job import ProcessIngestJobs
+
+
+class ProcessIngestJobsCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
+    command = 'process-ingest-jobs'
+
+    def configure_subparser(self, subparser):
+        subparser.add_argument("--runforseconds",
+                               help="Run for this many seconds only.")
+
+    def run_command(self, args):
+        run_until_timestamp = None
+        run_for_seconds = int(args.runforseconds) if args.runforseconds else 0
+        if run_for_seconds > 0:
+            run_until_timestamp = datetime.datetime.utcnow().timestamp() + run_for_seconds
+
+        process_ingest_jobs = ProcessIngestJobs(config=self.config, database=self.database)
+        logger = logging.getLogger('ocdskingfisher.ingest-job')
+
+        while True:
+            if process_ingest_jobs.process_next():
+                if not args.quiet:
+                    print("Processed!")
+            else:
+                logger.debug("No ingest jobs queued")
+                time.sleep(10)
+            # Early return?
+            if run_until_timestamp and run_until_timestamp < datetime.datetime.utcnow().timestamp():
+                return
@@ -1,5 +1,4 @@
 import datetime
-import json
 import logging
 import os
 from threading import Timer
@@ -7,6 +6,7 @@ from threading import Timer
 import redis
 
 import ocdskingfisherprocess.cli.commands.base
+from ocdskingfisherprocess.jsoncodec import get_codec
 from ocdskingfisherprocess.transform.util import get_transform_instance
 
 
@@ -44,7 +44,7 @@ class ProcessRedisQueueCollectionStoreFinishedCLICommand(ocdskingfisherprocess.c
         while run:
             data = redis_conn.blpop("kingfisher_work_collection_store_finished", timeout=10)
             if data:
-                message = json.loads(data[1].decode('ascii'))
+                message = get_codec(self.config.json_codec).loads(data[1].decode('ascii'))
                 if not args.quiet:
                     print("Got Collection: " + str(message.get('collection_id')))
                 logger.info("Got Collection: " + str(message.get('collection_id')))
@@ -0,0 +1,20 @@
+import ocdskingfisherprocess.cli.commands.base
+
+
+class SaveDataHashFilterCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
+    command = 'save-data-hash-filter'
+
+    def configure_subparser(self, subparser):
+        subparser.add_argument("filename", nargs='?',
+                               help="The file to save to. Defaults to DATA_HASH_FILTER_SNAPSHOT in the STORE config.")
+
+    def run_command(self, args):
+        filename = args.filename or self.config.store_data_hash_filter_snapshot
+        if not filename:
+            print("Pass a filename, or set DATA_HASH_FILTER_SNAPSHOT in the STORE config")
+            return
+
+        data_hash_filter = self.database.save_data_hash_filter(filename)
+
+        if not args.quiet:
+            print("Saved data hash filter with data up to ID {}".format(data_hash_filter.max_data_id))
@@ -59,6 +59,13 @@ class TransformCollectionsCLICommand(ocdskingfisherprocess.cli.commands.base.CLI
 
             Timer(run_for_seconds + 60, exitfunc).start()
 
+        # Each thread uses a connection at a time, from the shared pool.
+        if not self.config.database_pgbouncer and self.config.database_pool_max_overflow >= 0:
+            max_connections = self.config.database_pool_size + self.config.database_pool_max_overflow
+            if args.threads > max_connections:
+                logger.warning("--threads is " + str(args.threads) + ", but the database pool allows only " +
+                               str(max_connections) + " connections. Threads will wait for connections.")
+
         with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as executor:
             futures = [
                 executor.submit(
@@ -7,6 +7,12 @@ import ocdskingfisherprocess.database
 class UpdateCollectionCachesCLICommand(ocdskingfisherprocess.cli.commands.base.CLICommand):
     command = 'update-collection-caches'
 
+    def configure_subparser(self, subparser):
+        subparser.add_argument("--recount", action="store_true",
+                               help="Count each collection's rows, instead of adding the counts of rows stored "
+                                    "since the last update. This reads all the rows, so use it to check or repair the "
+                                    "counts.")
+
     def run_command(self, args):
         logger = logging.getLogger('ocdskingfisher.cli.update-collection-caches')
         logger.info("Starting command")
@@ -16,4 +22,4 @@ class UpdateCollectionCachesCLICommand(ocdskingfisherprocess.cli.commands.base.C
                 if not args.quiet:
                     print("Collection " + str(collection.database_id))
                 logger.info("Starting to update caches for collection " + str(collection.database_id))
-                self.database.update_collection_cached_columns(collection.database_id)
+                self.database.update_collection_cached_columns(collection.database_id, recount=args.recount)
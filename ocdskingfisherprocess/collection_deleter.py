@@ -0,0 +1,202 @@
+"""Deletes a collection's rows in small batches, so that no transaction is large. See DataBase.delete_collection.
+
+Each table is deleted in a step. A step selects the next batch of keys (in order, after the last key of the previous
+batch), and deletes the rows with those keys. The last key is saved in the collection_delete_progress table in the
+same transaction, so that an interrupted deletion resumes where it stopped.
+
+When rows that reference the data and package_data tables are deleted, the IDs that they reference are added to the
+orphan_candidate table, in the same transaction. See DataBase.delete_orphan_data.
+
+Deletions can be throttled to a number of rows per second, and/or by sleeping between batches. See the Delete section
+of the config docs."""
+
+import datetime
+import logging
+import time
+
+import sqlalchemy as sa
+
+
+def _select_ids(table):
+    return """SELECT id FROM {} WHERE collection_id = :collection_id AND id > :last_id
+              ORDER BY id LIMIT :batch_size""".format(table)
+
+
+def _select_keys(table, key_column, parent_table):
+    # The key isn't unique in the check tables, so a batch has all the rows with each key.
+    return """SELECT DISTINCT {0}.{1} AS id FROM {0} JOIN {2} ON {2}.id = {0}.{1}
+              WHERE {2}.collection_id = :collection_id AND {0}.{1} > :last_id
+              ORDER BY 1 LIMIT :batch_size""".format(table, key_column, parent_table)
+
+
+# (table, key column, SQL that selects the keys of the next batch)
+STATUS_STEPS = [
+    ('transform_upgrade_1_0_to_1_1_status_record', 'source_record_id',
+     _select_keys('transform_upgrade_1_0_to_1_1_status_record', 'source_record_id', 'record')),
+    ('transform_upgrade_1_0_to_1_1_status_release', 'source_release_id',
+     _select_keys('transform_upgrade_1_0_to_1_1_status_release', 'source_release_id', 'release')),
+]
+
+# Only used for collections created before the tables were partitioned. Other collections' partitions are dropped.
+PARTITIONED_STEPS = [
+    ('release_check_error', 'release_id', _select_keys('release_check_error', 'release_id', 'release')),
+    ('record_check_error', 'record_id', _select_keys('record_check_error', 'record_id', 'record')),
+    ('record_check', 'record_id', _select_keys('record_check', 'record_id', 'record')),
+    ('release_check', 'release_id', _select_keys('release_check', 'release_id', 'release')),
+    ('compiled_release', 'id', _select_ids('compiled_release')),
+    ('record', 'id', _select_ids('record')),
+    ('release', 'id', _select_ids('release')),
+]
+
+# The tables whose rows reference the data and package_data tables, and their columns that do.
+DATA_REFERENCES = {
+    'release': [('data', 'data_id'), ('package_data', 'package_data_id')],
+    'record': [('data', 'data_id'), ('package_data', 'package_data_id')],
+    'compiled_release': [('data', 'data_id')],
+}
+
+COLLECTION_STEPS = [
+    ('collection_file_item', 'id', """SELECT collection_file_item.id FROM collection_file_item
+        JOIN collection_file ON collection_file_item.collection_file_id = collection_file.id
+        WHERE collection_file.collection_id = :collection_id AND collection_file_item.id > :last_id
+        ORDER BY collection_file_item.id LIMIT :batch_size"""),
+    ('collection_file', 'id', _select_ids('collection_file')),
+    ('collection_note', 'id', _select_ids('collection_note')),
+    ('ingest_job', 'id', _select_ids('ingest_job')),
+]
+
+
+class CollectionDeleter:
+
+    def __init__(self, database, collection_id):
+        self.database = database
+        self.collection_id = collection_id
+        self.batch_size = database.config.delete_batch_size
+        self.max_rows_per_second = database.config.delete_max_rows_per_second
+        self.sleep = database.config.delete_sleep
+        self.logger = logging.getLogger('ocdskingfisher.database.delete-collection')
+
+    def run(self):
+        for table, key_column, select_sql in STATUS_STEPS:
+            self._run_step(table, key_column, select_sql)
+
+        partitions = self.database.get_collection_partitions(self.collection_id)
+        if partitions:
+            self._drop_partitions(partitions)
+        else:
+            for table, key_column, select_sql in PARTITIONED_STEPS:
+                self._run_step(table, key_column, select_sql)
+
+        for table, key_column, select_sql in COLLECTION_STEPS:
+            self._run_step(table, key_column, select_sql)
+
+        self.logger.debug("Deleting collection " + str(self.collection_id))
+        with self.database.get_engine().begin() as connection:
+            data = {'collection_id': self.collection_id}
+            connection.execute(sa.sql.expression.text(
+                "UPDATE collection SET transform_from_collection_id = NULL "
+                "WHERE transform_from_collection_id = :collection_id"), data)
+            connection.execute(sa.sql.expression.text(
+                "DELETE FROM collection_delete_progress WHERE collection_id = :collection_id"), data)
+            connection.execute(sa.sql.expression.text(
+                "DELETE FROM collection_count_delta WHERE collection_id = :collection_id"), data)
+            connection.execute(sa.sql.expression.text("DELETE FROM collection WHERE id = :collection_id"), data)
+
+    def _drop_partitions(self, partitions):
+        for table, partition in partitions:
+            self.logger.debug("Dropping " + partition + " for collection " + str(self.collection_id))
+            # Dropping a partition locks its partitioned table, so each is dropped in its own transaction.
+            with self.database.get_engine().begin() as connection:
+                for referenced_table, column in DATA_REFERENCES.get(table, []):
+                    connection.execute(
+                        "INSERT INTO orphan_candidate (table_name, id) SELECT DISTINCT '{}', {} FROM {} "
+                        "ON CONFLICT DO NOTHING".format(referenced_table, column, partition))
+                connection.execute("DROP TABLE IF EXISTS " + partition)
+
+    def _run_step(self, table, key_column, select_sql):
+        progress = self._get_progress(table)
+        if progress and progress['done']:
+            return
+
+        last_id = progress['last_id'] if progress else 0
+        rows_deleted = progress['rows_deleted'] if progress else 0
+        started_at = progress['started_at'] if progress else datetime.datetime.utcnow()
+        if progress:
+            self.logger.info("Resuming deleting " + table + " for collection " + str(self.collection_id) +
+                             " after " + str(last_id))
+        else:
+            self.logger.debug("Deleting " + table + " for collection " + str(self.collection_id))
+
+        step_start = time.monotonic()
+        step_rows = 0
+        while True:
+            batch_start = time.monotonic()
+            with self.database.get_engine().begin() as connection:
+                ids = [row['id'] for row in connection.execute(sa.sql.expression.text(select_sql), {
+                    'collection_id': self.collection_id,
+                    'last_id': last_id,
+                    'batch_size': self.batch_size,
+                })]
+                count = 0
+                if ids:
+                    last_id = ids[-1]
+                    count = self._delete(connection, table, key_column, ids)
+                    rows_deleted += count
+                self._save_progress(connection, table, last_id, rows_deleted, not ids, started_at)
+
+            if not ids:
+                break
+
+            step_rows += count
+            rate = step_rows / max(time.monotonic() - step_start, 0.001)
+            self.logger.debug("Deleted " + str(rows_deleted) + " rows from " + table + " for collection " +
+                              str(self.collection_id) + " (" + str(int(rate)) + " rows/s)")
+            self._throttle(count, batch_start)
+
+        self.logger.info("Deleted " + str(rows_deleted) + " rows from " + table + " for collection " +
+                         str(self.collection_id))
+
+    def _delete(self, connection, table, key_column, ids):
+        sql = "DELETE FROM " + table + " WHERE " + key_column + " = ANY(:ids)"
+        if table not in DATA_REFERENCES:
+            return connection.execute(sa.sql.expression.text(sql), {'ids': ids}).rowcount
+
+        columns = DATA_REFERENCES[table]
+        sql = "WITH deleted AS (" + sql + " RETURNING " + ", ".join(column for _, column in columns) + ")"
+        for i, (referenced_table, column) in enumerate(columns):
+            sql += (", candidate_{} AS (INSERT INTO orphan_candidate (table_name, id) SELECT DISTINCT '{}', {} "
+                    "FROM deleted ON CONFLICT DO NOTHING)").format(i, referenced_table, column)
+        sql += " SELECT count(*) FROM deleted"
+        return connection.execute(sa.sql.expression.text(sql), {'ids': ids}).scalar()
+
+    def _throttle(self, count, batch_start):
+        wait = self.sleep
+        if self.max_rows_per_second:
+            wait = max(wait, count / self.max_rows_per_second - (time.monotonic() - batch_start))
+        if wait > 0:
+            time.sleep(wait)
+
+    def _get_progress(self, table):
+        progress_table = self.database.collection_delete_progress_table
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([progress_table]) \
+                .where((progress_table.c.collection_id == self.collection_id) &
+                       (progress_table.c.table_name == table))
+            return connection.execute(s).fetchone()
+
+    def _save_progress(self, connection, table, last_id, rows_deleted, done, started_at):
+        connection.execute(sa.sql.expression.text("""
+            INSERT INTO collection_delete_progress
+                (collection_id, table_name, last_id, rows_deleted, done, started_at, updated_at)
+            VALUES (:collection_id, :table_name, :last_id, :rows_deleted, :done, :started_at, :updated_at)
+            ON CONFLICT (collection_id, table_name) DO UPDATE SET
+                last_id = excluded.last_id, rows_deleted = excluded.rows_deleted, done = excluded.done,
+                updated_at = excluded.updated_at"""), {
+            'collection_id': self.collection_id,
+            'table_name': table,
+            'last_id': last_id,
+            'rows_deleted': rows_deleted,
+            'done': done,
+            'started_at': started_at,
+            'updated_at': datetime.datetime.utcnow(),
+        })
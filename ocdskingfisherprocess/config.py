@@ -10,21 +10,47 @@ Whatever tool is calling it - CLI or other code - should create one of these, se
 """
 
 
+def _is_true(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 class Config:
 
     def __init__(self):
         self.web_api_keys = []
+        self.web_async_file_store = False
+        self.web_upload_directory = ''
         self.database_uri = ''
         self._database_host = ''
         self._database_port = 5432
         self._database_user = ''
         self._database_name = ''
         self._database_password = ''
+        self.database_pool_size = 5
+        self.database_pool_max_overflow = 10
+        self.database_pool_timeout = 30
+        self.database_pool_recycle = -1
+        self.database_pool_pre_ping = False
+        self.database_pgbouncer = False
         self.run_standard_pipeline = False
         self.redis_host = ''
         self.redis_port = 6379
         self.redis_database = 0
+        self.redis_id_cache = False
+        self.redis_id_cache_ttl = 86400
         self.sentry_dsn = ''
+        self.store_batch_size = 500
+        self.store_stream_min_file_size = 104857600
+        self.store_mmap_min_file_size = 104857600
+        self.store_items_per_transaction = 1
+        self.store_data_hash_filter = ''
+        self.store_data_hash_filter_capacity = 10000000
+        self.store_data_hash_filter_error_rate = 0.01
+        self.store_data_hash_filter_snapshot = ''
+        self.delete_batch_size = 10000
+        self.delete_max_rows_per_second = 0
+        self.delete_sleep = 0
+        self.json_codec = 'stdlib'
 
     def load_user_config(self):
         # First, try and load any config in the ini files
@@ -74,6 +100,19 @@ class Config:
         if os.environ.get('KINGFISHER_PROCESS_DB_URI'):
             self.database_uri = os.environ.get('KINGFISHER_PROCESS_DB_URI')
 
+        if os.environ.get('KINGFISHER_PROCESS_DB_POOL_SIZE'):
+            self.database_pool_size = int(os.environ.get('KINGFISHER_PROCESS_DB_POOL_SIZE'))
+        if os.environ.get('KINGFISHER_PROCESS_DB_POOL_MAX_OVERFLOW'):
+            self.database_pool_max_overflow = int(os.environ.get('KINGFISHER_PROCESS_DB_POOL_MAX_OVERFLOW'))
+        if os.environ.get('KINGFISHER_PROCESS_DB_POOL_TIMEOUT'):
+            self.database_pool_timeout = float(os.environ.get('KINGFISHER_PROCESS_DB_POOL_TIMEOUT'))
+        if os.environ.get('KINGFISHER_PROCESS_DB_POOL_RECYCLE'):
+            self.database_pool_recycle = int(os.environ.get('KINGFISHER_PROCESS_DB_POOL_RECYCLE'))
+        if os.environ.get('KINGFISHER_PROCESS_DB_POOL_PRE_PING'):
+            self.database_pool_pre_ping = _is_true(os.environ.get('KINGFISHER_PROCESS_DB_POOL_PRE_PING'))
+        if os.environ.get('KINGFISHER_PROCESS_DB_PGBOUNCER'):
+            self.database_pgbouncer = _is_true(os.environ.get('KINGFISHER_PROCESS_DB_PGBOUNCER'))
+
     def _load_user_config_ini(self):
         config = configparser.ConfigParser()
 
@@ -83,6 +122,8 @@ class Config:
             return
 
         self.web_api_keys = [key.strip() for key in config.get('WEB', 'API_KEYS', fallback='').split(',')]
+        self.web_async_file_store = config.getboolean('WEB', 'ASYNC_FILE_STORE', fallback=False)
+        self.web_upload_directory = config.get('WEB', 'UPLOAD_DIRECTORY', fallback='')
 
         self._database_host = config.get('DBHOST', 'HOSTNAME')
         self._database_port = config.get('DBHOST', 'PORT')
@@ -98,14 +139,41 @@ class Config:
             self._database_name
         )
 
+        self.database_pool_size = config.getint('DBPOOL', 'SIZE', fallback=5)
+        self.database_pool_max_overflow = config.getint('DBPOOL', 'MAX_OVERFLOW', fallback=10)
+        self.database_pool_timeout = config.getfloat('DBPOOL', 'TIMEOUT', fallback=30)
+        self.database_pool_recycle = config.getint('DBPOOL', 'RECYCLE', fallback=-1)
+        self.database_pool_pre_ping = config.getboolean('DBPOOL', 'PRE_PING', fallback=False)
+        self.database_pgbouncer = config.getboolean('DBPOOL', 'PGBOUNCER', fallback=False)
+
         self.run_standard_pipeline = \
             config.getboolean('STANDARD_PIPELINE', 'RUN', fallback=False)
 
         self.redis_host = config.get('REDIS', 'HOST', fallback='')
         self.redis_port = config.get('REDIS', 'PORT', fallback=6379)
         self.redis_database = config.get('REDIS', 'DATABASE', fallback=0)
+        self.redis_id_cache = config.getboolean('REDIS', 'ID_CACHE', fallback=False)
+        self.redis_id_cache_ttl = config.getint('REDIS', 'ID_CACHE_TTL', fallback=86400)
 
         self.sentry_dsn = config.get('SENTRY', 'DSN', fallback='')
 
+        self.store_batch_size = config.getint('STORE', 'BATCH_SIZE', fallback=500)
+        self.store_stream_min_file_size = config.getint('STORE', 'STREAM_MIN_FILE_SIZE', fallback=104857600)
+        self.store_mmap_min_file_size = config.getint('STORE', 'MMAP_MIN_FILE_SIZE', fallback=104857600)
+        self.store_items_per_transaction = config.getint('STORE', 'ITEMS_PER_TRANSACTION', fallback=1)
+        self.store_data_hash_filter = config.get('STORE', 'DATA_HASH_FILTER', fallback='')
+        self.store_data_hash_filter_capacity = config.getint('STORE', 'DATA_HASH_FILTER_CAPACITY', fallback=10000000)
+        self.store_data_hash_filter_error_rate = config.getfloat('STORE', 'DATA_HASH_FILTER_ERROR_RATE', fallback=0.01)
+        self.store_data_hash_filter_snapshot = config.get('STORE', 'DATA_HASH_FILTER_SNAPSHOT', fallback='')
+
+        self.delete_batch_size = config.getint('DELETE', 'BATCH_SIZE', fallback=10000)
+        self.delete_max_rows_per_second = config.getfloat('DELETE', 'MAX_ROWS_PER_SECOND', fallback=0)
+        self.delete_sleep = config.getfloat('DELETE', 'SLEEP', fallback=0)
+
+        self.json_codec = config.get('JSON', 'CODEC', fallback='stdlib')
+
     def is_redis_available(self):
         return self.redis_host and self.redis_port
+
+    def is_redis_id_cache_enabled(self):
+        return bool(self.redis_id_cache and self.is_redis_available())
@@ -1,31 +1,119 @@
 import collections
 import datetime
-import json
 import logging
 import os
-from functools import partial
+import sys
+import threading
+import time
 
 import alembic.config
 import sqlalchemy as sa
 from sqlalchemy.dialects.postgresql import JSONB
 
-from ocdskingfisherprocess.models import CollectionModel, CollectionNoteModel, FileItemModel, FileModel
+from ocdskingfisherprocess import prometheus
+from ocdskingfisherprocess.bloom_filter import BloomFilter
+from ocdskingfisherprocess.collection_deleter import CollectionDeleter
+from ocdskingfisherprocess.id_cache import RedisIdCache
+from ocdskingfisherprocess.jsoncodec import get_codec
+from ocdskingfisherprocess.models import CollectionModel, CollectionNoteModel, FileItemModel, FileModel, IngestJobModel
 from ocdskingfisherprocess.signals import KINGFISHER_SIGNALS
-from ocdskingfisherprocess.util import get_hash_md5_for_data
-
-
-class SetEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, set):
-            return list(obj)
-        return json.JSONEncoder.default(self, obj)
+from ocdskingfisherprocess.util import LRUCache, get_json_and_hash_md5_for_data
+
+# These tables are partitioned by collection_id, with one partition per collection, named {table}_collection_{id}.
+# Rows from before the tables were partitioned are in the {table}_default partitions.
+#
+# Primary keys, unique constraints and foreign keys are on each partition, as PostgreSQL 11 doesn't support them on
+# partitioned tables. The tables are in the order in which their partitions are created; they are dropped in reverse.
+_DATA_CONSTRAINTS = [
+    'PRIMARY KEY (id)',
+    'FOREIGN KEY (collection_id) REFERENCES collection (id)',
+    'FOREIGN KEY (collection_file_item_id) REFERENCES collection_file_item (id)',
+    'FOREIGN KEY (data_id) REFERENCES data (id)',
+]
+PARTITIONED_TABLES = collections.OrderedDict([
+    ('release', _DATA_CONSTRAINTS + ['FOREIGN KEY (package_data_id) REFERENCES package_data (id)']),
+    ('record', _DATA_CONSTRAINTS + ['FOREIGN KEY (package_data_id) REFERENCES package_data (id)']),
+    ('compiled_release', _DATA_CONSTRAINTS),
+    ('release_check', [
+        'PRIMARY KEY (id)',
+        'UNIQUE (release_id, override_schema_version)',
+        'FOREIGN KEY (collection_id) REFERENCES collection (id)',
+    ]),
+    ('release_check_error', [
+        'PRIMARY KEY (id)',
+        'FOREIGN KEY (collection_id) REFERENCES collection (id)',
+    ]),
+    ('record_check', [
+        'PRIMARY KEY (id)',
+        'UNIQUE (record_id, override_schema_version)',
+        'FOREIGN KEY (collection_id) REFERENCES collection (id)',
+    ]),
+    ('record_check_error', [
+        'PRIMARY KEY (id)',
+        'FOREIGN KEY (collection_id) REFERENCES collection (id)',
+    ]),
+])
+
+
+# https://www.postgresql.org/docs/11/errcodes-appendix.html
+CHECK_VIOLATION = '23514'
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+class TimedQueuePool(sa.pool.QueuePool):
+    # Records how long each checkout waits for a connection, including to open a new connection, if there is room.
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        except sa.exc.TimeoutError:
+            prometheus.PROMETHEUS_DB_POOL_CHECKOUT_TIMEOUTS.inc()
+            raise
+        finally:
+            prometheus.PROMETHEUS_DB_POOL_CHECKOUT_SECONDS.observe(time.monotonic() - start)
 
 
 class DataBase:
 
+    COLLECTION_FILE_ID_CACHE_SIZE = 10000
+    PACKAGE_DATA_ID_CACHE_SIZE = 1000
+    DATA_ID_CACHE_SIZE = 10000
+    # How long to wait for the lock on a partitioned table to create a collection's partition, and how many times to
+    # try. See create_collection_partitions.
+    PARTITION_LOCK_TIMEOUT = '5s'
+    PARTITION_LOCK_ATTEMPTS = 5
+    # Once a process has added this many rows to collection_count_delta for a collection, they are added to the
+    # collection's cached columns, so that the table stays small while a collection is stored. See
+    # collection_count_delta_committed.
+    COLLECTION_COUNT_DELTA_FOLD_SIZE = 1000
+
     def __init__(self, config):
         self.config = config
         self._engine = None
+        self._engine_lock = threading.Lock()
+
+        # Only committed rows are added to these caches. See DatabaseStore.
+        # (collection_id, filename) -> collection_file id
+        self.collection_file_ids = LRUCache(self.COLLECTION_FILE_ID_CACHE_SIZE)
+        # hash_md5 -> package_data id
+        self.package_data_ids = LRUCache(self.PACKAGE_DATA_ID_CACHE_SIZE)
+        # hash_md5 -> data id
+        self.data_ids = LRUCache(self.DATA_ID_CACHE_SIZE)
+        # IDs of collections whose partitions exist. See get_or_create_collection_id.
+        self.collection_ids_with_partitions = set()
+        # collection_id -> number of collection_count_delta rows committed by this process since they were last added
+        # to the collection's cached columns
+        self.collection_count_deltas_committed = collections.Counter()
+        # A second level of the data and package_data caches, shared by all processes. See get_cached_ids.
+        self.id_cache = RedisIdCache(config) if config.is_redis_id_cache_enabled() else None
+        self.id_cache_generation = None
+
+        # See get_data_hash_filter.
+        self.data_hash_filter = None
+        self.data_hash_filter_source_ids = set()
+        self.data_hash_filter_collection_ids = set()
+        self.data_hash_filter_stats = {'lookups_saved': 0, 'maybe': 0, 'false_positives': 0, 'conflicts': 0}
+        self._data_hash_filter_lock = threading.Lock()
 
         self.metadata = sa.MetaData()
 
@@ -75,6 +163,7 @@ class DataBase:
                                               sa.Column('url', sa.Text, nullable=False),
                                               sa.Column('warnings', JSONB, nullable=True),
                                               sa.Column('errors', JSONB, nullable=True),
+                                              sa.Column('store_end_at', sa.DateTime(timezone=False), nullable=True),
                                               sa.UniqueConstraint('collection_id', 'filename',
                                                                   name='unique_collection_file_identifiers'),
                                               sa.Index('collection_file_collection_id_idx', 'collection_id'),
@@ -129,10 +218,10 @@ class DataBase:
                                       sa.Column('package_data_id', sa.Integer,
                                                 sa.ForeignKey("package_data.id", name="fk_release_package_data_id"),
                                                 nullable=False),
-                                      sa.Index('release_collection_id_idx', 'collection_id'),
                                       sa.Index('release_collection_file_item_id_idx', 'collection_file_item_id'),
                                       sa.Index('release_ocid_idx', 'ocid'),
                                       sa.Index('release_package_data_id_idx', 'package_data_id'),
+                                      postgresql_partition_by='LIST (collection_id)',
                                       )
 
         self.record_table = sa.Table('record', self.metadata,
@@ -158,10 +247,10 @@ class DataBase:
                                      sa.Column('package_data_id', sa.Integer,
                                                sa.ForeignKey("package_data.id", name="fk_record_package_data_id"),
                                                nullable=False),
-                                     sa.Index('record_collection_id_idx', 'collection_id'),
                                      sa.Index('record_collection_file_item_id_idx', 'collection_file_item_id'),
                                      sa.Index('record_ocid_idx', 'ocid'),
                                      sa.Index('record_package_data_id_idx', 'package_data_id'),
+                                     postgresql_partition_by='LIST (collection_id)',
                                      )
 
         self.compiled_release_table = sa.Table('compiled_release', self.metadata,
@@ -183,72 +272,64 @@ class DataBase:
                                                sa.Column('data_id', sa.Integer,
                                                          sa.ForeignKey("data.id", name="fk_complied_release_data_id"),
                                                          nullable=False),
-                                               sa.Index('compiled_release_collection_id_idx', 'collection_id'),
                                                sa.Index(
                                                    'compiled_release_collection_file_item_id_idx',
                                                    'collection_file_item_id'
                                                ),
                                                sa.Index('compiled_release_ocid_idx', 'ocid'),
+                                               postgresql_partition_by='LIST (collection_id)',
                                                )
 
         self.release_check_table = sa.Table('release_check', self.metadata,
                                             sa.Column('id', sa.Integer, primary_key=True),
-                                            sa.Column('release_id', sa.Integer,
-                                                      sa.ForeignKey("release.id", name="fk_release_check_release_id"),
-                                                      nullable=False),
+                                            sa.Column('release_id', sa.Integer, nullable=False),
                                             sa.Column('override_schema_version', sa.Text, nullable=False),
                                             sa.Column('cove_output', JSONB, nullable=False),
+                                            sa.Column('collection_id', sa.Integer, nullable=True),
                                             sa.UniqueConstraint('release_id', 'override_schema_version',
                                                                 name='unique_release_check_release_id_and_more'),
                                             sa.Index('release_check_release_id_idx', 'release_id'),
+                                            postgresql_partition_by='LIST (collection_id)',
                                             )
 
         self.record_check_table = sa.Table('record_check', self.metadata,
                                            sa.Column('id', sa.Integer, primary_key=True),
-                                           sa.Column('record_id', sa.Integer,
-                                                     sa.ForeignKey("record.id", name="fk_record_check_record_id"),
-                                                     nullable=False),
+                                           sa.Column('record_id', sa.Integer, nullable=False),
                                            sa.Column('override_schema_version', sa.Text, nullable=False),
                                            sa.Column('cove_output', JSONB, nullable=False),
+                                           sa.Column('collection_id', sa.Integer, nullable=True),
                                            sa.UniqueConstraint('record_id', 'override_schema_version',
                                                                name='unique_record_check_record_id_and_more'),
                                            sa.Index('record_check_record_id_idx', 'record_id'),
+                                           postgresql_partition_by='LIST (collection_id)',
                                            )
 
         self.release_check_error_table = sa.Table('release_check_error', self.metadata,
                                                   sa.Column('id', sa.Integer, primary_key=True),
-                                                  sa.Column(
-                                                      'release_id',
-                                                      sa.Integer,
-                                                      sa.ForeignKey("release.id",
-                                                                    name="fk_release_check_error_release_id"),
-                                                      nullable=False
-                                                  ),
+                                                  sa.Column('release_id', sa.Integer, nullable=False),
                                                   sa.Column('override_schema_version', sa.Text, nullable=False),
                                                   sa.Column('error', sa.Text, nullable=False),
+                                                  sa.Column('collection_id', sa.Integer, nullable=True),
                                                   sa.UniqueConstraint(
                                                       'release_id',
                                                       'override_schema_version',
                                                       name='unique_release_check_error_release_id_and_more'),
                                                   sa.Index('release_check_error_release_id_idx', 'release_id'),
+                                                  postgresql_partition_by='LIST (collection_id)',
                                                   )
 
         self.record_check_error_table = sa.Table('record_check_error', self.metadata,
                                                  sa.Column('id', sa.Integer, primary_key=True),
-                                                 sa.Column(
-                                                     'record_id',
-                                                     sa.Integer,
-                                                     sa.ForeignKey("record.id",
-                                                                   name="fk_record_check_error_record_id"),
-                                                     nullable=False
-                                                 ),
+                                                 sa.Column('record_id', sa.Integer, nullable=False),
                                                  sa.Column('override_schema_version', sa.Text, nullable=False),
                                                  sa.Column('error', sa.Text, nullable=False),
+                                                 sa.Column('collection_id', sa.Integer, nullable=True),
                                                  sa.UniqueConstraint(
                                                      'record_id',
                                                      'override_schema_version',
                                                      name='unique_record_check_error_record_id_and_more'),
                                                  sa.Index('record_check_error_record_id_idx', 'record_id'),
+                                                 postgresql_partition_by='LIST (collection_id)',
                                                  )
 
         self.transform_upgrade_1_0_to_1_1_status_release_table = sa.Table(
@@ -257,10 +338,6 @@ class DataBase:
             sa.Column(
                 'source_release_id',
                 sa.Integer,
-                sa.ForeignKey(
-                    "release.id",
-                    name="fk_transform_upgrade_1_0_to_1_1_status_release_source_release_id"
-                ),
                 nullable=False,
                 primary_key=True
             )
@@ -272,30 +349,125 @@ class DataBase:
             sa.Column(
                 'source_record_id',
                 sa.Integer,
-                sa.ForeignKey(
-                    "record.id",
-                    name="fk_transform_upgrade_1_0_to_1_1_status_record_source_record_id"
-                ),
                 nullable=False,
                 primary_key=True
             )
         )
 
+        self.ingest_job_table = sa.Table('ingest_job', self.metadata,
+                                         sa.Column('id', sa.Integer, primary_key=True),
+                                         sa.Column('collection_id', sa.Integer,
+                                                   sa.ForeignKey("collection.id", name="fk_ingest_job_collection_id"),
+                                                   nullable=False),
+                                         sa.Column('filename', sa.Text, nullable=False),
+                                         sa.Column('url', sa.Text, nullable=False),
+                                         sa.Column('data_type', sa.Text, nullable=False),
+                                         sa.Column('encoding', sa.Text, nullable=False),
+                                         sa.Column('local_file_name', sa.Text, nullable=False),
+                                         sa.Column('delete_local_file', sa.Boolean, nullable=False),
+                                         sa.Column('compression', sa.Text, nullable=True),
+                                         sa.Column('status', sa.Text, nullable=False),
+                                         sa.Column('errors', JSONB, nullable=True),
+                                         sa.Column('created_at', sa.DateTime(timezone=False), nullable=False),
+                                         sa.Column('started_at', sa.DateTime(timezone=False), nullable=True),
+                                         sa.Column('ended_at', sa.DateTime(timezone=False), nullable=True),
+                                         sa.Index('ingest_job_collection_id_idx', 'collection_id'),
+                                         sa.Index('ingest_job_queued_idx', 'id',
+                                                  postgresql_where=sa.text("status = 'queued'")),
+                                         )
+
+        # See CollectionDeleter.
+        self.collection_delete_progress_table = sa.Table(
+            'collection_delete_progress',
+            self.metadata,
+            sa.Column('collection_id', sa.Integer,
+                      sa.ForeignKey("collection.id", name="fk_collection_delete_progress_collection_id"),
+                      nullable=False, primary_key=True),
+            sa.Column('table_name', sa.Text, nullable=False, primary_key=True),
+            sa.Column('last_id', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('rows_deleted', sa.BigInteger, nullable=False, server_default='0'),
+            sa.Column('done', sa.Boolean, nullable=False, server_default='false'),
+            sa.Column('started_at', sa.DateTime(timezone=False), nullable=False),
+            sa.Column('updated_at', sa.DateTime(timezone=False), nullable=False),
+        )
+
+        # See update_collection_cached_columns.
+        self.collection_count_delta_table = sa.Table(
+            'collection_count_delta',
+            self.metadata,
+            sa.Column('id', sa.BigInteger, primary_key=True),
+            sa.Column('collection_id', sa.Integer,
+                      sa.ForeignKey("collection.id", name="fk_collection_count_delta_collection_id"),
+                      nullable=False),
+            sa.Column('releases', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('records', sa.Integer, nullable=False, server_default='0'),
+            sa.Column('compiled_releases', sa.Integer, nullable=False, server_default='0'),
+            sa.Index('collection_count_delta_collection_id_idx', 'collection_id'),
+        )
+
+        # See delete_orphan_data.
+        self.orphan_candidate_table = sa.Table('orphan_candidate', self.metadata,
+                                               sa.Column('table_name', sa.Text, nullable=False, primary_key=True),
+                                               sa.Column('id', sa.Integer, nullable=False, primary_key=True),
+                                               )
+
     def get_engine(self):
         # We only create a connection if actually needed; sometimes people do operations that don't need a database
         # and in that case no need to connect.
         # But this side of kingfisher now always requires a DB, so there should not be a problem opening a connection!
+        #
+        # The engine and its pool are shared by all threads (like those of transform-collections, or of the web app),
+        # so the pool should allow a connection per thread. See the Database pool section of the config docs.
         if not self._engine:
-            self._engine = sa.create_engine(
-                self.config.database_uri,
-                json_serializer=SetEncoder().encode,
-                json_deserializer=partial(
-                    json.loads,
-                    object_pairs_hook=collections.OrderedDict),
-            )
+            with self._engine_lock:
+                if not self._engine:
+                    self._engine = self._create_engine()
         return self._engine
 
+    def _create_engine(self):
+        codec = get_codec(self.config.json_codec)
+        kwargs = {
+            'json_serializer': codec.dumps,
+            'json_deserializer': codec.loads,
+            'pool_pre_ping': self.config.database_pool_pre_ping,
+        }
+        if self.config.database_pgbouncer:
+            # PgBouncer pools the connections. psycopg2 doesn't use server-side prepared statements, so the only
+            # session state to avoid is holding connections between transactions.
+            kwargs['poolclass'] = sa.pool.NullPool
+        else:
+            kwargs.update({
+                'poolclass': TimedQueuePool,
+                'pool_size': self.config.database_pool_size,
+                'max_overflow': self.config.database_pool_max_overflow,
+                'pool_timeout': self.config.database_pool_timeout,
+                'pool_recycle': self.config.database_pool_recycle,
+            })
+        return sa.create_engine(self.config.database_uri, **kwargs)
+
+    def get_pool_status(self):
+        # Returns None if there is no pool, or if no connection has been made.
+        if not self._engine or not isinstance(self._engine.pool, sa.pool.QueuePool):
+            return None
+        pool = self._engine.pool
+        size = pool.size()
+        max_overflow = self.config.database_pool_max_overflow
+        checked_out = pool.checkedout()
+        capacity = size + max_overflow if max_overflow >= 0 else 0
+        return {
+            'size': size,
+            'checked_out': checked_out,
+            'overflow': max(pool.overflow(), 0),
+            'saturation': checked_out / capacity if capacity else 0,
+        }
+
     def delete_tables(self):
+        self.collection_file_ids.clear()
+        self.package_data_ids.clear()
+        self.data_ids.clear()
+        self.data_hash_filter = None
+        self.data_hash_filter_source_ids.clear()
+        self.data_hash_filter_collection_ids.clear()
         engine = self.get_engine()
         engine.execute("drop table if exists transform_upgrade_1_0_to_1_1_status_record cascade")
         engine.execute("drop table if exists transform_upgrade_1_0_to_1_1_status_release cascade")
@@ -313,6 +485,10 @@ class DataBase:
         engine.execute("drop table if exists collection_file cascade")
         engine.execute("drop table if exists source_session_file_status cascade")  # This is the old table name
         engine.execute("drop table if exists collection_note cascade")
+        engine.execute("drop table if exists ingest_job cascade")
+        engine.execute("drop table if exists collection_delete_progress cascade")
+        engine.execute("drop table if exists orphan_candidate cascade")
+        engine.execute("drop table if exists collection_count_delta cascade")
         engine.execute("drop table if exists collection cascade")
         engine.execute("drop table if exists source_session cascade")  # This is the old table name
         engine.execute("drop table if exists alembic_version cascade")
@@ -353,6 +529,9 @@ class DataBase:
             transform_from_collection_id=transform_from_collection_id,
             transform_type=transform_type)
         if collection_id:
+            # The partitions may not have been created, if the process that created the collection failed to.
+            if collection_id not in self.collection_ids_with_partitions:
+                self.create_collection_partitions(collection_id)
             return collection_id
 
         with self.get_engine().begin() as connection:
@@ -365,15 +544,64 @@ class DataBase:
                 'store_start_at': datetime.datetime.utcnow(),
                 'check_data': False,
                 'check_older_data_with_schema_version_1_1': False,
+                'cached_releases_count': 0,
+                'cached_records_count': 0,
+                'cached_compiled_releases_count': 0,
             })
             collection_id = value.inserted_primary_key[0]
 
+        self.create_collection_partitions(collection_id)
+
         KINGFISHER_SIGNALS.signal('new_collection_created').send('anonymous', collection_id=collection_id)
         return collection_id
 
+    def create_collection_partitions(self, collection_id):
+        """Creates the collection's partitions that don't exist yet."""
+        existing = set(name for table, name in self.get_collection_partitions(collection_id))
+        for table, constraints in PARTITIONED_TABLES.items():
+            name = '{}_collection_{}'.format(table, int(collection_id))
+            if name not in existing:
+                self._create_collection_partition(collection_id, table, name, constraints)
+        self.collection_ids_with_partitions.add(collection_id)
+
+    def _create_collection_partition(self, collection_id, table, name, constraints):
+        # Creating a partition locks its partitioned table until the transaction ends, and while it waits for the lock,
+        # other queries on the table wait behind it. So, each partition is created in its own transaction, which gives
+        # up if it doesn't get the lock quickly, and is tried again later.
+        sql = "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} ({}) FOR VALUES IN ({})".format(
+            name, table, ', '.join(constraints), int(collection_id))
+        for attempt in range(1, self.PARTITION_LOCK_ATTEMPTS + 1):
+            try:
+                with self.get_engine().begin() as connection:
+                    connection.execute("SELECT set_config('lock_timeout', %s, true)", (self.PARTITION_LOCK_TIMEOUT,))
+                    connection.execute(sql)
+                return
+            except sa.exc.DBAPIError as e:
+                pgcode = getattr(e.orig, 'pgcode', None)
+                # If rows of the collection were stored before the partition was created, they are in the default
+                # partition, and stay there.
+                if pgcode == CHECK_VIOLATION:
+                    logging.getLogger('ocdskingfisher.database').warning(
+                        "Collection {} has rows in {}_default, so its partition can't be created".format(
+                            collection_id, table))
+                    return
+                if pgcode != LOCK_NOT_AVAILABLE or attempt == self.PARTITION_LOCK_ATTEMPTS:
+                    raise
+                time.sleep(attempt)
+
+    def get_collection_partitions(self, collection_id):
+        """Returns the tables and names of the collection's partitions that exist, in the order in which they can be
+        dropped."""
+        with self.get_engine().begin() as connection:
+            partitions = [(table, '{}_collection_{}'.format(table, int(collection_id)))
+                          for table in reversed(PARTITIONED_TABLES)]
+            return [(table, name) for table, name in partitions
+                    if connection.execute("SELECT to_regclass(%s)", (name,)).scalar() is not None]
+
     def get_all_collections(self):
         out = []
         with self.get_engine().begin() as connection:
+            deltas = self.get_collection_count_deltas(connection)
             s = sa.sql.select([self.collection_table]).order_by(self.collection_table.c.id.asc())
             for collection in connection.execute(s):
                 out.append(CollectionModel(
@@ -388,12 +616,14 @@ class DataBase:
                     store_start_at=collection['store_start_at'],
                     store_end_at=collection['store_end_at'],
                     deleted_at=collection['deleted_at'],
+                    **self._get_collection_counts(collection, deltas)
                 ))
         return out
 
     def get_collections_that_transform_this_collection(self, collection_id):
         out = []
         with self.get_engine().begin() as connection:
+            deltas = self.get_collection_count_deltas(connection)
             s = sa.sql.select([self.collection_table]) \
                 .where(self.collection_table.c.transform_from_collection_id == collection_id)
 
@@ -410,11 +640,27 @@ class DataBase:
                     store_start_at=collection['store_start_at'],
                     store_end_at=collection['store_end_at'],
                     deleted_at=collection['deleted_at'],
+                    **self._get_collection_counts(collection, deltas)
                 ))
         return out
 
+    def _get_collection_counts(self, collection, deltas):
+        # The cached columns, plus the counts that haven't been added to them yet.
+        delta = deltas.get(collection['id'])
+        out = {}
+        for key, column, delta_column in (('releases_count', 'cached_releases_count', 'releases'),
+                                          ('records_count', 'cached_records_count', 'records'),
+                                          ('compiled_releases_count', 'cached_compiled_releases_count',
+                                           'compiled_releases')):
+            value = collection[column]
+            if value is not None and delta:
+                value += delta[delta_column]
+            out[key] = value
+        return out
+
     def get_collection(self, collection_id):
         with self.get_engine().begin() as connection:
+            deltas = self.get_collection_count_deltas(connection, collection_id)
             s = sa.sql.select([self.collection_table]) \
                 .where(self.collection_table.c.id == collection_id)
             result = connection.execute(s)
@@ -432,6 +678,7 @@ class DataBase:
                     store_start_at=collection['store_start_at'],
                     store_end_at=collection['store_end_at'],
                     deleted_at=collection['deleted_at'],
+                    **self._get_collection_counts(collection, deltas)
                 )
 
     def get_all_notes_in_collection(self, collection_id):
@@ -479,11 +726,14 @@ class DataBase:
                 ))
         return out
 
-    def is_release_check_done(self, release_id, override_schema_version=''):
+    def is_release_check_done(self, release_id, override_schema_version='', collection_id=None):
         with self.get_engine().begin() as connection:
             s = sa.sql.select([self.release_check_table]) \
                 .where((self.release_check_table.c.release_id == release_id) &
                        (self.release_check_table.c.override_schema_version == override_schema_version))
+            if collection_id:
+                # So that only the collection's partition (and the default partition) is looked in.
+                s = s.where(self._in_collection_partition(self.release_check_table, collection_id))
             result = connection.execute(s)
             if result.fetchone():
                 return True
@@ -491,17 +741,22 @@ class DataBase:
             s = sa.sql.select([self.release_check_error_table]) \
                 .where((self.release_check_error_table.c.release_id == release_id) &
                        (self.release_check_error_table.c.override_schema_version == override_schema_version))
+            if collection_id:
+                s = s.where(self._in_collection_partition(self.release_check_error_table, collection_id))
             result = connection.execute(s)
             if result.fetchone():
                 return True
 
         return False
 
-    def is_record_check_done(self, record_id, override_schema_version=''):
+    def is_record_check_done(self, record_id, override_schema_version='', collection_id=None):
         with self.get_engine().begin() as connection:
             s = sa.sql.select([self.record_check_table]) \
                 .where((self.record_check_table.c.record_id == record_id) &
                        (self.record_check_table.c.override_schema_version == override_schema_version))
+            if collection_id:
+                # So that only the collection's partition (and the default partition) is looked in.
+                s = s.where(self._in_collection_partition(self.record_check_table, collection_id))
             result = connection.execute(s)
             if result.fetchone():
                 return True
@@ -509,12 +764,18 @@ class DataBase:
             s = sa.sql.select([self.record_check_error_table]) \
                 .where((self.record_check_error_table.c.record_id == record_id) &
                        (self.record_check_error_table.c.override_schema_version == override_schema_version))
+            if collection_id:
+                s = s.where(self._in_collection_partition(self.record_check_error_table, collection_id))
             result = connection.execute(s)
             if result.fetchone():
                 return True
 
         return False
 
+    def _in_collection_partition(self, table, collection_id):
+        # Check rows from before the tables were partitioned have no collection_id.
+        return (table.c.collection_id == collection_id) | (table.c.collection_id.is_(None))
+
     def mark_collection_file_store_done(self, collection_id, filename, warnings=None):
         with self.get_engine().begin() as connection:
             connection.execute(
@@ -522,6 +783,7 @@ class DataBase:
                     .where((self.collection_file_table.c.collection_id == collection_id) &
                            (self.collection_file_table.c.filename == filename))
                     .values(warnings=warnings if warnings and len(warnings) > 0 else None,
+                            store_end_at=datetime.datetime.utcnow(),
                             )
             )
 
@@ -562,6 +824,17 @@ class DataBase:
             collection_file_table_row = result.fetchone()
 
             if collection_file_table_row:
+                # The row may have been created in advance by create_collection_files; if nothing was stored for it,
+                # record the errors.
+                s = sa.sql.select([self.collection_file_item_table.c.id]) \
+                    .where(self.collection_file_item_table.c.collection_file_id == collection_file_table_row['id']) \
+                    .limit(1)
+                if not connection.execute(s).fetchone():
+                    connection.execute(
+                        self.collection_file_table.update()
+                            .where(self.collection_file_table.c.id == collection_file_table_row['id'])
+                            .values(errors=errors)
+                    )
                 return
 
             connection.execute(self.collection_file_table.insert(), {
@@ -571,6 +844,338 @@ class DataBase:
                 'errors': errors,
             })
 
+    def get_ids_for_documents(self, table, documents, connection=None):
+        """Returns the IDs of a list of documents in the data or package_data table, in the same order. Documents that
+        are not already stored are inserted."""
+        hashes_md5 = []
+        json_by_hash = {}
+        for document in documents:
+            document_str, hash_md5 = get_json_and_hash_md5_for_data(document)
+            hashes_md5.append(hash_md5)
+            json_by_hash[hash_md5] = document_str
+        ids = self.get_ids_for_hashes(table, json_by_hash, connection)
+        return [ids[hash_md5] for hash_md5 in hashes_md5]
+
+    def get_ids_for_hashes(self, table, json_by_hash, connection=None, data_hash_filter=None):
+        """Takes a dict of hash_md5 to JSON string for the data or package_data table, and returns a dict of hash_md5
+        to id. Documents that are not already stored are inserted, with the JSON string (so it isn't serialized again).
+
+        If a data hash filter is passed (see get_data_hash_filter), documents that it says are definitely new aren't
+        looked up before being inserted.
+
+        This takes a few queries, however many documents there are. It is safe to run at the same time as other
+        inserts."""
+        if connection is None:
+            with self.get_engine().begin() as connection:
+                return self.get_ids_for_hashes(table, json_by_hash, connection, data_hash_filter)
+
+        if not json_by_hash:
+            return {}
+
+        select = sa.sql.expression.text(
+            "SELECT id, hash_md5 FROM " + table.name + " WHERE hash_md5 = ANY(CAST(:hashes_md5 AS text[]))")
+        # Inserting in order of hash_md5 stops concurrent inserters deadlocking on each other's new rows.
+        insert = sa.sql.expression.text(
+            "INSERT INTO " + table.name + " (hash_md5, data) "
+            "SELECT * FROM unnest(CAST(:hashes_md5 AS text[]), CAST(:data AS jsonb[])) ORDER BY 1 "
+            "ON CONFLICT (hash_md5) DO NOTHING "
+            "RETURNING id, hash_md5")
+
+        if data_hash_filter is None:
+            maybe = list(json_by_hash.keys())
+        else:
+            maybe = [hash_md5 for hash_md5 in json_by_hash if hash_md5 in data_hash_filter]
+
+        ids = {}
+        if maybe:
+            for row in connection.execute(select, {'hashes_md5': maybe}):
+                ids[row.hash_md5] = row.id
+
+        found = len(ids)
+
+        missing = sorted(hash_md5 for hash_md5 in json_by_hash if hash_md5 not in ids)
+        conflicts = 0
+        if missing:
+            result = connection.execute(insert, {'hashes_md5': missing,
+                                                 'data': [json_by_hash[hash_md5] for hash_md5 in missing]})
+            for row in result:
+                ids[row.hash_md5] = row.id
+
+            # Rows that were inserted by another transaction after the select. ON CONFLICT waits for that transaction
+            # to commit, so this select can see them.
+            missing = [hash_md5 for hash_md5 in missing if hash_md5 not in ids]
+            if missing:
+                conflicts = len(missing)
+                for row in connection.execute(select, {'hashes_md5': missing}):
+                    ids[row.hash_md5] = row.id
+
+        if data_hash_filter is not None:
+            for hash_md5 in json_by_hash:
+                data_hash_filter.add(hash_md5)
+            # Conflicts also include documents that the filter said might be stored, which were inserted by another
+            # transaction after the first select. These are rare.
+            self._count_data_hash_filter_results(lookups_saved=len(json_by_hash) - len(maybe), maybe=len(maybe),
+                                                 false_positives=len(maybe) - found, conflicts=conflicts)
+
+        return ids
+
+    def get_data_hash_filter(self, collection_id):
+        """If a data hash filter is enabled in config, returns a Bloom filter of data hashes, to which the hashes of
+        the data of the collection's source (or of all data) have been added. Otherwise, returns None.
+
+        The filter is only added to, so it can say that data might be stored when it has since been deleted. It might
+        also say that data is new when it was stored by another source or process; the data is then looked up after
+        failing to insert it."""
+        mode = self.config.store_data_hash_filter
+        if not mode:
+            return None
+        if mode not in ('source', 'global'):
+            raise Exception("Data hash filter must be source or global, not {}".format(mode))
+
+        with self._data_hash_filter_lock:
+            if self.data_hash_filter is None:
+                snapshot = self.config.store_data_hash_filter_snapshot
+                if mode == 'global' and snapshot and os.path.isfile(snapshot):
+                    self.data_hash_filter = BloomFilter.load(snapshot)
+                else:
+                    self.data_hash_filter = self._new_data_hash_filter(mode == 'global')
+                if mode == 'global':
+                    self._add_to_data_hash_filter(self.data_hash_filter, 'global')
+
+            if mode == 'source' and collection_id not in self.data_hash_filter_collection_ids:
+                source_id = self.get_collection(collection_id).source_id
+                if source_id not in self.data_hash_filter_source_ids:
+                    self._add_to_data_hash_filter(self.data_hash_filter, 'source', source_id)
+                    self.data_hash_filter_source_ids.add(source_id)
+                self.data_hash_filter_collection_ids.add(collection_id)
+
+        return self.data_hash_filter
+
+    def save_data_hash_filter(self, filename):
+        """Saves a data hash filter of all data to a file, for get_data_hash_filter to load in global mode."""
+        data_hash_filter = self._new_data_hash_filter(True)
+        self._add_to_data_hash_filter(data_hash_filter, 'global')
+        data_hash_filter.save(filename)
+        return data_hash_filter
+
+    def _new_data_hash_filter(self, for_all_data):
+        capacity = self.config.store_data_hash_filter_capacity
+        if for_all_data:
+            with self.get_engine().begin() as connection:
+                count = connection.execute(sa.sql.expression.text("SELECT count(*) FROM data")).scalar()
+            # Leave room for new data.
+            capacity = max(capacity, count * 2)
+        return BloomFilter(capacity, self.config.store_data_hash_filter_error_rate)
+
+    def _add_to_data_hash_filter(self, data_hash_filter, mode, source_id=None):
+        logger = logging.getLogger('ocdskingfisher.database.data-hash-filter')
+        if mode == 'global':
+            logger.info("Adding data with IDs over {} to data hash filter".format(data_hash_filter.max_data_id))
+            sql = "SELECT id, hash_md5 FROM data WHERE id > :max_data_id ORDER BY id"
+        else:
+            logger.info("Adding data of source {} to data hash filter".format(source_id))
+            sql = """SELECT id, hash_md5 FROM data WHERE id IN (
+                        SELECT data_id FROM release JOIN collection ON collection.id = release.collection_id
+                        WHERE collection.source_id = :source_id
+                        UNION
+                        SELECT data_id FROM record JOIN collection ON collection.id = record.collection_id
+                        WHERE collection.source_id = :source_id
+                        UNION
+                        SELECT data_id FROM compiled_release
+                        JOIN collection ON collection.id = compiled_release.collection_id
+                        WHERE collection.source_id = :source_id
+                    )"""
+
+        with self.get_engine().connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(
+                sa.sql.expression.text(sql), {'max_data_id': data_hash_filter.max_data_id, 'source_id': source_id})
+            for row in result:
+                data_hash_filter.add(row['hash_md5'])
+                if mode == 'global':
+                    data_hash_filter.max_data_id = row['id']
+
+    def _count_data_hash_filter_results(self, **counts):
+        with self._data_hash_filter_lock:
+            for key, value in counts.items():
+                self.data_hash_filter_stats[key] += value
+        prometheus.PROMETHEUS_DATA_HASH_FILTER_LOOKUPS_SAVED.inc(counts['lookups_saved'])
+        prometheus.PROMETHEUS_DATA_HASH_FILTER_MAYBE.inc(counts['maybe'])
+        prometheus.PROMETHEUS_DATA_HASH_FILTER_FALSE_POSITIVES.inc(counts['false_positives'])
+        prometheus.PROMETHEUS_DATA_HASH_FILTER_CONFLICTS.inc(counts['conflicts'])
+
+    def get_data_hash_filter_false_positive_rate(self):
+        """Returns the share of the looked up data that the data hash filter said might be stored but wasn't, out of
+        all the new data that it was asked about. Returns None if it wasn't asked about any new data."""
+        stats = self.data_hash_filter_stats
+        new = stats['false_positives'] + stats['lookups_saved'] - stats['conflicts']
+        if new > 0:
+            return stats['false_positives'] / new
+
+    def _get_local_id_cache(self, table):
+        if table.name == 'data':
+            return self.data_ids
+        return self.package_data_ids
+
+    def get_cached_ids(self, table, hashes_md5):
+        """Returns a dict of hash_md5 to id, for the hashes in the data or package_data table that are in the local
+        cache, or else in the Redis cache if it is enabled."""
+        local_id_cache = self._get_local_id_cache(table)
+        ids = {}
+        missing = []
+        for hash_md5 in hashes_md5:
+            id = local_id_cache.get(hash_md5)
+            if id:
+                ids[hash_md5] = id
+            else:
+                missing.append(hash_md5)
+
+        if self.id_cache and missing:
+            found = self.id_cache.get_many(table.name, missing)
+            for hash_md5, id in found.items():
+                local_id_cache.set(hash_md5, id)
+            ids.update(found)
+
+        return ids
+
+    def cache_ids(self, table, ids):
+        """Adds a dict of hash_md5 to id of committed rows in the data or package_data table to the caches."""
+        local_id_cache = self._get_local_id_cache(table)
+        for hash_md5, id in ids.items():
+            local_id_cache.set(hash_md5, id)
+        if self.id_cache:
+            self.id_cache.set_many(table.name, ids)
+
+    def uncache_ids(self, table, hashes_md5):
+        """Removes hashes in the data or package_data table from the Redis cache, if it is enabled. Call it after the
+        transaction that deleted their rows commits, so that no other process caches them again in the meantime."""
+        if self.id_cache:
+            self.id_cache.delete_many(table.name, list(hashes_md5))
+
+    def check_id_cache_generation(self):
+        """If the Redis cache is enabled, clears the local caches of data and package_data IDs if any process has
+        deleted orphan data since the last check."""
+        if not self.id_cache:
+            return
+        generation = self.id_cache.get_generation()
+        if generation != self.id_cache_generation:
+            self.data_ids.clear()
+            self.package_data_ids.clear()
+            self.id_cache_generation = generation
+
+    def get_stored_item_numbers(self, collection_id, filenames=None):
+        """Returns a dict of filename to the set of item numbers already stored, for every file in a collection, or
+        only for these filenames."""
+        out = {}
+        with self.get_engine().begin() as connection:
+            s = sa.sql.select([self.collection_file_table.c.filename, self.collection_file_item_table.c.number]) \
+                .select_from(self.collection_file_table.outerjoin(self.collection_file_item_table)) \
+                .where(self.collection_file_table.c.collection_id == collection_id)
+            if filenames is not None:
+                s = s.where(self.collection_file_table.c.filename.in_(list(filenames)))
+            for row in connection.execute(s):
+                numbers = out.setdefault(row['filename'], set())
+                if row['number'] is not None:
+                    numbers.add(row['number'])
+        return out
+
+    def get_stored_filenames(self, collection_id):
+        """Returns the set of filenames of files in a collection that have been completely stored. See
+        mark_collection_file_store_done."""
+        with self.get_engine().begin() as connection:
+            s = sa.sql.select([self.collection_file_table.c.filename]) \
+                .where((self.collection_file_table.c.collection_id == collection_id) &
+                       (self.collection_file_table.c.store_end_at != None)) # noqa
+            return set(row['filename'] for row in connection.execute(s))
+
+    def create_collection_files(self, collection_id, files):
+        """Creates collection_file rows for a list of (filename, url) tuples, in order, if they don't already exist.
+
+        This is so IDs are the same every time, even if the files are stored in a different order."""
+        if not files:
+            return
+        with self.get_engine().begin() as connection:
+            connection.execute(sa.sql.expression.text("""
+                INSERT INTO collection_file (collection_id, filename, url) VALUES (:collection_id, :filename, :url)
+                ON CONFLICT (collection_id, filename) DO NOTHING
+            """), [{'collection_id': collection_id, 'filename': filename, 'url': url} for filename, url in files])
+
+    def create_ingest_job(self, collection_id, filename, url, data_type, encoding, local_file_name,
+                          delete_local_file, compression=None):
+        """Queues a file to be stored by the process-ingest-jobs command, and returns the job's ID.
+
+        If delete_local_file is true, the local file is deleted once it is stored. If compression is None, the
+        file's compression is detected when it is stored."""
+        with self.get_engine().begin() as connection:
+            value = connection.execute(self.ingest_job_table.insert(), {
+                'collection_id': collection_id,
+                'filename': filename,
+                'url': url,
+                'data_type': data_type,
+                'encoding': encoding,
+                'local_file_name': local_file_name,
+                'delete_local_file': delete_local_file,
+                'compression': compression,
+                'status': 'queued',
+                'created_at': datetime.datetime.utcnow(),
+            })
+            return value.inserted_primary_key[0]
+
+    def claim_ingest_job(self):
+        """Marks the oldest queued ingest job as running, and returns its row, or None if there are none.
+
+        Workers skip jobs that other workers are claiming, so they can run at the same time."""
+        with self.get_engine().begin() as connection:
+            result = connection.execute(sa.sql.expression.text("""
+                UPDATE ingest_job SET status = 'running', started_at = :started_at
+                WHERE id = (
+                    SELECT id FROM ingest_job WHERE status = 'queued' ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED
+                )
+                RETURNING *
+            """), {'started_at': datetime.datetime.utcnow()})
+            return result.fetchone()
+
+    def mark_ingest_job_done(self, ingest_job_id, errors=None):
+        with self.get_engine().begin() as connection:
+            connection.execute(
+                self.ingest_job_table.update().where(self.ingest_job_table.c.id == ingest_job_id),
+                {'status': 'failed' if errors else 'done', 'errors': errors or None,
+                 'ended_at': datetime.datetime.utcnow()}
+            )
+
+    def get_ingest_job(self, ingest_job_id):
+        """Returns an ingest job, with the number of items of its file that have been stored so far, or None."""
+        with self.get_engine().begin() as connection:
+            ingest_job = connection.execute(
+                sa.sql.select([self.ingest_job_table]).where(self.ingest_job_table.c.id == ingest_job_id)
+            ).fetchone()
+            if not ingest_job:
+                return None
+
+            collection_file = connection.execute(sa.sql.expression.text("""
+                SELECT collection_file.errors, count(collection_file_item.id) AS items_stored,
+                    count(collection_file_item.errors) AS items_with_errors
+                FROM collection_file
+                LEFT JOIN collection_file_item ON collection_file_item.collection_file_id = collection_file.id
+                WHERE collection_file.collection_id = :collection_id AND collection_file.filename = :filename
+                GROUP BY collection_file.id
+            """), {'collection_id': ingest_job['collection_id'], 'filename': ingest_job['filename']}).fetchone()
+
+            return IngestJobModel(
+                database_id=ingest_job['id'],
+                collection_id=ingest_job['collection_id'],
+                filename=ingest_job['filename'],
+                url=ingest_job['url'],
+                data_type=ingest_job['data_type'],
+                status=ingest_job['status'],
+                errors=ingest_job['errors'],
+                created_at=ingest_job['created_at'],
+                started_at=ingest_job['started_at'],
+                ended_at=ingest_job['ended_at'],
+                items_stored=collection_file['items_stored'] if collection_file else 0,
+                items_with_errors=collection_file['items_with_errors'] if collection_file else 0,
+                file_errors=collection_file['errors'] if collection_file else None,
+            )
+
     def store_collection_file_item_errors(self, collection_id, file_name, number, url, errors):
         with self.get_engine().begin() as connection:
 
@@ -634,106 +1239,68 @@ class DataBase:
             )
 
     def delete_collection(self, collection_id):
-        self._delete_collection_run_sql("release_check_error", """DELETE FROM release_check_error
-                WHERE release_id IN
-                    (
-                        SELECT id FROM release
-                        WHERE collection_id = :collection_id
-                    );""", collection_id)
-        self._delete_collection_run_sql("record_check_error", """DELETE FROM record_check_error
-                        WHERE record_id IN
-                            (
-                                SELECT id FROM record
-                                WHERE collection_id = :collection_id
-                            );""", collection_id)
-        self._delete_collection_run_sql("record_check", """DELETE FROM record_check
-                WHERE record_id IN
-                    (
-                        SELECT id FROM record
-                        WHERE collection_id = :collection_id
-                    );""", collection_id)
-        self._delete_collection_run_sql("release_check", """DELETE FROM release_check
-                WHERE release_id IN
-                    (
-                        SELECT id FROM release
-                        WHERE collection_id = :collection_id
-                    );""", collection_id)
-        self._delete_collection_run_sql("compiled_release", """DELETE FROM compiled_release
-                WHERE id IN
-                    (
-                        SELECT id FROM compiled_release
-                        WHERE collection_id = :collection_id
-                    );""", collection_id)
-        self._delete_collection_run_sql("transform_upgrade_1_0_to_1_1_status_record", """DELETE FROM transform_upgrade_1_0_to_1_1_status_record
-                WHERE source_record_id IN
-                    (
-                        SELECT id FROM record
-                        WHERE collection_id = :collection_id
-                    );""", collection_id)
-        self._delete_collection_run_sql("record", """DELETE FROM record
-                WHERE id IN
-                    (
-                        SELECT id FROM record
-                        WHERE collection_id = :collection_id
-                    );""", collection_id)
-        self._delete_collection_run_sql("transform_upgrade_1_0_to_1_1_status_release", """DELETE FROM transform_upgrade_1_0_to_1_1_status_release
-                WHERE source_release_id IN
-                    (
-                        SELECT id FROM release
-                        WHERE collection_id = :collection_id
-                    );""", collection_id)
-        self._delete_collection_run_sql("release", """DELETE FROM release
-                WHERE id IN
-                    (
-                        SELECT id FROM release
-                        WHERE collection_id = :collection_id
-                    );""", collection_id)
-        self._delete_collection_run_sql_in_blocks(
-            "collection_file_item",
-            """SELECT collection_file_item.id FROM collection_file_item
-            JOIN collection_file ON collection_file_item.collection_file_id = collection_file.id
-            WHERE collection_file.collection_id = :collection_id LIMIT 10000""",
-            collection_id,
-            "collection_file_item"
-        )
-        self._delete_collection_run_sql("collection_file", """DELETE FROM collection_file
-                WHERE collection_id = :collection_id;""", collection_id)
-        self._delete_collection_run_sql("collection_note", """DELETE FROM collection_note
-                WHERE collection_id = :collection_id;""", collection_id)
-        self._delete_collection_run_sql("collection", """UPDATE collection SET transform_from_collection_id = NULL
-                 WHERE transform_from_collection_id = :collection_id;""", collection_id)
-        self._delete_collection_run_sql("collection", """DELETE FROM collection
-                WHERE id = :collection_id;""", collection_id)
-
-    def _delete_collection_run_sql(self, label, sql, collection_id):
-        logger = logging.getLogger('ocdskingfisher.database.delete-collection')
-        logger.debug("Deleting " + label + " for collection " + str(collection_id))
-        data = {'collection_id': collection_id}
-        # We execute every SQL statement in it's own transaction, to try and keep the size of the transactions small
-        # It doesn't matter if we re-do a delete, so it doesn't matter if there is a problem half way through!
-        with self.get_engine().begin() as connection:
-            connection.execute(sa.sql.expression.text(sql), data)
+        self.collection_file_ids.remove_keys(lambda key: key[0] == collection_id)
+        CollectionDeleter(self, collection_id).run()
 
-    def _delete_collection_run_sql_in_blocks(self, label, select_sql, collection_id, delete_from_table):
+    def get_collection_delete_progress(self):
+        """Returns the number of collections being deleted, the number of rows deleted from them so far, and the
+        rate at which they were deleted, in rows per second."""
+        with self.get_engine().begin() as connection:
+            return connection.execute("""SELECT
+                    count(DISTINCT collection_id) AS collections,
+                    coalesce(sum(rows_deleted), 0) AS rows_deleted,
+                    coalesce(sum(rows_deleted) / nullif(extract(epoch FROM max(updated_at) - min(started_at)), 0), 0)
+                        AS rows_per_second
+                FROM collection_delete_progress""").fetchone()
+
+    def delete_orphan_data(self, all_data=False):
+        """Deletes the data and package data that are no longer used by any release, record or compiled release.
+
+        Only the candidates that were used by deleted rows are checked (see CollectionDeleter), unless all_data is set,
+        in which case all data and package data are checked, which takes much longer on a large database."""
+        self.package_data_ids.clear()
+        self.data_ids.clear()
+        self._delete_orphan_candidates(self.data_table, """DELETE FROM data
+                WHERE id = ANY(:ids)
+                AND NOT EXISTS (SELECT 1 FROM release WHERE release.data_id = data.id)
+                AND NOT EXISTS (SELECT 1 FROM record WHERE record.data_id = data.id)
+                AND NOT EXISTS (SELECT 1 FROM compiled_release WHERE compiled_release.data_id = data.id)""")
+        self._delete_orphan_candidates(self.package_data_table, """DELETE FROM package_data
+                WHERE id = ANY(:ids)
+                AND NOT EXISTS (SELECT 1 FROM release WHERE release.package_data_id = package_data.id)
+                AND NOT EXISTS (SELECT 1 FROM record WHERE record.package_data_id = package_data.id)""")
+        if all_data:
+            self._delete_orphan_data_data()
+            self._delete_orphan_data_package_data()
+        # Other processes clear their local caches. Their own deleted rows were removed from the Redis cache.
+        if self.id_cache:
+            self.id_cache.increment_generation()
+
+    def _delete_orphan_candidates(self, table, sql):
+        table_name = table.name
+        sql_get = """SELECT id FROM orphan_candidate WHERE table_name = :table_name ORDER BY id LIMIT 10000"""
         logger = logging.getLogger('ocdskingfisher.database.delete-collection')
-        logger.debug("Deleting " + label + " for collection " + str(collection_id))
-        data_get = {'collection_id': collection_id}
+        logger.debug("Deleting " + table_name + " orphan candidates")
+        deleted = 0
         while True:
+            hashes_md5 = []
             with self.get_engine().begin() as connection:
-                ids_to_delete = []
-                for row in connection.execute(sa.sql.expression.text(select_sql), data_get):
-                    ids_to_delete.append(str(row['id']))
-                if len(ids_to_delete) == 0:
-                    return
-                connection.execute(
-                    sa.sql.expression.text(
-                        "DELETE FROM " + delete_from_table + " WHERE id IN (" + ",".join(ids_to_delete) + ")"),
-                    {}
-                )
-
-    def delete_orphan_data(self):
-        self._delete_orphan_data_data()
-        self._delete_orphan_data_package_data()
+                ids = [row['id'] for row in
+                       connection.execute(sa.sql.expression.text(sql_get), {'table_name': table_name})]
+                if not ids:
+                    break
+                # A candidate that is still used is removed, too. It is a candidate again when its users are deleted.
+                if self.id_cache:
+                    result = connection.execute(sa.sql.expression.text(sql + " RETURNING hash_md5"), {'ids': ids})
+                    hashes_md5 = [row['hash_md5'] for row in result]
+                    deleted += len(hashes_md5)
+                else:
+                    deleted += connection.execute(sa.sql.expression.text(sql), {'ids': ids}).rowcount
+                connection.execute(sa.sql.expression.text(
+                    "DELETE FROM orphan_candidate WHERE table_name = :table_name AND id = ANY(:ids)"),
+                    {'table_name': table_name, 'ids': ids})
+            self.uncache_ids(table, hashes_md5)
+        logger.info("Deleted " + str(deleted) + " orphan " + table_name)
 
     def _delete_orphan_data_data(self):
         data_get = {}
@@ -746,16 +1313,20 @@ class DataBase:
         logger = logging.getLogger('ocdskingfisher.database.delete-collection')
         logger.debug("Deleting data")
         while True:
+            hashes_md5 = []
             with self.get_engine().begin() as connection:
                 ids_to_delete = []
                 for row in connection.execute(sa.sql.expression.text(sql_get), data_get):
                     ids_to_delete.append(str(row['id']))
                 if len(ids_to_delete) == 0:
                     return
-                connection.execute(
-                    sa.sql.expression.text("DELETE FROM data WHERE id IN (" + ",".join(ids_to_delete) + ")"),
-                    {}
-                )
+                sql = "DELETE FROM data WHERE id IN (" + ",".join(ids_to_delete) + ")"
+                if self.id_cache:
+                    result = connection.execute(sa.sql.expression.text(sql + " RETURNING hash_md5"), {})
+                    hashes_md5 = [row['hash_md5'] for row in result]
+                else:
+                    connection.execute(sa.sql.expression.text(sql), {})
+            self.uncache_ids(self.data_table, hashes_md5)
 
     def _delete_orphan_data_package_data(self):
         data = {}
@@ -764,11 +1335,18 @@ class DataBase:
                     (
                         SELECT package_data_id FROM release union
                         SELECT package_data_id FROM record
-                    );"""
+                    )"""
         logger = logging.getLogger('ocdskingfisher.database.delete-collection')
         logger.debug("Deleting package_data")
+        hashes_md5 = []
         with self.get_engine().begin() as connection:
-            connection.execute(sa.sql.expression.text(sql), data)
+            if self.id_cache:
+                result = connection.execute(sa.sql.expression.text(sql + " RETURNING hash_md5"), data)
+                hashes_md5 = [row['hash_md5'] for row in result]
+            else:
+                connection.execute(sa.sql.expression.text(sql), data)
+        for i in range(0, len(hashes_md5), 10000):
+            self.uncache_ids(self.package_data_table, hashes_md5[i:i + 10000])
 
     def _get_check_query(self, obj_type, collection_id, override_schema_version):
         data = {'collection_id': collection_id}
@@ -780,8 +1358,11 @@ class DataBase:
         if override_schema_version:
             sql += """ LEFT JOIN release_check ON release_check.release_id = release.id
                           AND release_check.override_schema_version = :override_schema_version
+                          AND (release_check.collection_id = :collection_id OR release_check.collection_id IS NULL)
                        LEFT JOIN release_check_error ON release_check_error.release_id = release_check_error.id
                           AND release_check_error.override_schema_version = :override_schema_version
+                          AND (release_check_error.collection_id = :collection_id
+                               OR release_check_error.collection_id IS NULL)
                        LEFT JOIN package_data on package_data.id = package_data_id
                        WHERE release.collection_id = :collection_id
                        AND release_check.id IS NULL AND release_check_error.id IS NULL
@@ -790,8 +1371,11 @@ class DataBase:
         else:
             sql += """ LEFT JOIN release_check ON release_check.release_id = release.id
                           AND release_check.override_schema_version IS NULL
+                          AND (release_check.collection_id = :collection_id OR release_check.collection_id IS NULL)
                        LEFT JOIN release_check_error ON release_check_error.release_id = release_check_error.id
                           AND release_check_error.override_schema_version IS NULL
+                          AND (release_check_error.collection_id = :collection_id
+                               OR release_check_error.collection_id IS NULL)
                         WHERE release.collection_id = :collection_id
                         AND release_check.id IS NULL AND release_check_error.id IS NULL """
 
@@ -842,49 +1426,108 @@ class DataBase:
                     .values(check_older_data_with_schema_version_1_1=value)
             )
 
-    def update_collection_cached_columns(self, collection_id):
-        with self.get_engine().begin() as connection:
-            s = sa.sql.expression.text(
-                "SELECT count(*) as release_count FROM release WHERE collection_id = :collection_id")
-            result = connection.execute(s, {"collection_id": collection_id})
-            data = result.fetchone()
-
-            connection.execute(
-                self.collection_table.update()
-                    .where(self.collection_table.c.id == collection_id)
-                    .values(cached_releases_count=data['release_count'])
-            )
-
-        with self.get_engine().begin() as connection:
-            s = sa.sql.expression.text(
-                "SELECT count(*) as record_count FROM record WHERE collection_id = :collection_id")
-            result = connection.execute(s, {"collection_id": collection_id})
-            data = result.fetchone()
-
-            connection.execute(
-                self.collection_table.update()
-                    .where(self.collection_table.c.id == collection_id)
-                    .values(cached_records_count=data['record_count'])
-            )
+    def add_collection_count_delta(self, connection, collection_id, counts):
+        """Adds the numbers of releases, records and compiled releases stored in a transaction to the collection's
+        counts. Call it in the same transaction, then call collection_count_delta_committed once it commits. The counts
+        are added to the collection's cached columns by update_collection_cached_columns."""
+        if any(counts.values()):
+            connection.execute(self.collection_count_delta_table.insert(), {
+                'collection_id': collection_id,
+                'releases': counts.get('release', 0),
+                'records': counts.get('record', 0),
+                'compiled_releases': counts.get('compiled_release', 0),
+            })
 
+    def get_collection_count_deltas(self, connection, collection_id=None):
+        """Returns a dict of collection ID to the counts not yet added to the collection's cached columns."""
+        s = sa.sql.select([
+            self.collection_count_delta_table.c.collection_id,
+            sa.func.sum(self.collection_count_delta_table.c.releases).label('releases'),
+            sa.func.sum(self.collection_count_delta_table.c.records).label('records'),
+            sa.func.sum(self.collection_count_delta_table.c.compiled_releases).label('compiled_releases'),
+        ]).group_by(self.collection_count_delta_table.c.collection_id)
+        if collection_id:
+            s = s.where(self.collection_count_delta_table.c.collection_id == collection_id)
+        return {row['collection_id']: row for row in connection.execute(s)}
+
+    def collection_count_delta_committed(self, collection_id):
+        """Call it after a transaction that called add_collection_count_delta commits. Every
+        COLLECTION_COUNT_DELTA_FOLD_SIZE calls for a collection, its counts are added to its cached columns."""
+        self.collection_count_deltas_committed[collection_id] += 1
+        if self.collection_count_deltas_committed[collection_id] < self.COLLECTION_COUNT_DELTA_FOLD_SIZE:
+            return
+        del self.collection_count_deltas_committed[collection_id]
+
+        # The rows are already stored, so an error is logged, not raised. The counts are added by the next update.
+        try:
+            with self.get_engine().begin() as connection:
+                collection = self._lock_collection_for_cached_columns(connection, collection_id)
+                # If the collection's rows need counting, update_collection_cached_columns does it.
+                if collection and collection['cached_releases_count'] is not None \
+                        and collection['cached_records_count'] is not None \
+                        and collection['cached_compiled_releases_count'] is not None:
+                    self._fold_collection_count_deltas(connection, collection_id)
+        except Exception:
+            logging.getLogger('ocdskingfisher.database').exception(
+                "Error adding counts to the cached columns of collection {}".format(collection_id))
+
+    def update_collection_cached_columns(self, collection_id, recount=False):
+        """Adds the counts of rows stored since the last update to the collection's cached columns.
+
+        If recount is set, or if the collection's rows weren't counted as they were stored (if it was being stored
+        when counting was added), the rows are counted instead, which reads all the collection's rows."""
         with self.get_engine().begin() as connection:
-            s = sa.sql.expression.text(
-                "SELECT count(*) as compiled_release_count FROM compiled_release " +
-                "WHERE collection_id = :collection_id")
-            result = connection.execute(s, {"collection_id": collection_id})
-            data = result.fetchone()
+            collection = self._lock_collection_for_cached_columns(connection, collection_id)
+            if not collection:
+                return
 
-            connection.execute(
-                self.collection_table.update()
-                    .where(self.collection_table.c.id == collection_id)
-                    .values(cached_compiled_releases_count=data['compiled_release_count'])
+            data = {'collection_id': collection_id}
+            if recount or collection['cached_releases_count'] is None or collection['cached_records_count'] is None \
+                    or collection['cached_compiled_releases_count'] is None:
+                # Deltas that haven't been added yet are subtracted, so that adding them later gives the right counts.
+                connection.execute(sa.sql.expression.text("""
+                    UPDATE collection SET
+                        cached_releases_count = (SELECT count(*) FROM release WHERE collection_id = :collection_id)
+                            - (SELECT coalesce(sum(releases), 0) FROM collection_count_delta
+                               WHERE collection_id = :collection_id),
+                        cached_records_count = (SELECT count(*) FROM record WHERE collection_id = :collection_id)
+                            - (SELECT coalesce(sum(records), 0) FROM collection_count_delta
+                               WHERE collection_id = :collection_id),
+                        cached_compiled_releases_count = (SELECT count(*) FROM compiled_release
+                                                          WHERE collection_id = :collection_id)
+                            - (SELECT coalesce(sum(compiled_releases), 0) FROM collection_count_delta
+                               WHERE collection_id = :collection_id)
+                    WHERE id = :collection_id"""), data)
+
+            self._fold_collection_count_deltas(connection, collection_id)
+
+    def _lock_collection_for_cached_columns(self, connection, collection_id):
+        # Updates of the same collection wait for each other. Unlike FOR UPDATE, FOR NO KEY UPDATE doesn't block
+        # the foreign key checks of rows being stored in the collection.
+        s = sa.sql.select([self.collection_table]) \
+            .where(self.collection_table.c.id == collection_id) \
+            .with_for_update(key_share=True)
+        return connection.execute(s).fetchone()
+
+    def _fold_collection_count_deltas(self, connection, collection_id):
+        connection.execute(sa.sql.expression.text("""
+            WITH delta AS (
+                DELETE FROM collection_count_delta WHERE collection_id = :collection_id
+                RETURNING releases, records, compiled_releases
             )
+            UPDATE collection SET
+                cached_releases_count = cached_releases_count + (SELECT coalesce(sum(releases), 0) FROM delta),
+                cached_records_count = cached_records_count + (SELECT coalesce(sum(records), 0) FROM delta),
+                cached_compiled_releases_count = cached_compiled_releases_count
+                    + (SELECT coalesce(sum(compiled_releases), 0) FROM delta)
+            WHERE id = :collection_id"""), {'collection_id': collection_id})
 
 
 class DatabaseStore:
 
     def __init__(self, database, collection_id, file_name, number, url='', before_db_transaction_ends_callback=None,
-                 allow_existing_collection_file_item_table_row=False, warnings=None):
+                 allow_existing_collection_file_item_table_row=False, warnings=None, batch_size=None, group=None,
+                 known_new_file=False):
         self.database = database
         self.collection_id = collection_id
         self.file_name = file_name
@@ -897,28 +1540,83 @@ class DatabaseStore:
         self.collection_file_item_id = None
         self.allow_existing_collection_file_item_table_row = allow_existing_collection_file_item_table_row
         self.warnings = warnings
+        # If a batch size is set, rows are buffered and written with a few set-based queries per batch,
+        # instead of several queries per row.
+        self.batch_size = batch_size
+        self.batch = []
+        # If a DatabaseStoreGroup is passed, its transaction is used, and it commits and sends signals.
+        self.group = group
+        # If the caller expects that the collection_file row doesn't exist yet, try to insert it before looking for it.
+        self.known_new_file = known_new_file
+        # Store.store_file_item passes the same package_data object with every row, so remember the last one's JSON
+        # and hash.
+        self.last_package_data = None
+        self.last_package_data_json_and_hash_md5 = None
+        # hash_md5 -> id of rows looked up or inserted in this transaction, to add to the database's caches after
+        # commit
+        self.package_data_ids = {}
+        self.data_ids = {}
+        # hash_md5 of rows whose IDs were found in the database's caches, to remove from the caches if an ID is stale.
+        self.cached_package_data_hashes_md5 = set()
+        self.cached_data_hashes_md5 = set()
+        # Set in __enter__. See DataBase.get_data_hash_filter.
+        self.data_hash_filter = None
+        # The number of rows of each type stored, added to the collection's counts in this transaction.
+        self.counts = {'release': 0, 'record': 0, 'compiled_release': 0}
 
     def __enter__(self):
-        self.connection = self.database.get_engine().connect()
-        self.transaction = self.connection.begin()
+        self.database.check_id_cache_generation()
+
+        if self.group:
+            self.connection = self.group.get_connection()
+            if self.group.savepoints:
+                self.transaction = self.connection.begin_nested()
+        else:
+            self.connection = self.database.get_engine().connect()
+            self.transaction = self.connection.begin()
+
+        try:
+            self._get_or_create_collection_file_item()
+        except Exception:
+            self.__exit__(*sys.exc_info())
+            raise
+
+        return self
+
+    def _get_or_create_collection_file_item(self):
+        self.data_hash_filter = self.database.get_data_hash_filter(self.collection_id)
 
         # Collection File!
-        s = sa.sql.select([self.database.collection_file_table]) \
-            .where((self.database.collection_file_table.c.collection_id == self.collection_id) &
-                   (self.database.collection_file_table.c.filename == self.file_name))
-        result = self.connection.execute(s)
+        self.collection_file_id = self.database.collection_file_ids.get((self.collection_id, self.file_name))
+        self.collection_file_id_is_cached = bool(self.collection_file_id)
+
+        if not self.collection_file_id and self.known_new_file:
+            result = self.connection.execute(sa.sql.expression.text("""
+                INSERT INTO collection_file (collection_id, filename, url) VALUES (:collection_id, :filename, :url)
+                ON CONFLICT (collection_id, filename) DO NOTHING
+                RETURNING id
+            """), {'collection_id': self.collection_id, 'filename': self.file_name, 'url': self.url})
+            collection_file_table_row = result.fetchone()
+            if collection_file_table_row:
+                self.collection_file_id = collection_file_table_row['id']
 
-        collection_file_table_row = result.fetchone()
+        if not self.collection_file_id:
+            s = sa.sql.select([self.database.collection_file_table]) \
+                .where((self.database.collection_file_table.c.collection_id == self.collection_id) &
+                       (self.database.collection_file_table.c.filename == self.file_name))
+            result = self.connection.execute(s)
 
-        if collection_file_table_row:
-            self.collection_file_id = collection_file_table_row['id']
-        else:
-            value = self.connection.execute(self.database.collection_file_table.insert(), {
-                'collection_id': self.collection_id,
-                'filename': self.file_name,
-                'url': self.url,
-            })
-            self.collection_file_id = value.inserted_primary_key[0]
+            collection_file_table_row = result.fetchone()
+
+            if collection_file_table_row:
+                self.collection_file_id = collection_file_table_row['id']
+            else:
+                value = self.connection.execute(self.database.collection_file_table.insert(), {
+                    'collection_id': self.collection_id,
+                    'filename': self.file_name,
+                    'url': self.url,
+                })
+                self.collection_file_id = value.inserted_primary_key[0]
 
         # Collection File Item!
         s = sa.sql.select([self.database.collection_file_item_table]) \
@@ -942,28 +1640,52 @@ class DatabaseStore:
             })
             self.collection_file_item_id = value.inserted_primary_key[0]
 
-        # DB queries that will be used repeatably, we pre-build and reuse for speed
-        self.database_get_existing_data = \
-            sa.sql.expression.text("SELECT id FROM data WHERE hash_md5 = :hash_md5")
-        self.database_get_existing_package_data = \
-            sa.sql.expression.text("SELECT id FROM package_data WHERE hash_md5 = :hash_md5")
-
-        return self
-
     def __exit__(self, type, value, traceback):
 
         if type:
 
-            self.transaction.rollback()
-
-            self.connection.close()
+            # Maybe a cached ID was for a row that has since been deleted.
+            if issubclass(type, sa.exc.IntegrityError):
+                self.database.collection_file_ids.clear()
+                self.database.package_data_ids.clear()
+                self.database.data_ids.clear()
+                # Otherwise, every process would keep using it until it expires.
+                self.database.uncache_ids(self.database.package_data_table,
+                                          self.cached_package_data_hashes_md5 | set(self.package_data_ids))
+                self.database.uncache_ids(self.database.data_table,
+                                          self.cached_data_hashes_md5 | set(self.data_ids))
+
+            # If in a group, the group rolls back when the exception reaches it, unless it uses savepoints.
+            if not self.group:
+                self.transaction.rollback()
+
+                self.connection.close()
+            elif self.transaction:
+                self.transaction.rollback()
 
         else:
-            if self.before_db_transaction_ends_callback:
-                self.before_db_transaction_ends_callback(database=self.database, connection=self.connection)
+            try:
+                self.flush()
+
+                self.database.add_collection_count_delta(self.connection, self.collection_id, self.counts)
+
+                if self.before_db_transaction_ends_callback:
+                    self.before_db_transaction_ends_callback(database=self.database, connection=self.connection)
+            except Exception:
+                self.__exit__(*sys.exc_info())
+                raise
+
+            if self.group:
+                # Release the savepoint, if any.
+                if self.transaction:
+                    self.transaction.commit()
+                self.group.item_stored(self)
+                return
 
             self.transaction.commit()
 
+            self.after_commit()
+
             self.connection.close()
 
             KINGFISHER_SIGNALS\
@@ -973,7 +1695,19 @@ class DatabaseStore:
                       collection_file_item_id=self.collection_file_item_id
                       )
 
+    def after_commit(self):
+        # The collection_file row might have been inserted in this transaction, so it can only be cached now.
+        if not self.collection_file_id_is_cached:
+            self.database.collection_file_ids.set((self.collection_id, self.file_name), self.collection_file_id)
+        self.database.cache_ids(self.database.package_data_table, self.package_data_ids)
+        self.database.cache_ids(self.database.data_table, self.data_ids)
+        if any(self.counts.values()):
+            self.database.collection_count_delta_committed(self.collection_id)
+
     def insert_record(self, row, package_data):
+        if self.batch_size:
+            self._add_to_batch('record', row, package_data)
+            return
         ocid = row.get('ocid', '')
         package_data_id = self.get_id_for_package_data(package_data)
         data_id = self.get_id_for_data(row)
@@ -984,8 +1718,12 @@ class DatabaseStore:
             'data_id': data_id,
             'package_data_id': package_data_id,
         })
+        self.counts['record'] += 1
 
     def insert_release(self, row, package_data):
+        if self.batch_size:
+            self._add_to_batch('release', row, package_data)
+            return
         ocid = row.get('ocid', '')
         release_id = row.get('id', '')
         package_data_id = self.get_id_for_package_data(package_data)
@@ -998,8 +1736,12 @@ class DatabaseStore:
             'data_id': data_id,
             'package_data_id': package_data_id,
         })
+        self.counts['release'] += 1
 
     def insert_compiled_release(self, row):
+        if self.batch_size:
+            self._add_to_batch('compiled_release', row, None)
+            return
         ocid = row.get('ocid', '')
         data_id = self.get_id_for_data(row)
         self.connection.execute(self.database.compiled_release_table.insert(), {
@@ -1008,29 +1750,154 @@ class DatabaseStore:
             'ocid': ocid,
             'data_id': data_id,
         })
+        self.counts['compiled_release'] += 1
+
+    def get_json_and_hash_md5_for_package_data(self, package_data):
+        if package_data is not self.last_package_data:
+            self.last_package_data = package_data
+            self.last_package_data_json_and_hash_md5 = get_json_and_hash_md5_for_data(package_data)
+        return self.last_package_data_json_and_hash_md5
+
+    def get_ids_for_hashes(self, table, json_by_hash):
+        """Like DataBase.get_ids_for_hashes, but looks in this transaction's IDs and the database's caches first."""
+        if table is self.database.data_table:
+            ids, cached_hashes_md5 = self.data_ids, self.cached_data_hashes_md5
+            data_hash_filter = self.data_hash_filter
+        else:
+            ids, cached_hashes_md5 = self.package_data_ids, self.cached_package_data_hashes_md5
+            data_hash_filter = None
+
+        out = {hash_md5: ids[hash_md5] for hash_md5 in json_by_hash if hash_md5 in ids}
+        cached = self.database.get_cached_ids(table, [hash_md5 for hash_md5 in json_by_hash if hash_md5 not in out])
+        cached_hashes_md5.update(cached)
+        out.update(cached)
+
+        new_ids = self.database.get_ids_for_hashes(
+            table, {hash_md5: value for hash_md5, value in json_by_hash.items() if hash_md5 not in out},
+            self.connection, data_hash_filter)
+        ids.update(new_ids)
+        out.update(new_ids)
+        return out
 
     def get_id_for_package_data(self, package_data):
 
-        hash_md5 = get_hash_md5_for_data(package_data)
-        result = self.connection.execute(self.database_get_existing_package_data, {'hash_md5': hash_md5})
-        existing_table_row = result.fetchone()
-        if existing_table_row:
-            return existing_table_row.id
-        else:
-            return self.connection.execute(self.database.package_data_table.insert(), {
-                'hash_md5': hash_md5,
-                'data': package_data,
-            }).inserted_primary_key[0]
+        package_data_str, hash_md5 = self.get_json_and_hash_md5_for_package_data(package_data)
+        return self.get_ids_for_hashes(self.database.package_data_table, {hash_md5: package_data_str})[hash_md5]
 
     def get_id_for_data(self, data):
 
-        hash_md5 = get_hash_md5_for_data(data)
-        result = self.connection.execute(self.database_get_existing_data, {'hash_md5': hash_md5})
-        existing_table_row = result.fetchone()
-        if existing_table_row:
-            return existing_table_row.id
+        data_str, hash_md5 = get_json_and_hash_md5_for_data(data)
+        return self.get_ids_for_hashes(self.database.data_table, {hash_md5: data_str})[hash_md5]
+
+    def _add_to_batch(self, row_type, row, package_data):
+        self.batch.append((row_type, row, package_data))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        batch = self.batch
+        self.batch = []
+
+        # Hash everything first. Every row in a package shares the same package_data object, so only hash it once.
+        data_by_hash = {}
+        package_data_by_hash = {}
+        rows = []
+        for row_type, row, package_data in batch:
+            data_str, data_hash_md5 = get_json_and_hash_md5_for_data(row)
+            data_by_hash[data_hash_md5] = data_str
+            package_data_hash_md5 = None
+            if package_data is not None:
+                package_data_str, package_data_hash_md5 = self.get_json_and_hash_md5_for_package_data(package_data)
+                package_data_by_hash[package_data_hash_md5] = package_data_str
+            rows.append((row_type, row, data_hash_md5, package_data_hash_md5))
+
+        data_ids = self.get_ids_for_hashes(self.database.data_table, data_by_hash)
+        package_data_ids = self.get_ids_for_hashes(self.database.package_data_table, package_data_by_hash)
+
+        values = {'release': [], 'record': [], 'compiled_release': []}
+        for row_type, row, data_hash_md5, package_data_hash_md5 in rows:
+            value = {
+                'collection_id': self.collection_id,
+                'collection_file_item_id': self.collection_file_item_id,
+                'ocid': row.get('ocid', ''),
+                'data_id': data_ids[data_hash_md5],
+            }
+            if row_type == 'release':
+                value['release_id'] = row.get('id', '')
+            if row_type != 'compiled_release':
+                value['package_data_id'] = package_data_ids[package_data_hash_md5]
+            values[row_type].append(value)
+
+        for row_type, table in (('release', self.database.release_table),
+                                ('record', self.database.record_table),
+                                ('compiled_release', self.database.compiled_release_table)):
+            if values[row_type]:
+                self.connection.execute(table.insert().values(values[row_type]))
+                self.counts[row_type] += len(values[row_type])
+
+
+class DatabaseStoreGroup:
+    """Stores several items in one transaction, to spread the cost of committing.
+
+    Pass it to each DatabaseStore. It commits after every items_per_transaction items, and when it exits, then sends a
+    collection-data-store-finished signal for each item committed. If there is an exception, the items not yet
+    committed are rolled back.
+
+    If savepoints is true, each item is stored in a savepoint, so if an item can not be stored, only it is rolled back,
+    and the exception can be caught without leaving the group."""
+
+    def __init__(self, database, items_per_transaction, savepoints=False):
+        self.database = database
+        self.items_per_transaction = items_per_transaction
+        self.savepoints = savepoints
+        self.connection = None
+        self.transaction = None
+        # DatabaseStores of items stored in the current transaction
+        self.items = []
+
+    def __enter__(self):
+        return self
+
+    def get_connection(self):
+        if not self.connection:
+            self.connection = self.database.get_engine().connect()
+            self.transaction = self.connection.begin()
+        return self.connection
+
+    def item_stored(self, store):
+        self.items.append(store)
+        if len(self.items) >= self.items_per_transaction:
+            self.commit()
+
+    def commit(self):
+        if not self.connection:
+            return
+
+        self.transaction.commit()
+        self.connection.close()
+        self.connection = None
+
+        items = self.items
+        self.items = []
+        for store in items:
+            store.after_commit()
+        for store in items:
+            KINGFISHER_SIGNALS\
+                .signal('collection-data-store-finished')\
+                .send('anonymous',
+                      collection_id=store.collection_id,
+                      collection_file_item_id=store.collection_file_item_id
+                      )
+
+    def __exit__(self, type, value, traceback):
+        if type:
+            if self.connection:
+                self.transaction.rollback()
+                self.connection.close()
+                self.connection = None
+            self.items = []
         else:
-            return self.connection.execute(self.database.data_table.insert(), {
-                'hash_md5': hash_md5,
-                'data': data,
-            }).inserted_primary_key[0]
+            self.commit()
@@ -0,0 +1,46 @@
+"""A cache of hash_md5 to id for the data and package_data tables in Redis, shared by all processes. See the Redis
+section of the config docs.
+
+Only IDs of committed rows are added. When orphan data is deleted, its hashes are removed, and a generation number is
+incremented, so that other processes clear their local caches. See DataBase.check_id_cache_generation."""
+
+import redis
+
+KEY_PREFIX = 'kingfisher_id'
+GENERATION_KEY = 'kingfisher_id_cache_generation'
+
+
+class RedisIdCache:
+
+    def __init__(self, config):
+        self.ttl = config.redis_id_cache_ttl
+        self.redis = redis.Redis(host=config.redis_host, port=config.redis_port, db=config.redis_database)
+
+    def _key(self, table_name, hash_md5):
+        return '{}:{}:{}'.format(KEY_PREFIX, table_name, hash_md5)
+
+    def get_many(self, table_name, hashes_md5):
+        """Returns a dict of hash_md5 to id, for the hashes that are cached."""
+        if not hashes_md5:
+            return {}
+        values = self.redis.mget([self._key(table_name, hash_md5) for hash_md5 in hashes_md5])
+        return {hash_md5: int(value) for hash_md5, value in zip(hashes_md5, values) if value is not None}
+
+    def set_many(self, table_name, ids):
+        if not ids:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        for hash_md5, id in ids.items():
+            pipeline.set(self._key(table_name, hash_md5), id, ex=self.ttl)
+        pipeline.execute()
+
+    def delete_many(self, table_name, hashes_md5):
+        if not hashes_md5:
+            return
+        self.redis.delete(*[self._key(table_name, hash_md5) for hash_md5 in hashes_md5])
+
+    def get_generation(self):
+        return int(self.redis.get(GENERATION_KEY) or 0)
+
+    def increment_generation(self):
+        return self.redis.incr(GENERATION_KEY)
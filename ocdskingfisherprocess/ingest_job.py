@@ -0,0 +1,38 @@
+import logging
+import os
+
+from ocdskingfisherprocess.store import Store
+
+
+class ProcessIngestJobs:
+    """Stores files that were queued by the web API's asynchronous mode. See DataBase.create_ingest_job."""
+
+    def __init__(self, config, database):
+        self.config = config
+        self.database = database
+
+    def process_next(self):
+        """Stores the next queued file, if any. Returns whether there was one."""
+        ingest_job = self.database.claim_ingest_job()
+        if not ingest_job:
+            return False
+
+        logger = logging.getLogger('ocdskingfisher.ingest-job')
+        logger.info("Starting ingest job {} for collection {}".format(ingest_job['id'], ingest_job['collection_id']))
+
+        errors = None
+        try:
+            store = Store(self.config, self.database)
+            store.set_collection(self.database.get_collection(ingest_job['collection_id']))
+            store.store_file_from_local(ingest_job['filename'], ingest_job['url'], ingest_job['data_type'],
+                                        ingest_job['encoding'], ingest_job['local_file_name'],
+                                        compression=ingest_job['compression'])
+        except Exception as e:
+            logger.exception("Error in ingest job {}".format(ingest_job['id']))
+            errors = [repr(e)]
+        finally:
+            if ingest_job['delete_local_file'] and os.path.exists(ingest_job['local_file_name']):
+                os.remove(ingest_job['local_file_name'])
+
+        self.database.mark_ingest_job_done(ingest_job['id'], errors=errors)
+        return True
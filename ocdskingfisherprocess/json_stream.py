@@ -0,0 +1,111 @@
+"""Incremental JSON parsing, for files that are too big to load into memory all at once.
+
+ijson's pure Python backend is slow, so a faster one is used if it is installed."""
+
+import decimal
+import importlib
+
+import ijson
+from ijson.common import ObjectBuilder
+
+
+def _get_backend():
+    for name in ('yajl2_c', 'yajl2_cffi', 'yajl2'):
+        try:
+            return importlib.import_module('ijson.backends.' + name)
+        except ImportError:
+            pass
+    return ijson
+
+
+backend = _get_backend()
+
+
+def _number(value):
+    # ijson gives non-integer numbers as Decimals, but the json module (and so the hashes of data already in the
+    # database) uses floats.
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return value
+
+
+class _ObjectBuilder(ObjectBuilder):
+
+    def event(self, event, value):
+        if event == 'number':
+            value = _number(value)
+        super().event(event, value)
+
+
+def _build(events, event, value):
+    # Builds the value that starts with this event, consuming the events up to where it ends.
+    if event not in ('start_map', 'start_array'):
+        return _number(value) if event == 'number' else value
+    builder = _ObjectBuilder()
+    depth = 0
+    while True:
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                return builder.value
+        _, event, value = next(events)
+
+
+def _skip(events, event):
+    # Like _build, but doesn't keep anything.
+    if event not in ('start_map', 'start_array'):
+        return
+    depth = 1
+    while depth:
+        _, event, _ = next(events)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+
+
+def get_top_level(fileobj, skip_keys=()):
+    """Reads a whole JSON document from a binary file object. This also checks that the document is valid JSON.
+
+    If the document is an object, returns a dict of its keys. For keys in skip_keys the value is not built; instead it
+    is the ijson event that the value started with, eg. 'start_array'.
+
+    Otherwise, returns the ijson event that the document started with."""
+    events = backend.parse(fileobj)
+    _, event, value = next(events)
+    if event != 'start_map':
+        _skip(events, event)
+        for _ in events:
+            pass
+        return event
+
+    out = {}
+    for prefix, event, value in events:
+        if event == 'end_map':
+            break
+        # event is 'map_key'
+        key = value
+        _, event, value = next(events)
+        if key in skip_keys:
+            out[key] = event
+            _skip(events, event)
+        else:
+            out[key] = _build(events, event, value)
+
+    # There should be nothing else, but make sure the rest of the document is valid.
+    for _ in events:
+        pass
+
+    return out
+
+
+def items(fileobj, prefix):
+    """Yields each value at the prefix in a JSON document in a binary file object. The prefix is in ijson's format,
+    eg. 'releases.item' for each release in a release package."""
+    events = backend.parse(fileobj)
+    for current, event, value in events:
+        if current == prefix and event not in ('end_map', 'end_array', 'map_key'):
+            yield _build(events, event, value)
@@ -0,0 +1,103 @@
+"""JSON encoding and decoding, with a choice of library. See the JSON section of the config docs.
+
+All codecs give the same Python objects when decoding, and JSON that decodes to the same objects when encoding; only
+the speed differs. If a fast library can't handle something (like a very big integer), the json module is used instead.
+
+This is not used for hashes, which must always be of the json module's output. See util.get_json_and_hash_md5_for_data.
+"""
+
+import importlib
+import json
+import logging
+import re
+
+# orjson decodes integers that don't fit in 64 bits as floats, losing precision, instead of failing. Integers outside
+# the range of a signed 64-bit integer can have 19 digits (like -9223372036854775809), so the json module decodes JSON
+# with 19 or more digits in a row.
+_LONG_DIGITS = re.compile(r'\d{19}')
+_LONG_DIGITS_BYTES = re.compile(br'\d{19}')
+
+
+def _default(obj):
+    # Sets are stored as lists.
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+class StdlibCodec:
+    name = 'stdlib'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(default=_default)
+
+    def loads(self, s):
+        return json.loads(s)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+
+class OrjsonCodec(StdlibCodec):
+    name = 'orjson'
+    module = 'orjson'
+
+    def __init__(self):
+        super().__init__()
+        self._orjson = importlib.import_module(self.module)
+
+    def loads(self, s):
+        if (_LONG_DIGITS if isinstance(s, str) else _LONG_DIGITS_BYTES).search(s):
+            return super().loads(s)
+        try:
+            return self._orjson.loads(s)
+        except self._orjson.JSONDecodeError:
+            # eg. NaN. If it's invalid JSON, the json module raises the same error as the stdlib codec would.
+            return super().loads(s)
+
+    def dumps(self, obj):
+        try:
+            return self._orjson.dumps(obj, default=_default).decode('utf-8')
+        except TypeError:
+            return super().dumps(obj)
+
+
+class UjsonCodec(StdlibCodec):
+    name = 'ujson'
+    module = 'ujson'
+
+    def __init__(self):
+        super().__init__()
+        self._ujson = importlib.import_module(self.module)
+
+    def loads(self, s):
+        try:
+            return self._ujson.loads(s)
+        except ValueError:
+            return super().loads(s)
+
+    def dumps(self, obj):
+        try:
+            return self._ujson.dumps(obj, ensure_ascii=False)
+        except (TypeError, OverflowError):
+            return super().dumps(obj)
+
+
+CODECS = {codec.name: codec for codec in (StdlibCodec, OrjsonCodec, UjsonCodec)}
+
+_codecs = {}
+
+
+def get_codec(name):
+    """Returns the codec with this name. If its library is not installed, logs a warning and returns the stdlib codec.
+    """
+    if name not in _codecs:
+        if name not in CODECS:
+            raise Exception("JSON codec not known: {}".format(name))
+        try:
+            _codecs[name] = CODECS[name]()
+        except ImportError:
+            logging.getLogger('ocdskingfisher.jsoncodec').warning(
+                "JSON codec {} is not installed, so using stdlib instead".format(name))
+            _codecs[name] = StdlibCodec()
+    return _codecs[name]
@@ -0,0 +1,42 @@
+"""ingest_job
+
+Revision ID: 5a3e1b4c7d20
+Revises: 413c84a833f5
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects.postgresql import JSONB
+
+# revision identifiers, used by Alembic.
+revision = '5a3e1b4c7d20'
+down_revision = '413c84a833f5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ingest_job',
+                    sa.Column('id', sa.Integer, primary_key=True),
+                    sa.Column('collection_id', sa.Integer,
+                              sa.ForeignKey("collection.id", name="fk_ingest_job_collection_id"),
+                              nullable=False),
+                    sa.Column('filename', sa.Text, nullable=False),
+                    sa.Column('url', sa.Text, nullable=False),
+                    sa.Column('data_type', sa.Text, nullable=False),
+                    sa.Column('encoding', sa.Text, nullable=False),
+                    sa.Column('local_file_name', sa.Text, nullable=False),
+                    sa.Column('delete_local_file', sa.Boolean, nullable=False),
+                    sa.Column('status', sa.Text, nullable=False),
+                    sa.Column('errors', JSONB, nullable=True),
+                    sa.Column('created_at', sa.DateTime(timezone=False), nullable=False),
+                    sa.Column('started_at', sa.DateTime(timezone=False), nullable=True),
+                    sa.Column('ended_at', sa.DateTime(timezone=False), nullable=True),
+                    )
+    op.create_index('ingest_job_collection_id_idx', 'ingest_job', ['collection_id'])
+    op.create_index('ingest_job_queued_idx', 'ingest_job', ['id'], postgresql_where=sa.text("status = 'queued'"))
+
+
+def downgrade():
+    op.drop_table('ingest_job')
@@ -0,0 +1,117 @@
+"""partition_by_collection
+
+Partitions the release, record and compiled_release tables, and the check tables, by collection_id. Each new
+collection gets its own partitions (see DataBase.create_collection_partitions).
+
+The existing tables become the default partitions, so no rows are copied. A check constraint limits them to the
+collections that exist now, so that PostgreSQL doesn't have to scan them when a new collection's partitions are
+created. Validating that constraint scans each table once.
+
+In PostgreSQL 11, foreign keys can't reference a partitioned table, so those that reference these tables are dropped.
+Primary keys and unique constraints are on each partition, not on the partitioned tables.
+
+Revision ID: 6c1d2e8f9a31
+Revises: 5a3e1b4c7d20
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '6c1d2e8f9a31'
+down_revision = '5a3e1b4c7d20'
+branch_labels = None
+depends_on = None
+
+# The indexes of the partitioned tables, by column. The collection_id indexes are only kept on the default partitions,
+# as each other partition has only one collection.
+PARTITIONED_TABLES = [
+    ('release', ['collection_file_item_id', 'ocid', 'data_id', 'package_data_id']),
+    ('record', ['collection_file_item_id', 'ocid', 'data_id', 'package_data_id']),
+    ('compiled_release', ['collection_file_item_id', 'ocid', 'data_id']),
+    ('release_check', ['release_id']),
+    ('release_check_error', ['release_id']),
+    ('record_check', ['record_id']),
+    ('record_check_error', ['record_id']),
+]
+
+CHECK_TABLES = ['release_check', 'release_check_error', 'record_check', 'record_check_error']
+
+# The foreign keys that reference the partitioned tables.
+FOREIGN_KEYS = [
+    ('fk_release_check_release_id', 'release_check', 'release', 'release_id'),
+    ('fk_release_check_error_release_id', 'release_check_error', 'release', 'release_id'),
+    ('fk_record_check_record_id', 'record_check', 'record', 'record_id'),
+    ('fk_record_check_error_record_id', 'record_check_error', 'record', 'record_id'),
+    ('fk_transform_upgrade_1_0_to_1_1_status_release_source_release_id', 'transform_upgrade_1_0_to_1_1_status_release',
+     'release', 'source_release_id'),
+    ('fk_transform_upgrade_1_0_to_1_1_status_record_source_record_id', 'transform_upgrade_1_0_to_1_1_status_record',
+     'record', 'source_record_id'),
+]
+
+
+def _rename_indexes(conn, table, old_prefix, new_prefix):
+    for (name,) in conn.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND "
+                                "tablename = '{}'".format(table)).fetchall():
+        if name.startswith(old_prefix + '_'):
+            op.execute('ALTER INDEX "{}" RENAME TO "{}"'.format(name, new_prefix + name[len(old_prefix):]))
+
+
+def upgrade():
+    conn = op.get_bind()
+
+    # PostgreSQL truncates names to 63 characters, so look the foreign keys up by table.
+    for _, table, referenced_table, _ in FOREIGN_KEYS:
+        for (name,) in conn.execute("SELECT conname FROM pg_constraint WHERE contype = 'f' AND "
+                                    "conrelid = '{}'::regclass AND confrelid = '{}'::regclass"
+                                    .format(table, referenced_table)).fetchall():
+            op.execute('ALTER TABLE {} DROP CONSTRAINT "{}"'.format(table, name))
+
+    for table in CHECK_TABLES:
+        op.execute('ALTER TABLE {} ADD COLUMN collection_id integer'.format(table))
+
+    max_collection_id = conn.execute('SELECT coalesce(max(id), 0) FROM collection').scalar()
+
+    for table, columns in PARTITIONED_TABLES:
+        default = table + '_default'
+
+        op.execute('ALTER TABLE {} RENAME TO {}'.format(table, default))
+        _rename_indexes(conn, default, table, default)
+
+        op.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS) PARTITION BY LIST (collection_id)'
+                   .format(table, default))
+        op.execute('ALTER SEQUENCE {}_id_seq OWNED BY {}.id'.format(table, table))
+        # The default partition's indexes on the same columns are attached to these, instead of new ones being built.
+        for column in columns:
+            op.execute('CREATE INDEX {}_{}_idx ON {} ({})'.format(table, column, table, column))
+
+        op.execute('ALTER TABLE {} ADD CONSTRAINT {}_collection_id_check CHECK '
+                   '(collection_id IS NULL OR collection_id <= {}) NOT VALID'
+                   .format(default, default, max_collection_id))
+        op.execute('ALTER TABLE {} VALIDATE CONSTRAINT {}_collection_id_check'.format(default, default))
+        op.execute('ALTER TABLE {} ATTACH PARTITION {} DEFAULT'.format(table, default))
+
+
+def downgrade():
+    conn = op.get_bind()
+
+    for table, _ in PARTITIONED_TABLES:
+        default = table + '_default'
+
+        op.execute('ALTER TABLE {} DETACH PARTITION {}'.format(table, default))
+        op.execute('ALTER TABLE {} DROP CONSTRAINT {}_collection_id_check'.format(default, default))
+        for (partition,) in conn.execute("SELECT inhrelid::regclass::text FROM pg_inherits WHERE "
+                                         "inhparent = '{}'::regclass".format(table)).fetchall():
+            op.execute('INSERT INTO {} SELECT * FROM {}'.format(default, partition))
+            op.execute('DROP TABLE {}'.format(partition))
+
+        op.execute('ALTER SEQUENCE {}_id_seq OWNED BY {}.id'.format(table, default))
+        op.execute('DROP TABLE {}'.format(table))
+        op.execute('ALTER TABLE {} RENAME TO {}'.format(default, table))
+        _rename_indexes(conn, table, default, table)
+
+    for table in CHECK_TABLES:
+        op.drop_column(table, 'collection_id')
+
+    for name, table, referenced_table, column in FOREIGN_KEYS:
+        op.create_foreign_key(name, table, referenced_table, [column], ['id'])
@@ -0,0 +1,33 @@
+"""collection_delete_progress
+
+Revision ID: 8e4f0a2b6c13
+Revises: 6c1d2e8f9a31
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8e4f0a2b6c13'
+down_revision = '6c1d2e8f9a31'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('collection_delete_progress',
+                    sa.Column('collection_id', sa.Integer,
+                              sa.ForeignKey("collection.id", name="fk_collection_delete_progress_collection_id"),
+                              nullable=False, primary_key=True),
+                    sa.Column('table_name', sa.Text, nullable=False, primary_key=True),
+                    sa.Column('last_id', sa.Integer, nullable=False, server_default='0'),
+                    sa.Column('rows_deleted', sa.BigInteger, nullable=False, server_default='0'),
+                    sa.Column('done', sa.Boolean, nullable=False, server_default='false'),
+                    sa.Column('started_at', sa.DateTime(timezone=False), nullable=False),
+                    sa.Column('updated_at', sa.DateTime(timezone=False), nullable=False),
+                    )
+
+
+def downgrade():
+    op.drop_table('collection_delete_progress')
@@ -0,0 +1,26 @@
+"""orphan_candidate
+
+Revision ID: 9b7d3c5e1f42
+Revises: 8e4f0a2b6c13
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9b7d3c5e1f42'
+down_revision = '8e4f0a2b6c13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('orphan_candidate',
+                    sa.Column('table_name', sa.Text, nullable=False, primary_key=True),
+                    sa.Column('id', sa.Integer, nullable=False, primary_key=True),
+                    )
+
+
+def downgrade():
+    op.drop_table('orphan_candidate')
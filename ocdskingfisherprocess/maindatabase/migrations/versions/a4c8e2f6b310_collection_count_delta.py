@@ -0,0 +1,37 @@
+"""collection_count_delta
+
+Revision ID: a4c8e2f6b310
+Revises: 9b7d3c5e1f42
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a4c8e2f6b310'
+down_revision = '9b7d3c5e1f42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('collection_count_delta',
+                    sa.Column('id', sa.BigInteger, primary_key=True),
+                    sa.Column('collection_id', sa.Integer,
+                              sa.ForeignKey("collection.id", name="fk_collection_count_delta_collection_id"),
+                              nullable=False),
+                    sa.Column('releases', sa.Integer, nullable=False, server_default='0'),
+                    sa.Column('records', sa.Integer, nullable=False, server_default='0'),
+                    sa.Column('compiled_releases', sa.Integer, nullable=False, server_default='0'),
+                    )
+    op.create_index('collection_count_delta_collection_id_idx', 'collection_count_delta', ['collection_id'])
+
+    # Rows stored from now on are counted as they are stored. The counts of collections that are still being stored
+    # don't include rows stored since they were last counted, so they are recounted the next time they are updated.
+    op.execute("UPDATE collection SET cached_releases_count = NULL, cached_records_count = NULL, "
+               "cached_compiled_releases_count = NULL WHERE store_end_at IS NULL")
+
+
+def downgrade():
+    op.drop_table('collection_count_delta')
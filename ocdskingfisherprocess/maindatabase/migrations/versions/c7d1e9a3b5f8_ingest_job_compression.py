@@ -0,0 +1,23 @@
+"""ingest_job_compression
+
+Revision ID: c7d1e9a3b5f8
+Revises: a4c8e2f6b310
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c7d1e9a3b5f8'
+down_revision = 'a4c8e2f6b310'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('ingest_job', sa.Column('compression', sa.Text, nullable=True))
+
+
+def downgrade():
+    op.drop_column('ingest_job', 'compression')
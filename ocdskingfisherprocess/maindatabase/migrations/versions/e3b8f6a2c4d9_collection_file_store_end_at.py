@@ -0,0 +1,23 @@
+"""collection_file_store_end_at
+
+Revision ID: e3b8f6a2c4d9
+Revises: c7d1e9a3b5f8
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e3b8f6a2c4d9'
+down_revision = 'c7d1e9a3b5f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('collection_file', sa.Column('store_end_at', sa.DateTime(timezone=False), nullable=True))
+
+
+def downgrade():
+    op.drop_column('collection_file', 'store_end_at')
@@ -2,7 +2,8 @@ class CollectionModel:
 
     def __init__(self, database_id=None, source_id=None, data_version=None, sample=None, transform_type='',
                  transform_from_collection_id=None, check_data=None, check_older_data_with_schema_version_1_1=None,
-                 store_start_at=None, store_end_at=None, deleted_at=None):
+                 store_start_at=None, store_end_at=None, deleted_at=None, releases_count=None, records_count=None,
+                 compiled_releases_count=None):
         self.database_id = database_id
         self.source_id = source_id
         self.data_version = data_version
@@ -14,6 +15,9 @@ class CollectionModel:
         self.store_start_at = store_start_at
         self.store_end_at = store_end_at
         self.deleted_at = deleted_at
+        self.releases_count = releases_count
+        self.records_count = records_count
+        self.compiled_releases_count = compiled_releases_count
 
 
 class FileModel:
@@ -41,3 +45,23 @@ class CollectionNoteModel:
         self.database_id = database_id
         self.note = note
         self.stored_at = stored_at
+
+
+class IngestJobModel:
+
+    def __init__(self, database_id=None, collection_id=None, filename=None, url=None, data_type=None, status=None,
+                 errors=None, created_at=None, started_at=None, ended_at=None, items_stored=None, file_errors=None,
+                 items_with_errors=None):
+        self.database_id = database_id
+        self.collection_id = collection_id
+        self.filename = filename
+        self.url = url
+        self.data_type = data_type
+        self.status = status
+        self.errors = errors
+        self.created_at = created_at
+        self.started_at = started_at
+        self.ended_at = ended_at
+        self.items_stored = items_stored
+        self.file_errors = file_errors
+        self.items_with_errors = items_with_errors
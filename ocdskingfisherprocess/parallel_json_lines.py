@@ -0,0 +1,126 @@
+"""Stores a big JSON Lines file with several processes.
+
+The file is split into byte ranges that start and end on a new line. Each process parses, hashes and stores the lines
+in its ranges with a BulkStore, reading them from a memory map of the file. The item number of each line is still its
+line number in the file."""
+
+import multiprocessing
+
+import ocdskingfisherprocess.signals.signals
+from ocdskingfisherprocess.bulk_store import BulkStore
+from ocdskingfisherprocess.database import DataBase
+from ocdskingfisherprocess.util import FileToStore, has_control_codes, iter_lines, open_mapped, remove_control_codes
+
+JSON_LINES_DATA_TYPES = [
+    'release_package_json_lines',
+    'record_package_json_lines',
+    'release_in_Release_json_lines',
+]
+
+CHUNK_SIZE = 1024 ** 2
+
+# Each worker process has its own database connection, set up by _init_worker.
+_worker_config = None
+_worker_database = None
+
+
+def _init_worker(config):
+    global _worker_config, _worker_database
+    _worker_config = config
+    _worker_database = DataBase(config)
+    ocdskingfisherprocess.signals.signals.setup_signals(config, _worker_database)
+
+
+def get_byte_ranges(local_filename, number_of_ranges):
+    """Returns a list of (start, end) byte offsets, that split a file into about number_of_ranges ranges of lines."""
+    starts = [0]
+    with open_mapped(local_filename) as buffer:
+        size = len(buffer)
+        for i in range(1, number_of_ranges):
+            position = buffer.find(b'\n', max(size * i // number_of_ranges, starts[-1])) + 1
+            if position <= 0 or position >= size:
+                break
+            if position > starts[-1]:
+                starts.append(position)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def _count_lines(args):
+    local_filename, start, end = args
+    count = 0
+    with open(local_filename, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            chunk = f.read(min(CHUNK_SIZE, end - position))
+            if not chunk:
+                break
+            count += chunk.count(b'\n')
+            position += len(chunk)
+    return count
+
+
+def _store_range(args):
+    collection_id, filename, url, data_type, encoding, local_filename, start, end, number, stored_item_numbers = args
+
+    store = BulkStore(_worker_config, _worker_database)
+    store.collection_id = collection_id
+    store.stored_item_numbers = {filename: stored_item_numbers}
+
+    warnings = []
+    with open_mapped(local_filename) as buffer:
+        # Control codes are only looked for in lines if the range has any.
+        sanitize = has_control_codes(buffer, start, end)
+        for raw_data in iter_lines(buffer, start, end):
+            if not store.is_item_stored(filename, number):
+                if sanitize:
+                    raw_data = remove_control_codes(raw_data, warnings)
+                json_data = store.json_codec.loads(raw_data.decode(encoding))
+                if data_type == 'release_in_Release_json_lines':
+                    json_data = json_data['Release']
+                store.store_file_item(filename, url, data_type, json_data, number)
+            number += 1
+
+    store.flush()
+    return warnings
+
+
+def store_file_from_local(store, filename, url, data_type, encoding, local_filename, workers):
+    """Like Store.store_file_from_local, for JSON Lines files, but with a pool of worker processes.
+
+    The encoding must be one in which a new line is the byte '\\n', like UTF-8."""
+
+    if data_type not in JSON_LINES_DATA_TYPES:
+        raise Exception("data_type is not a JSON Lines type")
+
+    with FileToStore(local_filename) as file_to_store:
+        # A compressed file can't be split into byte ranges, so it is stored by this process.
+        if file_to_store.get_compression():
+            return store.store_file_from_local(filename, url, data_type, encoding, local_filename)
+
+    stored_item_numbers = store.stored_item_numbers.get(filename, set())
+    # More ranges than workers, so that a worker that finishes early can take another range.
+    byte_ranges = get_byte_ranges(local_filename, workers * 4)
+
+    # Otherwise, processes would race to create it.
+    store.database.create_collection_files(store.collection_id, [(filename, url)])
+    # Connections must not be shared with the worker processes.
+    store.database.get_engine().dispose()
+
+    with multiprocessing.Pool(workers, _init_worker, (store.config,)) as pool:
+        counts = pool.map(_count_lines, [(local_filename, start, end) for start, end in byte_ranges])
+
+        tasks = []
+        number = 0
+        for (start, end), count in zip(byte_ranges, counts):
+            tasks.append((store.collection_id, filename, url, data_type, encoding, local_filename, start, end, number,
+                          set(n for n in stored_item_numbers if number <= n < number + count + 1)))
+            number += count
+
+        warnings = []
+        for range_warnings in pool.map(_store_range, tasks):
+            for warning in range_warnings:
+                if warning not in warnings:
+                    warnings.append(warning)
+
+    store.mark_file_store_done(filename, warnings=warnings)
@@ -1,5 +1,5 @@
 import redis
-from prometheus_client import Gauge
+from prometheus_client import Counter, Gauge, Histogram
 
 PROMETHEUS_REDIS_QUEUE_LENGTH = Gauge(
     'kingfisher_process_redis_queue_length',
@@ -10,8 +10,68 @@ PROMETHEUS_REDIS_QUEUE_COLLECTION_STORE_FINISHED_LENGTH = Gauge(
     'Length of Redis Que for Collection Store Finished Events'
 )
 
+# See DataBase.get_ids_for_hashes. The false positive rate is false positives / (false positives + lookups saved -
+# conflicts).
+PROMETHEUS_DATA_HASH_FILTER_LOOKUPS_SAVED = Counter(
+    'kingfisher_process_data_hash_filter_lookups_saved',
+    'Data that the data hash filter said was new, so was inserted without looking it up'
+)
+PROMETHEUS_DATA_HASH_FILTER_MAYBE = Counter(
+    'kingfisher_process_data_hash_filter_maybe',
+    'Data that the data hash filter said might be stored, so was looked up'
+)
+PROMETHEUS_DATA_HASH_FILTER_FALSE_POSITIVES = Counter(
+    'kingfisher_process_data_hash_filter_false_positives',
+    'Data that the data hash filter said might be stored, but was not'
+)
+PROMETHEUS_DATA_HASH_FILTER_CONFLICTS = Counter(
+    'kingfisher_process_data_hash_filter_conflicts',
+    'Data that the data hash filter said was new, but was already stored by another source or process'
+)
+
+# Collections are deleted by the delete-collections command, in another process, so these are read from the
+# collection_delete_progress table. See CollectionDeleter.
+PROMETHEUS_DELETE_COLLECTION_IN_PROGRESS = Gauge(
+    'kingfisher_process_delete_collection_in_progress',
+    'Collections that are being deleted'
+)
+PROMETHEUS_DELETE_COLLECTION_ROWS_DELETED = Gauge(
+    'kingfisher_process_delete_collection_rows_deleted',
+    'Rows deleted so far from the collections that are being deleted'
+)
+PROMETHEUS_DELETE_COLLECTION_ROWS_PER_SECOND = Gauge(
+    'kingfisher_process_delete_collection_rows_per_second',
+    'Rows deleted per second from the collections that are being deleted'
+)
+
+# See DataBase.get_engine. These are of this process's pool.
+PROMETHEUS_DB_POOL_CHECKOUT_SECONDS = Histogram(
+    'kingfisher_process_db_pool_checkout_seconds',
+    'Seconds waited for a database connection from the pool, including to open a new connection'
+)
+PROMETHEUS_DB_POOL_CHECKOUT_TIMEOUTS = Counter(
+    'kingfisher_process_db_pool_checkout_timeouts',
+    'Times that no database connection was available from the pool before the timeout'
+)
+PROMETHEUS_DB_POOL_SIZE = Gauge(
+    'kingfisher_process_db_pool_size',
+    'Database connections that the pool keeps open'
+)
+PROMETHEUS_DB_POOL_CHECKED_OUT = Gauge(
+    'kingfisher_process_db_pool_checked_out',
+    'Database connections in use'
+)
+PROMETHEUS_DB_POOL_OVERFLOW = Gauge(
+    'kingfisher_process_db_pool_overflow',
+    'Database connections in use beyond the pool size'
+)
+PROMETHEUS_DB_POOL_SATURATION = Gauge(
+    'kingfisher_process_db_pool_saturation',
+    'Database connections in use, as a fraction of the most that the pool allows'
+)
+
 
-def update_all_prometheus_stats(config):
+def update_all_prometheus_stats(config, database=None):
     if config.is_redis_available():
         redis_conn = redis.Redis(host=config.redis_host, port=config.redis_port, db=config.redis_database)
         PROMETHEUS_REDIS_QUEUE_LENGTH.set(
@@ -20,3 +80,14 @@ def update_all_prometheus_stats(config):
         PROMETHEUS_REDIS_QUEUE_COLLECTION_STORE_FINISHED_LENGTH.set(
             redis_conn.llen('kingfisher_work_collection_store_finished')
         )
+    if database:
+        progress = database.get_collection_delete_progress()
+        PROMETHEUS_DELETE_COLLECTION_IN_PROGRESS.set(progress['collections'])
+        PROMETHEUS_DELETE_COLLECTION_ROWS_DELETED.set(progress['rows_deleted'])
+        PROMETHEUS_DELETE_COLLECTION_ROWS_PER_SECOND.set(progress['rows_per_second'])
+        pool = database.get_pool_status()
+        if pool:
+            PROMETHEUS_DB_POOL_SIZE.set(pool['size'])
+            PROMETHEUS_DB_POOL_CHECKED_OUT.set(pool['checked_out'])
+            PROMETHEUS_DB_POOL_OVERFLOW.set(pool['overflow'])
+            PROMETHEUS_DB_POOL_SATURATION.set(pool['saturation'])
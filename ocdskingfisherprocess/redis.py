@@ -1,6 +1,5 @@
-import json
-
 from ocdskingfisherprocess.checks import Checks
+from ocdskingfisherprocess.jsoncodec import get_codec
 
 
 class ProcessQueueMessage:
@@ -9,7 +8,7 @@ class ProcessQueueMessage:
         self.database = database
 
     def process(self, message_as_string, run_until_timestamp=None):
-        message_as_data = json.loads(message_as_string)
+        message_as_data = get_codec(self.database.config.json_codec).loads(message_as_string)
         if message_as_data['type'] == 'collection-data-store-finished':
             collection = self.database.get_collection(message_as_data['collection_id'])
             if collection:
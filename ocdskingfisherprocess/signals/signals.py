@@ -1,7 +1,6 @@
-import json
-
 import redis
 
+from ocdskingfisherprocess.jsoncodec import get_codec
 from ocdskingfisherprocess.signals import KINGFISHER_SIGNALS
 from ocdskingfisherprocess.transform import TRANSFORM_TYPE_COMPILE_RELEASES, TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1
 
@@ -50,7 +49,7 @@ def collection_data_store_finished_to_redis(sender,
                                             collection_file_item_id=None,
                                             **kwargs):
     redis_conn = redis.Redis(host=our_config.redis_host, port=our_config.redis_port, db=our_config.redis_database)
-    message = json.dumps({
+    message = get_codec(our_config.json_codec).dumps({
         'type': 'collection-data-store-finished',
         'collection_id': collection_id,
         'collection_file_item_id': collection_file_item_id,
@@ -62,7 +61,7 @@ def collection_store_finished_to_redis(sender,
                                        collection_id=None,
                                        **kwargs):
     redis_conn = redis.Redis(host=our_config.redis_host, port=our_config.redis_port, db=our_config.redis_database)
-    message = json.dumps({
+    message = get_codec(our_config.json_codec).dumps({
         'collection_id': collection_id,
     })
     redis_conn.rpush('kingfisher_work_collection_store_finished', message)
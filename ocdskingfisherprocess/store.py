@@ -1,7 +1,15 @@
-import json
+import contextlib
+import io
 
-from ocdskingfisherprocess.database import DatabaseStore
-from ocdskingfisherprocess.util import FileToStore
+import sqlalchemy as sa
+
+from ocdskingfisherprocess import json_stream
+from ocdskingfisherprocess.database import DatabaseStore, DatabaseStoreGroup
+from ocdskingfisherprocess.jsoncodec import get_codec
+from ocdskingfisherprocess.util import FileToStore, has_control_codes, iter_lines, remove_control_codes
+
+# https://www.postgresql.org/docs/11/errcodes-appendix.html
+FOREIGN_KEY_VIOLATION = '23503'
 
 
 class Store:
@@ -24,11 +32,47 @@ class Store:
         'release_in_Release_json_lines'
     ]
 
+    # Data types that can be parsed incrementally, if the file is big enough. See store_stream_min_file_size.
+    STREAMABLE_DATA_TYPES = [
+        'record_list',
+        'release_list',
+        'record_package',
+        'release_package',
+        'record_package_list',
+        'release_package_list',
+        'record_package_list_in_results',
+        'release_package_list_in_results',
+        'release_package_in_ocdsReleasePackage_in_list_in_results',
+    ]
+
+    # Data types that can have more than one item in a file. Files of other types only have item 0.
+    MULTIPLE_ITEM_DATA_TYPES = [
+        'record_list',
+        'release_list',
+        'record_package_list',
+        'release_package_list',
+        'record_package_list_in_results',
+        'release_package_list_in_results',
+        'release_package_json_lines',
+        'record_package_json_lines',
+        'release_package_in_ocdsReleasePackage_in_list_in_results',
+        'release_in_Release_json_lines',
+    ]
+
+    # The minimum number of items per transaction in group_item_transactions.
+    BATCH_ITEMS_PER_TRANSACTION = 100
+
     def __init__(self, config, database):
         self.config = config
         self.collection_id = None
         self.collection = None
         self.database = database
+        self.json_codec = get_codec(config.json_codec)
+        # filename -> set of item numbers that are already stored, and should be skipped. See
+        # DataBase.get_stored_item_numbers.
+        self.stored_item_numbers = {}
+        # Set by _group_transactions
+        self.transaction_group = None
 
     def load_collection(self, collection_source, collection_data_version, collection_sample):
         self.collection_id = self.database.get_or_create_collection_id(
@@ -60,40 +104,71 @@ class Store:
     def store_file_item_errors(self, filename, number, url, errors):
         self.database.store_collection_file_item_errors(self.collection_id, filename, number, url, errors)
 
-    def store_file_from_local(self, filename, url, data_type, encoding, local_filename):
+    def mark_file_store_done(self, filename, warnings=None):
+        self.database.mark_collection_file_store_done(self.collection_id, filename, warnings=warnings)
 
-        with FileToStore(local_filename, encoding=encoding) as file_to_store:
+    def is_item_stored(self, filename, number):
+        return number in self.stored_item_numbers.get(filename, ())
 
-            if data_type == 'release_package_json_lines' or data_type == 'record_package_json_lines'\
-                    or data_type == 'release_in_Release_json_lines':
-                try:
-                    with open(file_to_store.get_filename(), encoding=encoding) as f:
-                        number = 0
-                        raw_data = f.readline()
-                        while raw_data:
-                            json_data = json.loads(raw_data)
+    def store_file_from_local(self, filename, url, data_type, encoding, local_filename, compression=None):
+        """Stores a local file. A compressed file (see util.COMPRESSIONS) is decompressed as it is read; its
+        compression is detected, unless given."""
+
+        with FileToStore(local_filename, encoding=encoding, compression=compression) as file_to_store:
+            self._store_file(filename, url, data_type, encoding, file_to_store)
+
+    def store_file_from_stream(self, filename, url, data_type, encoding, fileobj, compression=None):
+        """Like store_file_from_local, but reads a binary file object, like an upload or a request body, as is.
+
+        If the file object isn't seekable, it can only be read once, so a file that isn't JSON Lines is read into
+        memory."""
+
+        with FileToStore(None, encoding=encoding, fileobj=fileobj, compression=compression) as file_to_store:
+            self._store_file(filename, url, data_type, encoding, file_to_store)
+
+    def _store_file(self, filename, url, data_type, encoding, file_to_store):
+
+        if data_type not in self.MULTIPLE_ITEM_DATA_TYPES and self.is_item_stored(filename, 0):
+            return
+
+        if data_type == 'release_package_json_lines' or data_type == 'record_package_json_lines'\
+                or data_type == 'release_in_Release_json_lines':
+            if self._can_map(encoding, file_to_store):
+                self._store_json_lines_mapped(filename, url, data_type, encoding, file_to_store)
+                return
+
+            try:
+                with io.TextIOWrapper(file_to_store.open(), encoding=encoding) as f, \
+                        self._group_transactions():
+                    number = 0
+                    raw_data = f.readline()
+                    while raw_data:
+                        if not self.is_item_stored(filename, number):
+                            json_data = self.json_codec.loads(raw_data)
                             if data_type == 'release_in_Release_json_lines':
                                 json_data = json_data['Release']
                             self.store_file_item(filename, url, data_type, json_data, number)
-                            raw_data = f.readline()
-                            number += 1
-                except Exception as e:
-                    raise e
-                    # TODO Store error in database and make nice HTTP response!
+                        raw_data = f.readline()
+                        number += 1
+            except Exception as e:
+                raise e
+                # TODO Store error in database and make nice HTTP response!
 
-                self.database.mark_collection_file_store_done(self.collection_id, filename,
-                                                              warnings=file_to_store.get_warnings())
+            self.mark_file_store_done(filename, warnings=file_to_store.get_warnings())
 
-            else:
-                try:
-                    with open(file_to_store.get_filename(), encoding=encoding) as f:
-                        data = json.load(f)
+        elif self._can_stream(data_type, encoding, file_to_store):
+            self._store_file_from_local_streamed(filename, url, data_type, file_to_store)
 
-                except Exception as e:
-                    self.database.store_collection_file_errors(self.collection_id, filename, url, [repr(e)])
-                    return
+        else:
+            try:
+                with io.TextIOWrapper(file_to_store.open(), encoding=encoding) as f:
+                    data = self.json_codec.loads(f.read())
 
-                self.store_file_from_data(filename, url, data_type, data, file_warnings=file_to_store.get_warnings())
+            except Exception as e:
+                self.database.store_collection_file_errors(self.collection_id, filename, url, [repr(e)])
+                return
+
+            self.store_file_from_data(filename, url, data_type, data, file_warnings=file_to_store.get_warnings())
 
     def store_file_from_data(self, filename, url, data_type, data, file_warnings=None):
 
@@ -111,24 +186,151 @@ class Store:
         else:
             objects_list.append(data)
 
-        number = 0
-        for item_data in objects_list:
+        self._store_file_items(filename, url, data_type, objects_list, file_warnings=file_warnings)
+
+    def _store_file_items(self, filename, url, data_type, objects, file_warnings=None):
 
+        with self._group_transactions():
+            number = 0
+            for item_data in objects:
+
+                try:
+                    self.store_file_item(filename, url, data_type, item_data, number)
+                    number += 1
+
+                except Exception as e:
+                    raise e
+                    # TODO Store error in database and make nice HTTP response!
+
+        self.mark_file_store_done(filename, warnings=file_warnings)
+
+    def group_item_transactions(self):
+        """Returns a context manager, inside which items from any files share transactions, like a batch of items
+        submitted to the web API. Each item has a savepoint, so if store_file_item raises an exception, the other items
+        are still stored.
+
+        Item errors should only be stored after leaving the context manager, as until then the items' collection_file
+        rows may not be committed."""
+        return self._group_transactions(
+            max(self.config.store_items_per_transaction, self.BATCH_ITEMS_PER_TRANSACTION), savepoints=True)
+
+    @contextlib.contextmanager
+    def _group_transactions(self, items_per_transaction=None, savepoints=False):
+        # Items stored inside this share transactions. See store_items_per_transaction.
+        if items_per_transaction is None:
+            items_per_transaction = self.config.store_items_per_transaction
+        if items_per_transaction <= 1 or self.transaction_group:
+            yield
+            return
+
+        with DatabaseStoreGroup(self.database, items_per_transaction, savepoints=savepoints) as group:
+            self.transaction_group = group
             try:
-                self.store_file_item(filename, url, data_type, item_data, number)
-                number += 1
+                yield
+            finally:
+                self.transaction_group = None
+
+    def _can_stream(self, data_type, encoding, file_to_store):
+        # Small files are quicker to load all at once. Streaming reads the file twice, so it must be seekable.
+        if data_type not in self.STREAMABLE_DATA_TYPES or encoding.lower().replace('-', '') != 'utf8' or \
+                self.config.store_stream_min_file_size <= 0:
+            return False
+        size = file_to_store.get_size()
+        return size is not None and size >= self.config.store_stream_min_file_size
+
+    def _can_map(self, encoding, file_to_store):
+        # Lines are found by their new line bytes, so the encoding must have no other bytes that look like them.
+        if not file_to_store.can_map() or encoding.lower().replace('-', '') != 'utf8' or \
+                self.config.store_mmap_min_file_size <= 0:
+            return False
+        return file_to_store.get_size() >= self.config.store_mmap_min_file_size
+
+    def _store_json_lines_mapped(self, filename, url, data_type, encoding, file_to_store):
+        """Like the JSON Lines case of _store_file, but reads the lines from a memory map of the file, so that only
+        each line is copied and decoded, and control codes are only looked for in lines if the file has any."""
+        warnings = []
+        with file_to_store.open_mapped() as buffer, self._group_transactions():
+            sanitize = has_control_codes(buffer)
+            for number, raw_data in enumerate(iter_lines(buffer)):
+                if not self.is_item_stored(filename, number):
+                    if sanitize:
+                        raw_data = remove_control_codes(raw_data, warnings)
+                    json_data = self.json_codec.loads(raw_data.decode(encoding))
+                    if data_type == 'release_in_Release_json_lines':
+                        json_data = json_data['Release']
+                    self.store_file_item(filename, url, data_type, json_data, number)
+
+        self.mark_file_store_done(filename, warnings=warnings)
+
+    def _store_file_from_local_streamed(self, filename, url, data_type, file_to_store):
+        """Like store_file_from_data, but parses the file incrementally, so that only one item (or, for packages,
+        one release or record) is in memory at a time.
+
+        The file is read twice: first to check it is valid JSON and to get the package metadata, then to store it."""
+
+        if data_type in ('release_package', 'record_package'):
+            skip_keys = ('releases', 'records')
+        elif data_type == 'release_package_list' or data_type == 'record_package_list' \
+                or data_type == 'release_list' or data_type == 'record_list':
+            skip_keys = ()
+        else:
+            skip_keys = ('results',)
 
-            except Exception as e:
-                raise e
-                # TODO Store error in database and make nice HTTP response!
+        try:
+            with file_to_store.open() as f:
+                top_level = json_stream.get_top_level(f, skip_keys=skip_keys)
+        except Exception as e:
+            self.database.store_collection_file_errors(self.collection_id, filename, url, [repr(e)])
+            return
+
+        if data_type in ('release_package', 'record_package'):
+            if not isinstance(top_level, dict):
+                raise Exception("Can not process data as JSON is not an object")
+            key = 'releases' if data_type == 'release_package' else 'records'
+            if key not in top_level:
+                raise Exception("{} list not found".format(key[:-1].capitalize()))
+            elif top_level[key] != 'start_array':
+                raise Exception("{} list which is not a list found".format(key[:-1].capitalize()))
+            package_data = {k: v for k, v in top_level.items() if k not in skip_keys}
+            self._store_rows(filename, url, 0, self._get_rows_streamed(data_type, file_to_store, package_data))
+            self.mark_file_store_done(filename, warnings=file_to_store.get_warnings())
+            return
+
+        if skip_keys:
+            if not isinstance(top_level, dict):
+                raise Exception("Can not process data as JSON is not an object")
+            if 'results' not in top_level:
+                raise KeyError('results')
+            prefix = 'results.item'
+        else:
+            if isinstance(top_level, dict):
+                raise Exception("Can not process data as JSON is not an object")
+            prefix = 'item'
+
+        self._store_file_items(filename, url, data_type, self._get_items_streamed(data_type, file_to_store, prefix),
+                               file_warnings=file_to_store.get_warnings())
+
+    def _get_items_streamed(self, data_type, file_to_store, prefix):
+        with file_to_store.open() as f:
+            for item_data in json_stream.items(f, prefix):
+                if data_type == 'release_package_in_ocdsReleasePackage_in_list_in_results':
+                    item_data = item_data['ocdsReleasePackage']
+                yield item_data
+
+    def _get_rows_streamed(self, data_type, file_to_store, package_data):
+        row_type = self._get_row_type(data_type)
+        with file_to_store.open() as f:
+            for row in json_stream.items(f, 'records.item' if row_type == 'record' else 'releases.item'):
+                if not isinstance(row, dict):
+                    raise Exception("Row in data is not a object")
 
-        self.database.mark_collection_file_store_done(self.collection_id, filename, warnings=file_warnings)
+                yield row_type, row, package_data
 
     def store_file_item_from_local(self, filename, url, data_type, encoding, number, local_filename):
 
         try:
             with open(local_filename, encoding=encoding) as f:
-                data = json.load(f)
+                data = self.json_codec.loads(f.read())
 
         except Exception as e:
             raise e
@@ -144,57 +346,91 @@ class Store:
     def store_file_item(self, filename, url, data_type, json_data, number,
                         before_db_transaction_ends_callback=None, warnings=None):
 
+        if self.is_item_stored(filename, number):
+            return
+
         if not isinstance(json_data, dict):
             raise Exception("Can not process data as JSON is not an object")
 
+        kwargs = {'before_db_transaction_ends_callback': before_db_transaction_ends_callback, 'warnings': warnings}
+        try:
+            self._store_rows(filename, url, number, self._get_rows(data_type, json_data), **kwargs)
+        except sa.exc.IntegrityError as e:
+            # A cached ID might be of a data or package_data row that another process has since deleted as orphan
+            # data. DatabaseStore has cleared the caches, so the item is stored once more, if only it was rolled back.
+            if getattr(e.orig, 'pgcode', None) != FOREIGN_KEY_VIOLATION or \
+                    (self.transaction_group and not self.transaction_group.savepoints):
+                raise
+            self._store_rows(filename, url, number, self._get_rows(data_type, json_data), **kwargs)
+
+    def _store_rows(self, filename, url, number, rows, before_db_transaction_ends_callback=None, warnings=None):
+        """Stores an item, given an iterable of (row_type, row, package_data) tuples."""
+
         with DatabaseStore(database=self.database, collection_id=self.collection_id, file_name=filename, number=number,
                            url=url, before_db_transaction_ends_callback=before_db_transaction_ends_callback,
-                           warnings=warnings) as store:
-
-            if data_type == 'release' or data_type == 'record' or data_type == 'compiled_release' or \
-                            data_type == 'release_list' or data_type == 'record_list' \
-                    or data_type == 'release_in_Release_json_lines':
-                data_list = [json_data]
-            elif data_type == 'release_package' or \
-                    data_type == 'release_package_json_lines' or \
-                    data_type == 'release_package_list_in_results' or \
-                    data_type == 'release_package_in_ocdsReleasePackage_in_list_in_results' or \
-                    data_type == 'release_package_list':
-                if 'releases' not in json_data:
-                    raise Exception("Release list not found")
-                elif not isinstance(json_data['releases'], list):
-                    raise Exception("Release list which is not a list found")
-                data_list = json_data['releases']
-            elif data_type == 'record_package' or \
-                    data_type == 'record_package_json_lines' or \
-                    data_type == 'record_package_list_in_results' or \
-                    data_type == 'record_package_list':
-                if 'records' not in json_data:
-                    raise Exception("Record list not found")
-                elif not isinstance(json_data['records'], list):
-                    raise Exception("Record list which is not a list found")
-                data_list = json_data['records']
-            else:
-                raise Exception("data_type not a known type")
-
-            package_data = {}
-            if not data_type == 'release' and not data_type == 'compiled_release' and not data_type == 'release_list':
-                for key, value in json_data.items():
-                    if key not in ('releases', 'records'):
-                        package_data[key] = value
-
-            for row in data_list:
-                if not isinstance(row, dict):
-                    raise Exception("Row in data is not a object")
+                           warnings=warnings, batch_size=self.config.store_batch_size,
+                           group=self.transaction_group, known_new_file=number == 0) as store:
 
-                if data_type == 'compiled_release':
+            for row_type, row, package_data in rows:
+                if row_type == 'compiled_release':
                     store.insert_compiled_release(row)
-                elif data_type == 'record' or \
-                        data_type == 'record_package' or \
-                        data_type == 'record_package_json_lines' or \
-                        data_type == 'record_package_list_in_results' or \
-                        data_type == 'record_package_list' or \
-                        data_type == 'record_list':
+                elif row_type == 'record':
                     store.insert_record(row, package_data)
                 else:
                     store.insert_release(row, package_data)
+
+    def _get_rows(self, data_type, json_data):
+        """Yields a (row_type, row, package_data) tuple for each release, record or compiled release in an item."""
+
+        if data_type == 'release' or data_type == 'record' or data_type == 'compiled_release' or \
+                        data_type == 'release_list' or data_type == 'record_list' \
+                or data_type == 'release_in_Release_json_lines':
+            data_list = [json_data]
+        elif data_type == 'release_package' or \
+                data_type == 'release_package_json_lines' or \
+                data_type == 'release_package_list_in_results' or \
+                data_type == 'release_package_in_ocdsReleasePackage_in_list_in_results' or \
+                data_type == 'release_package_list':
+            if 'releases' not in json_data:
+                raise Exception("Release list not found")
+            elif not isinstance(json_data['releases'], list):
+                raise Exception("Release list which is not a list found")
+            data_list = json_data['releases']
+        elif data_type == 'record_package' or \
+                data_type == 'record_package_json_lines' or \
+                data_type == 'record_package_list_in_results' or \
+                data_type == 'record_package_list':
+            if 'records' not in json_data:
+                raise Exception("Record list not found")
+            elif not isinstance(json_data['records'], list):
+                raise Exception("Record list which is not a list found")
+            data_list = json_data['records']
+        else:
+            raise Exception("data_type not a known type")
+
+        package_data = {}
+        if not data_type == 'release' and not data_type == 'compiled_release' and not data_type == 'release_list':
+            for key, value in json_data.items():
+                if key not in ('releases', 'records'):
+                    package_data[key] = value
+
+        row_type = self._get_row_type(data_type)
+
+        for row in data_list:
+            if not isinstance(row, dict):
+                raise Exception("Row in data is not a object")
+
+            yield row_type, row, package_data
+
+    def _get_row_type(self, data_type):
+        if data_type == 'compiled_release':
+            return 'compiled_release'
+        elif data_type == 'record' or \
+                data_type == 'record_package' or \
+                data_type == 'record_package_json_lines' or \
+                data_type == 'record_package_list_in_results' or \
+                data_type == 'record_package_list' or \
+                data_type == 'record_list':
+            return 'record'
+        else:
+            return 'release'
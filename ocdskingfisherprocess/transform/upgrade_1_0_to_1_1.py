@@ -1,3 +1,4 @@
+import collections
 import datetime
 
 import sqlalchemy as sa
@@ -7,6 +8,15 @@ from ocdskingfisherprocess.database import DatabaseStore
 from ocdskingfisherprocess.transform.base import BaseTransform
 
 
+def _to_ordered_dicts(value):
+    # ocdskit's upgrade needs OrderedDicts, but the database returns plain dicts.
+    if isinstance(value, dict):
+        return collections.OrderedDict((k, _to_ordered_dicts(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_to_ordered_dicts(v) for v in value]
+    return value
+
+
 class Upgrade10To11Transform(BaseTransform):
 
     def process(self):
@@ -44,12 +54,12 @@ class Upgrade10To11Transform(BaseTransform):
         with self.database.get_engine().begin() as connection:
             release_rows = connection.execute(
                 self.database.release_table.select().where(
-                    self.database.release_table.c.collection_file_item_id == file_item_model.database_id)
+                    (self.database.release_table.c.collection_id == self.source_collection.database_id) &
+                    (self.database.release_table.c.collection_file_item_id == file_item_model.database_id))
             )
 
-        for release_row in release_rows:
-            if not self.has_release_id_been_done(release_row['id']):
-                self.process_release_row(file_model, file_item_model, release_row)
+        for release_rows_batch in self._batches(release_rows, self.has_release_id_been_done):
+            self.process_release_rows(file_model, file_item_model, release_rows_batch)
             # Early return?
             if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
                 return
@@ -59,59 +69,82 @@ class Upgrade10To11Transform(BaseTransform):
         with self.database.get_engine().begin() as connection:
             record_rows = connection.execute(
                 self.database.record_table.select().where(
-                    self.database.record_table.c.collection_file_item_id == file_item_model.database_id)
+                    (self.database.record_table.c.collection_id == self.source_collection.database_id) &
+                    (self.database.record_table.c.collection_file_item_id == file_item_model.database_id))
             )
 
-        for record_row in record_rows:
-            if not self.has_record_id_been_done(record_row['id']):
-                self.process_record_row(file_model, file_item_model, record_row)
+        for record_rows_batch in self._batches(record_rows, self.has_record_id_been_done):
+            self.process_record_rows(file_model, file_item_model, record_rows_batch)
             # Early return?
             if self.run_until_timestamp and self.run_until_timestamp < datetime.datetime.utcnow().timestamp():
                 return
 
-    def process_release_row(self, file_model, file_item_model, release_row):
-        package = self.database.get_package_data(release_row.package_data_id)
-        package['releases'] = [self.database.get_data(release_row.data_id)]
-        package = upgrade_10_11(package)
+    def _batches(self, rows, has_id_been_done):
+        # Each batch of rows is stored in one transaction, so that DatabaseStore looks up and inserts its data and
+        # package data together.
+        batch_size = max(self.database.config.store_batch_size, 1)
+        batch = []
+        for row in rows:
+            if not has_id_been_done(row['id']):
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def _upgrade(self, rows, key):
+        # Rows from the same file item usually share package data, so each is read once.
+        package_data_by_id = {}
+        out = []
+        for row in rows:
+            if row.package_data_id not in package_data_by_id:
+                package_data_by_id[row.package_data_id] = self.database.get_package_data(row.package_data_id)
+            package = dict(package_data_by_id[row.package_data_id])
+            package[key] = [self.database.get_data(row.data_id)]
+            package = upgrade_10_11(_to_ordered_dicts(package))
+
+            package_data = {}
+            for k, value in package.items():
+                if k != key:
+                    package_data[k] = value
+
+            out.append((package[key][0], package_data))
+        return out
+
+    def process_release_rows(self, file_model, file_item_model, release_rows):
+        releases = self._upgrade(release_rows, 'releases')
 
         def add_status(database, connection):
-            connection.execute(database.transform_upgrade_1_0_to_1_1_status_release_table.insert(), {
-                'source_release_id': release_row.id,
-            })
-
-        package_data = {}
-        for key, value in package.items():
-            if key != 'releases':
-                package_data[key] = value
+            connection.execute(database.transform_upgrade_1_0_to_1_1_status_release_table.insert(), [
+                {'source_release_id': release_row.id} for release_row in release_rows
+            ])
 
         with DatabaseStore(database=self.database, collection_id=self.destination_collection.database_id,
                            file_name=file_model.filename, number=file_item_model.number,
                            url=file_model.url, before_db_transaction_ends_callback=add_status,
-                           allow_existing_collection_file_item_table_row=True) as store:
+                           allow_existing_collection_file_item_table_row=True,
+                           batch_size=self.database.config.store_batch_size) as store:
 
-            store.insert_release(package['releases'][0], package_data)
+            for release, package_data in releases:
+                store.insert_release(release, package_data)
 
-    def process_record_row(self, file_model, file_item_model, record_row):
-        package = self.database.get_package_data(record_row.package_data_id)
-        package['records'] = [self.database.get_data(record_row.data_id)]
-        package = upgrade_10_11(package)
+    def process_record_rows(self, file_model, file_item_model, record_rows):
+        records = self._upgrade(record_rows, 'records')
 
         def add_status(database, connection):
-            connection.execute(database.transform_upgrade_1_0_to_1_1_status_record_table.insert(), {
-                'source_record_id': record_row.id,
-            })
-
-        package_data = {}
-        for key, value in package.items():
-            if key != 'records':
-                package_data[key] = value
+            connection.execute(database.transform_upgrade_1_0_to_1_1_status_record_table.insert(), [
+                {'source_record_id': record_row.id} for record_row in record_rows
+            ])
 
         with DatabaseStore(database=self.database, collection_id=self.destination_collection.database_id,
                            file_name=file_model.filename, number=file_item_model.number,
                            url=file_model.url, before_db_transaction_ends_callback=add_status,
-                           allow_existing_collection_file_item_table_row=True) as store:
+                           allow_existing_collection_file_item_table_row=True,
+                           batch_size=self.database.config.store_batch_size) as store:
 
-            store.insert_record(package['records'][0], package_data)
+            for record, package_data in records:
+                store.insert_record(record, package_data)
 
     def has_release_id_been_done(self, release_id):
         with self.database.get_engine().begin() as connection:
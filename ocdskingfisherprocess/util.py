@@ -1,13 +1,71 @@
+import bz2
+import collections
+import contextlib
 import datetime
+import gzip
 import hashlib
+import io
 import json
+import lzma
+import mmap
 import os
+import re
+import shutil
 import tempfile
+import threading
+
+import zstandard
 
 
 def get_hash_md5_for_data(data):
-    data_str = json.dumps(data, sort_keys=True)
-    return hashlib.md5(data_str.encode('utf-8')).hexdigest()
+    return get_json_and_hash_md5_for_data(data)[1]
+
+
+# The same output as json.dumps(data, sort_keys=True), which the hashes in the database are of. json.dumps would create
+# a new encoder on every call.
+_canonical_json_encoder = json.JSONEncoder(sort_keys=True)
+
+
+def get_json_and_hash_md5_for_data(data):
+    # The JSON string is returned too, so callers that need to send the data to the database can reuse it, instead of
+    # serializing it again.
+    data_str = _canonical_json_encoder.encode(data)
+    return data_str, hashlib.md5(data_str.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """A thread-safe dict with at most size keys. When it is full, the least recently used key is removed."""
+
+    def __init__(self, size):
+        self.size = size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def remove_keys(self, test):
+        with self._lock:
+            for key in [key for key in self._data if test(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
 
 
 control_codes_to_filter_out = [
@@ -53,55 +111,293 @@ def control_code_to_filter_out_to_human_readable(control_code_to_filter_out):
         return str(control_code_to_filter_out)
 
 
+# Control codes that are a single byte can be removed with bytes.translate, which is much quicker than replace.
+_single_byte_control_codes_to_filter_out = b''.join(c for c in control_codes_to_filter_out if len(c) == 1)
+_single_byte_control_codes_regex = re.compile(b'[' + re.escape(_single_byte_control_codes_to_filter_out) + b']')
+_multi_byte_control_codes_to_filter_out = [c for c in control_codes_to_filter_out if len(c) > 1]
+
+
+def remove_control_codes(data, warnings):
+    """Returns bytes with control_codes_to_filter_out removed. A warning is added to the warnings list the first time
+    each control code is found."""
+    found = []
+    for control_code_to_filter_out in _multi_byte_control_codes_to_filter_out:
+        if control_code_to_filter_out in data:
+            data = data.replace(control_code_to_filter_out, b'')
+            found.append(control_code_to_filter_out)
+    sanitized = data.translate(None, _single_byte_control_codes_to_filter_out)
+    if len(sanitized) != len(data):
+        found.extend(set(_single_byte_control_codes_regex.findall(data)))
+
+    for control_code_to_filter_out in sorted(found, key=control_codes_to_filter_out.index):
+        warning = 'We had to replace control codes: ' \
+                  + control_code_to_filter_out_to_human_readable(control_code_to_filter_out)
+        if warning not in warnings:
+            warnings.append(warning)
+
+    return sanitized
+
+
+def has_control_codes(buffer, start=0, end=None):
+    """Returns whether a bytes-like object (like a memory map) contains any of control_codes_to_filter_out between two
+    offsets. It is searched without being copied."""
+    if end is None:
+        end = len(buffer)
+    return bool(_single_byte_control_codes_regex.search(buffer, start, end)) or \
+        any(buffer.find(control_code, start, end) != -1 for control_code in _multi_byte_control_codes_to_filter_out)
+
+
+@contextlib.contextmanager
+def open_mapped(filename):
+    """Yields a read-only memory map of a file. An empty file can't be mapped, so empty bytes are yielded instead."""
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            # Python 3.8+. The file is read in order, so the kernel can read ahead and drop pages that were read.
+            if hasattr(buffer, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                buffer.madvise(mmap.MADV_SEQUENTIAL)
+            yield buffer
+
+
+def iter_lines(buffer, start=0, end=None):
+    """Yields the lines of a bytes-like object (like a memory map) between two offsets, like readline would. Only each
+    line is copied."""
+    if end is None:
+        end = len(buffer)
+    while start < end:
+        position = buffer.find(b'\n', start, end)
+        position = end if position == -1 else position + 1
+        yield buffer[start:position]
+        start = position
+
+
+class SanitizingReader(io.RawIOBase):
+    """A binary file object that reads from another binary file object, removing control_codes_to_filter_out.
+
+    A warning is added to the warnings list the first time each control code is found. If close_raw is false, closing
+    this doesn't close the other file object."""
+
+    CHUNK_SIZE = 1024 ** 2
+
+    def __init__(self, raw, warnings=None, close_raw=True):
+        self.raw = raw
+        self.warnings = warnings if warnings is not None else []
+        self.close_raw = close_raw
+        # Bytes at the end of the last chunk that might be the start of a control code, that continues in the next
+        self.pending = b''
+        # Sanitized bytes that have not been read yet
+        self.buffer = b''
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.eof:
+            self._fill()
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        if self.close_raw:
+            self.raw.close()
+        super().close()
+
+    def _fill(self):
+        chunk = self.raw.read(self.CHUNK_SIZE)
+        data = self.pending + chunk
+        self.pending = b''
+        if chunk:
+            for control_code_to_filter_out in _multi_byte_control_codes_to_filter_out:
+                for length in range(len(control_code_to_filter_out) - 1, 0, -1):
+                    if data.endswith(control_code_to_filter_out[:length]):
+                        self.pending = data[-length:]
+                        data = data[:-length]
+                        break
+                if self.pending:
+                    break
+        else:
+            self.eof = True
+
+        self.buffer = remove_control_codes(data, self.warnings)
+
+
+# The bytes that compressed files start with.
+COMPRESSION_MAGIC_NUMBERS = collections.OrderedDict([
+    ('gzip', b'\x1f\x8b'),
+    ('bz2', b'BZh'),
+    ('xz', b'\xfd7zXZ\x00'),
+    ('zstd', b'\x28\xb5\x2f\xfd'),
+])
+
+COMPRESSION_MAGIC_NUMBER_SIZE = max(len(magic_number) for magic_number in COMPRESSION_MAGIC_NUMBERS.values())
+
+# 'none' turns off detection, for files that are known not to be compressed.
+COMPRESSIONS = list(COMPRESSION_MAGIC_NUMBERS) + ['none']
+
+
+def get_compression_from_magic_number(data):
+    """Returns the compression of a file that starts with these bytes, or None if it isn't compressed."""
+    for compression, magic_number in COMPRESSION_MAGIC_NUMBERS.items():
+        if data.startswith(magic_number):
+            return compression
+
+
+def open_decompressed(source, compression):
+    """Returns a binary file object that decompresses a file, from a filename or a binary file object. The file is
+    decompressed as it is read. If a file object is given, closing the returned file object doesn't close it."""
+    if compression == 'gzip':
+        return gzip.open(source, 'rb')
+    if compression == 'bz2':
+        return bz2.open(source, 'rb')
+    if compression == 'xz':
+        return lzma.open(source, 'rb')
+    if compression == 'zstd':
+        if isinstance(source, str):
+            return zstandard.ZstdDecompressor().stream_reader(open(source, 'rb'), read_across_frames=True)
+        return zstandard.ZstdDecompressor().stream_reader(source, read_across_frames=True, closefd=False)
+    raise Exception("Compression not known: {}".format(compression))
+
+
+class PrefixedReader(io.RawIOBase):
+    """A binary file object that reads some bytes, and then the rest of another binary file object. Used to put back
+    bytes that were read from a file object that isn't seekable."""
+
+    def __init__(self, prefix, raw):
+        self.prefix = prefix
+        self.raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.prefix:
+            data = self.prefix[:len(b)]
+            self.prefix = self.prefix[len(data):]
+        else:
+            data = self.raw.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
 class FileToStore:
+    """A file to store, from a filename or, if source_filename is None, a binary file object (like a request body).
 
-    def __init__(self, source_filename, encoding='utf-8'):
+    A file object is read as is, without copying it. If it isn't seekable, it can only be opened once.
+
+    A compressed file is decompressed as it is read. Its compression is detected from its first bytes, unless one of
+    COMPRESSIONS is given."""
+
+    def __init__(self, source_filename, encoding='utf-8', fileobj=None, compression=None):
         # The original filename
         self.source_filename = source_filename
-        # IF we have to process the file, store the temporary file name here. It must be removed after use.
+        self.fileobj = fileobj
+        self.opened = False
+        self.compression = compression or None
+        # The first bytes of a file object that isn't seekable, read to detect its compression
+        self.head = None
+        # IF get_filename has to process the file, store the temporary file name here. It must be removed after use.
         self.processed_filename = None
         self.warnings = []
         # We don't actually do anything with encoding yet, but we might need to later ...
         self.encoding = encoding
 
     def __enter__(self):
-        if self._have_to_process_file():
-            (fp_write, fn_write) = tempfile.mkstemp(prefix='tmp_kingfisher_process_')
+        return self
 
-            with open(self.source_filename, 'rb') as fp_read:
-                while True:
-                    chunk = fp_read.read(1024 ^ 2)
-                    if not chunk:
-                        break
-                    for control_code_to_filter_out in control_codes_to_filter_out:
-                        if control_code_to_filter_out in chunk:
-                            chunk = chunk.replace(control_code_to_filter_out, b'')
-                            warning = 'We had to replace control codes: ' \
-                                      + control_code_to_filter_out_to_human_readable(control_code_to_filter_out)
-                            if warning not in self.warnings:
-                                self.warnings.append(warning)
-                    os.write(fp_write, chunk)
-
-            os.close(fp_write)
-            self.processed_filename = fn_write
+    def open(self):
+        """Returns a binary file object of the file with control codes removed. Warnings are only complete once it has
+        been read to the end."""
+        compression = self.get_compression()
+        if self.fileobj is None:
+            source = self.source_filename
+        else:
+            if self.opened:
+                self.fileobj.seek(0)
+            source = self.fileobj
+            if self.head is not None:
+                source = PrefixedReader(self.head, source)
+                self.head = None
+        self.opened = True
 
-        return self
+        # A given file object is left open.
+        if compression:
+            raw = open_decompressed(source, compression)
+            close_raw = True
+        elif self.fileobj is None:
+            raw = open(source, 'rb')
+            close_raw = True
+        else:
+            raw = source
+            close_raw = False
+        return io.BufferedReader(SanitizingReader(raw, self.warnings, close_raw=close_raw),
+                                 SanitizingReader.CHUNK_SIZE)
 
-    def _have_to_process_file(self):
-        with open(self.source_filename, 'rb') as fp_read:
-            while True:
-                chunk = fp_read.read(1024 ^ 2)
-                if not chunk:
-                    break
-                for control_code_to_filter_out in control_codes_to_filter_out:
-                    if control_code_to_filter_out in chunk:
-                        return True
-        return False
+    def get_compression(self):
+        """Returns the file's compression, or None if it isn't compressed."""
+        if self.compression is None:
+            if self.fileobj is None:
+                with open(self.source_filename, 'rb') as f:
+                    head = f.read(COMPRESSION_MAGIC_NUMBER_SIZE)
+            elif self.is_seekable():
+                position = self.fileobj.tell()
+                head = self.fileobj.read(COMPRESSION_MAGIC_NUMBER_SIZE)
+                self.fileobj.seek(position)
+            else:
+                self.head = head = self.fileobj.read(COMPRESSION_MAGIC_NUMBER_SIZE)
+            self.compression = get_compression_from_magic_number(head) or 'none'
+        if self.compression != 'none':
+            return self.compression
+
+    def is_seekable(self):
+        if self.fileobj is None:
+            return True
+        try:
+            return self.fileobj.seekable()
+        except AttributeError:
+            # eg. tempfile.SpooledTemporaryFile before Python 3.11, which werkzeug uses for uploads
+            return hasattr(self.fileobj, 'seek')
+
+    def can_map(self):
+        """Returns whether the file can be read with open_mapped: that is, it is a local file that isn't compressed."""
+        return self.fileobj is None and not self.get_compression()
+
+    def open_mapped(self):
+        """Returns a context manager for a read-only memory map of the file, like open_mapped. Control codes are not
+        removed."""
+        return open_mapped(self.source_filename)
+
+    def get_size(self):
+        """Returns the size of the file in bytes (compressed, if it is compressed), or None if it isn't seekable."""
+        if self.fileobj is None:
+            return os.path.getsize(self.source_filename)
+        if self.is_seekable():
+            position = self.fileobj.tell()
+            self.fileobj.seek(0, io.SEEK_END)
+            size = self.fileobj.tell()
+            self.fileobj.seek(position)
+            return size
 
     def get_filename(self):
+        """Returns the name of a file with control codes removed. If there are any, this is a temporary copy, so
+        prefer open."""
         if self.processed_filename:
             return self.processed_filename
+
+        (fp_write, fn_write) = tempfile.mkstemp(prefix='tmp_kingfisher_process_')
+        with os.fdopen(fp_write, 'wb') as f_write, self.open() as f_read:
+            shutil.copyfileobj(f_read, f_write, SanitizingReader.CHUNK_SIZE)
+
+        if self.source_filename is None or self.get_compression() or \
+                os.path.getsize(fn_write) != os.path.getsize(self.source_filename):
+            self.processed_filename = fn_write
+            return self.processed_filename
         else:
+            os.remove(fn_write)
             return self.source_filename
 
     def get_warnings(self):
@@ -59,8 +59,12 @@ def create_app(config=None):
                      view_func=views_api_v1.SubmitFileView.as_view('api_v1_submit_file'))
     app.add_url_rule('/api/v1/submit/item/',
                      view_func=views_api_v1.SubmitItemView.as_view('api_v1_submit_item'))
+    app.add_url_rule('/api/v1/submit/items/',
+                     view_func=views_api_v1.SubmitItemsView.as_view('api_v1_submit_items'))
     app.add_url_rule('/api/v1/submit/file_errors/',
                      view_func=views_api_v1.SubmitFileErrorsView.as_view('api_v1_submit_file_errors'))
+    app.add_url_rule('/api/v1/job/<int:ingest_job_id>',
+                     view_func=views_api_v1.JobView.as_view('api_v1_job'))
 
     return app
 
@@ -102,5 +106,5 @@ def prometheus_index():
 
 
 def prometheus_metrics():
-    update_all_prometheus_stats(current_app.kingfisher_config)
+    update_all_prometheus_stats(current_app.kingfisher_config, current_app.kingfisher_database)
     return Response(generate_latest(), content_type="text/plain")
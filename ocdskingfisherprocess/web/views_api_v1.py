@@ -1,11 +1,20 @@
-import json
 import os
+import shutil
 import tempfile
 
-from flask import current_app, request, views
+from flask import Response, current_app, request, url_for, views
 
+from ocdskingfisherprocess.jsoncodec import get_codec
 from ocdskingfisherprocess.store import Store
-from ocdskingfisherprocess.util import parse_string_to_boolean, parse_string_to_date_time
+from ocdskingfisherprocess.util import (COMPRESSIONS, parse_string_to_boolean, parse_string_to_date_time,
+                                        remove_control_codes)
+
+# The HTTP Content-Encoding values of request bodies that can be decompressed, and their compressions.
+CONTENT_ENCODINGS = {
+    'gzip': 'gzip',
+    'x-gzip': 'gzip',
+    'zstd': 'zstd',
+}
 
 
 class RootV1View(views.View):
@@ -20,22 +29,25 @@ class BaseAPIViewAuthAndCollectionNeeded(views.View):
         api_key = request.headers.get('Authorization', '')[len('ApiKey '):]
         return api_key and api_key in current_app.kingfisher_config.web_api_keys
 
-    def _load_collection_variables(self, request):
+    def _load_collection_variables(self, request, values=None):
+        # The values are read from the form, unless other values (like the query string) are passed.
+        if values is None:
+            values = request.form
 
         # get source, test
-        self.collection_source = request.form.get('collection_source')
+        self.collection_source = values.get('collection_source')
 
         if not self.collection_source:
             return False
 
         # get data_version, test
-        self.collection_data_version = parse_string_to_date_time(request.form.get('collection_data_version'))
+        self.collection_data_version = parse_string_to_date_time(values.get('collection_data_version'))
 
         if not self.collection_data_version:
             return False
 
         # get sample (No test because if it's not there it is read as False and that's fine)
-        self.collection_sample = parse_string_to_boolean(request.form.get('collection_sample', False))
+        self.collection_sample = parse_string_to_boolean(values.get('collection_sample', False))
 
         # all passed so ...
         return True
@@ -72,13 +84,25 @@ class SubmitEndCollectionStoreView(BaseAPIViewAuthAndCollectionNeeded):
 
 
 class SubmitFileView(BaseAPIViewAuthAndCollectionNeeded):
+    """Stores a file. The file is either uploaded as multipart form data, with the other fields in the form, or sent as
+    the request body, with the other fields in the query string. Either way, it is parsed as it is read, without first
+    being saved to a temporary file."""
     methods = ['POST']
 
     def dispatch_request(self):
         if not self._check_authorization(request):
             return "ACCESS DENIED", 401
 
-        if not self._load_collection_variables(request):
+        # If the file is the request body, don't read the body to look for form fields.
+        raw_body = request.mimetype not in ('multipart/form-data', 'application/x-www-form-urlencoded')
+        values = request.args if raw_body else request.form
+
+        # A compressed request body is decompressed as it is read. A compressed form can't be parsed.
+        content_encoding = request.headers.get('Content-Encoding', 'identity').lower()
+        if content_encoding != 'identity' and (not raw_body or content_encoding not in CONTENT_ENCODINGS):
+            return "CONTENT ENCODING NOT SUPPORTED", 415
+
+        if not self._load_collection_variables(request, values):
             return "COLLECTION FIELDS NOT SPECIFIED", 400
 
         # TODO check all required fields are there!
@@ -93,23 +117,35 @@ class SubmitFileView(BaseAPIViewAuthAndCollectionNeeded):
 
         current_app.kingfisher_web_logger.info("Submit File API V1 called for collection " + str(store.collection_id))
 
-        store.add_collection_note(request.form.get('collection_note'))
+        store.add_collection_note(values.get('collection_note'))
 
-        file_filename = request.form.get('file_name', '')
-        file_url = request.form.get('url', '')
-        file_data_type = request.form.get('data_type')
-        file_encoding = request.form.get('encoding', 'utf-8')
+        file_filename = values.get('file_name', '')
+        file_url = values.get('url', '')
+        file_data_type = values.get('data_type')
+        file_encoding = values.get('encoding', 'utf-8')
+        file_compression = CONTENT_ENCODINGS.get(content_encoding) or values.get('compression')
+
+        if file_compression and file_compression not in COMPRESSIONS:
+            return "COMPRESSION NOT SUPPORTED", 400
 
-        if 'file' in request.files:
+        if 'async' in values:
+            queue_file = parse_string_to_boolean(values.get('async'))
+        else:
+            queue_file = current_app.kingfisher_config.web_async_file_store
+
+        if queue_file:
+            return self._queue_file(store, raw_body, file_filename, file_url, file_data_type, file_encoding,
+                                    file_compression)
 
-            (tmp_file, tmp_filename) = tempfile.mkstemp(prefix="ocdskf-")
-            os.close(tmp_file)
+        if raw_body:
 
-            request.files['file'].save(tmp_filename)
+            store.store_file_from_stream(file_filename, file_url, file_data_type, file_encoding, request.stream,
+                                         compression=file_compression)
 
-            store.store_file_from_local(file_filename, file_url, file_data_type, file_encoding, tmp_filename)
+        elif 'file' in request.files:
 
-            os.remove(tmp_filename)
+            store.store_file_from_stream(file_filename, file_url, file_data_type, file_encoding,
+                                         request.files['file'].stream, compression=file_compression)
 
         elif 'local_file_name' in request.form:
 
@@ -118,7 +154,8 @@ class SubmitFileView(BaseAPIViewAuthAndCollectionNeeded):
                 file_url,
                 file_data_type,
                 file_encoding,
-                request.form.get('local_file_name')
+                request.form.get('local_file_name'),
+                compression=file_compression
             )
 
         else:
@@ -127,6 +164,36 @@ class SubmitFileView(BaseAPIViewAuthAndCollectionNeeded):
 
         return "OCDS Kingfisher APIs V1 Submit"
 
+    def _queue_file(self, store, raw_body, file_filename, file_url, file_data_type, file_encoding, file_compression):
+        # The file is stored by the process-ingest-jobs command, so an upload is saved where it can read it. A
+        # compressed file is saved as is, and is decompressed when it is stored.
+        if raw_body or 'file' in request.files:
+
+            (tmp_file, tmp_filename) = tempfile.mkstemp(prefix="ocdskf-",
+                                                        dir=current_app.kingfisher_config.web_upload_directory or None)
+
+            with os.fdopen(tmp_file, 'wb') as f:
+                shutil.copyfileobj(request.stream if raw_body else request.files['file'].stream, f)
+
+            ingest_job_id = store.database.create_ingest_job(store.collection_id, file_filename, file_url,
+                                                             file_data_type, file_encoding, tmp_filename, True,
+                                                             compression=file_compression)
+
+        elif 'local_file_name' in request.form:
+
+            ingest_job_id = store.database.create_ingest_job(store.collection_id, file_filename, file_url,
+                                                             file_data_type, file_encoding,
+                                                             request.form.get('local_file_name'), False,
+                                                             compression=file_compression)
+
+        else:
+
+            raise Exception('Did not send file data')
+
+        url = url_for('api_v1_job', ingest_job_id=ingest_job_id)
+        body = get_codec(current_app.kingfisher_config.json_codec).dumps({'job_id': ingest_job_id, 'url': url})
+        return Response(body, status=202, mimetype='application/json', headers={'Location': url})
+
 
 class SubmitItemView(BaseAPIViewAuthAndCollectionNeeded):
     methods = ['POST']
@@ -157,7 +224,7 @@ class SubmitItemView(BaseAPIViewAuthAndCollectionNeeded):
         file_data_type = request.form.get('data_type')
         item_number = int(request.form.get('number'))
 
-        data = json.loads(request.form.get('data'))
+        data = get_codec(current_app.kingfisher_config.json_codec).loads(request.form.get('data'))
 
         try:
             store.store_file_item(
@@ -173,6 +240,82 @@ class SubmitItemView(BaseAPIViewAuthAndCollectionNeeded):
         return "OCDS Kingfisher APIs V1 Submit"
 
 
+class SubmitItemsView(BaseAPIViewAuthAndCollectionNeeded):
+    """Stores many items, from any files in a collection. The collection fields are in the query string, and the body
+    is JSON Lines, each line an object with file_name, url, data_type, number and data (an object, or a JSON string).
+
+    Responds with a JSON array with the result of each line, in order."""
+    methods = ['POST']
+
+    def dispatch_request(self):
+        if not self._check_authorization(request):
+            return "ACCESS DENIED", 401
+
+        if not self._load_collection_variables(request, request.args):
+            return "COLLECTION FIELDS NOT SPECIFIED", 400
+
+        store = Store(config=current_app.kingfisher_config, database=current_app.kingfisher_database)
+
+        store.load_collection(
+            self.collection_source,
+            self.collection_data_version,
+            self.collection_sample,
+        )
+
+        current_app.kingfisher_web_logger.info("Submit Items API V1 called for collection " + str(store.collection_id))
+
+        store.add_collection_note(request.args.get('collection_note'))
+
+        codec = get_codec(current_app.kingfisher_config.json_codec)
+        results = []
+        item_errors = []
+
+        with store.group_item_transactions():
+            for line in request.stream:
+                if not line.strip():
+                    continue
+
+                warnings = []
+                try:
+                    item = codec.loads(remove_control_codes(line, warnings).decode('utf-8'))
+                    file_filename = item.get('file_name', '')
+                    file_url = item.get('url', '')
+                    item_number = int(item['number'])
+                except Exception as e:
+                    results.append({'stored': False, 'errors': [str(e)]})
+                    continue
+
+                result = {'file_name': file_filename, 'number': item_number}
+                try:
+                    data = item['data']
+                    if isinstance(data, str):
+                        data = codec.loads(data)
+                    store.store_file_item(file_filename, file_url, item.get('data_type'), data, item_number,
+                                          warnings=warnings)
+                    result['stored'] = True
+                except Exception as e:
+                    result['stored'] = False
+                    result['errors'] = [str(e)]
+                    item_errors.append((file_filename, item_number, file_url, result))
+                results.append(result)
+
+        # Only now are the files' rows committed. An item that is already stored (like if a batch is submitted again)
+        # only has its error in the results.
+        stored_item_numbers = {}
+        if item_errors:
+            stored_item_numbers = store.database.get_stored_item_numbers(
+                store.collection_id, {file_filename for file_filename, _, _, _ in item_errors})
+        for file_filename, item_number, file_url, result in item_errors:
+            if item_number in stored_item_numbers.get(file_filename, ()):
+                continue
+            try:
+                store.store_file_item_errors(file_filename, item_number, file_url, list(result['errors']))
+            except Exception as e:
+                result['errors'].append(str(e))
+
+        return Response(codec.dumps(results), mimetype='application/json')
+
+
 class SubmitFileErrorsView(BaseAPIViewAuthAndCollectionNeeded):
     methods = ['POST']
 
@@ -198,9 +341,43 @@ class SubmitFileErrorsView(BaseAPIViewAuthAndCollectionNeeded):
 
         file_filename = request.form.get('file_name', '')
         file_errors_raw = request.form.get('errors')
-        file_errors = json.loads(file_errors_raw)
+        file_errors = get_codec(current_app.kingfisher_config.json_codec).loads(file_errors_raw)
         file_url = request.form.get('url', '')
 
         store.store_file_errors(file_filename, file_url, file_errors)
 
         return "OCDS Kingfisher APIs V1 Submit"
+
+
+class JobView(BaseAPIViewAuthAndCollectionNeeded):
+    methods = ['GET']
+
+    def dispatch_request(self, ingest_job_id):
+        if not self._check_authorization(request):
+            return "ACCESS DENIED", 401
+
+        ingest_job = current_app.kingfisher_database.get_ingest_job(ingest_job_id)
+        if not ingest_job:
+            return "JOB NOT FOUND", 404
+
+        body = get_codec(current_app.kingfisher_config.json_codec).dumps({
+            'job_id': ingest_job.database_id,
+            'collection_id': ingest_job.collection_id,
+            'file_name': ingest_job.filename,
+            'url': ingest_job.url,
+            'data_type': ingest_job.data_type,
+            'status': ingest_job.status,
+            'errors': ingest_job.errors,
+            'created_at': _format_date_time(ingest_job.created_at),
+            'started_at': _format_date_time(ingest_job.started_at),
+            'ended_at': _format_date_time(ingest_job.ended_at),
+            'items_stored': ingest_job.items_stored,
+            'items_with_errors': ingest_job.items_with_errors,
+            'file_errors': ingest_job.file_errors,
+        })
+        return Response(body, mimetype='application/json')
+
+
+def _format_date_time(value):
+    if value:
+        return value.isoformat()
@@ -39,6 +39,10 @@ class BaseDataBaseTest:
         _reset_signals()
         setup_signals(self.config, self.database)
 
+    def teardown_method(self, test_method):
+        # Close pooled connections, so tests don't run out.
+        self.database.get_engine().dispose()
+
 
 class BaseWebTest:
 
@@ -61,3 +65,8 @@ class BaseWebTest:
         self.webapp = create_app(config=self.config)
         self.webapp.config['TESTING'] = True
         self.flaskclient = self.webapp.test_client()
+
+    def teardown_method(self, test_method):
+        # Close pooled connections, so tests don't run out.
+        self.database.get_engine().dispose()
+        self.webapp.kingfisher_database.get_engine().dispose()
@@ -0,0 +1,42 @@
+import os
+import tempfile
+
+import pytest
+
+from ocdskingfisherprocess.bloom_filter import BloomFilter
+from ocdskingfisherprocess.util import get_hash_md5_for_data
+
+
+def test_bloom_filter():
+    bloom_filter = BloomFilter(1000, 0.01)
+    added = [get_hash_md5_for_data({'id': i}) for i in range(1000)]
+    for hash_md5 in added:
+        bloom_filter.add(hash_md5)
+
+    # No false negatives
+    assert all(hash_md5 in bloom_filter for hash_md5 in added)
+
+    # About 1% false positives
+    false_positives = sum(get_hash_md5_for_data({'id': i}) in bloom_filter for i in range(1000, 11000))
+    assert false_positives < 200
+
+
+def test_save_and_load():
+    bloom_filter = BloomFilter(100)
+    bloom_filter.add(get_hash_md5_for_data({'id': 1}))
+    bloom_filter.max_data_id = 7
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'filter')
+        bloom_filter.save(filename)
+        loaded = BloomFilter.load(filename)
+
+        assert get_hash_md5_for_data({'id': 1}) in loaded
+        assert 7 == loaded.max_data_id
+        assert bloom_filter.num_bits == loaded.num_bits
+        assert bloom_filter.num_hashes == loaded.num_hashes
+
+        with open(filename, 'wb') as f:
+            f.write(b'not a filter')
+        with pytest.raises(Exception):
+            BloomFilter.load(filename)
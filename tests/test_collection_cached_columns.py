@@ -1,5 +1,6 @@
 import datetime
 import os
+import threading
 
 import sqlalchemy as sa
 
@@ -117,3 +118,89 @@ class TestCollectionCachedColums(BaseDataBaseTest):
             data = result.fetchone()
             assert 0 == data['cached_releases_count']
             assert 1 == data['cached_compiled_releases_count']
+
+    def test_incremental(self):
+        # Make collection
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+        assert 0 == collection.releases_count
+
+        # Load some data
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        # The counts are current before they are updated.
+        collection = self.database.get_collection(collection_id)
+        assert 6 == collection.releases_count
+        assert 0 == collection.records_count
+
+        # test
+        self.database.update_collection_cached_columns(collection_id)
+
+        # check
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_table])
+            data = connection.execute(s).fetchone()
+            assert 6 == data['cached_releases_count']
+
+            s = sa.sql.select([self.database.collection_count_delta_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+            # Make the cached value wrong.
+            connection.execute(self.database.collection_table.update().values(cached_releases_count=1))
+
+        # test
+        self.database.update_collection_cached_columns(collection_id, recount=True)
+
+        # check
+        assert 6 == self.database.get_collection(collection_id).releases_count
+
+    def test_fold_while_storing(self):
+        self.database.COLLECTION_COUNT_DELTA_FOLD_SIZE = 2
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        for number in range(3):
+            store.store_file_item("test.json", "http://example.com", "release_package",
+                                  {"releases": [{"ocid": "a"}, {"ocid": "b"}]}, number)
+
+        # The counts of the first 2 items are added to the cached columns, and the third's isn't yet.
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_table])
+            assert 4 == connection.execute(s).fetchone()['cached_releases_count']
+
+            s = sa.sql.select([self.database.collection_count_delta_table])
+            assert 1 == connection.execute(s).rowcount
+
+        assert 6 == self.database.get_collection(collection_id).releases_count
+
+    def test_concurrent_store(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+
+        # A transaction that is storing rows in the collection holds a key share lock on the collection's row.
+        connection = self.database.get_engine().connect()
+        transaction = connection.begin()
+        self.database.add_collection_count_delta(connection, collection_id, {'release': 1})
+
+        # test
+        thread = threading.Thread(target=self.database.update_collection_cached_columns, args=(collection_id,))
+        thread.start()
+        thread.join(5)
+        try:
+            # check
+            assert not thread.is_alive()
+        finally:
+            transaction.commit()
+            connection.close()
+            thread.join()
+
+        self.database.update_collection_cached_columns(collection_id)
+        assert 1 == self.database.get_collection(collection_id).releases_count
@@ -0,0 +1,53 @@
+import sqlalchemy as sa
+
+from ocdskingfisherprocess import prometheus
+from ocdskingfisherprocess.database import TimedQueuePool
+from tests.base import BaseDataBaseTest
+
+
+class TestDataBasePool(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.database_pool_size = 2
+        self.config.database_pool_max_overflow = 1
+        self.config.database_pool_timeout = 0.1
+        self.config.database_pool_recycle = 1800
+
+    def test_pool(self):
+        self.database.get_engine().dispose()
+        pool = self.database.get_engine().pool
+        assert isinstance(pool, TimedQueuePool)
+        assert pool.size() == 2
+        assert pool._recycle == 1800
+
+        timeouts = prometheus.PROMETHEUS_DB_POOL_CHECKOUT_TIMEOUTS._value.get()
+        connections = [self.database.get_engine().connect() for _ in range(3)]
+        try:
+            assert self.database.get_pool_status() == {
+                'size': 2,
+                'checked_out': 3,
+                'overflow': 1,
+                'saturation': 1,
+            }
+
+            try:
+                self.database.get_engine().connect()
+                assert False
+            except sa.exc.TimeoutError:
+                pass
+            assert prometheus.PROMETHEUS_DB_POOL_CHECKOUT_TIMEOUTS._value.get() == timeouts + 1
+        finally:
+            for connection in connections:
+                connection.close()
+
+        assert self.database.get_pool_status()['checked_out'] == 0
+
+
+class TestDataBasePoolPgBouncer(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.database_pgbouncer = True
+
+    def test_pool(self):
+        assert isinstance(self.database.get_engine().pool, sa.pool.NullPool)
+        assert self.database.get_pool_status() is None
@@ -1,8 +1,11 @@
 import datetime
 import os
+from unittest import mock
 
+import pytest
 import sqlalchemy as sa
 
+from ocdskingfisherprocess.database import DataBase
 from ocdskingfisherprocess.store import Store
 from ocdskingfisherprocess.transform import TRANSFORM_TYPE_UPGRADE_1_0_TO_1_1
 from ocdskingfisherprocess.transform.upgrade_1_0_to_1_1 import Upgrade10To11Transform
@@ -188,3 +191,182 @@ class TestDelete(BaseDataBaseTest):
             s = sa.sql.select([self.database.package_data_table])
             result = connection.execute(s)
             assert 0 == result.rowcount
+
+    def test_partitions(self):
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        partitions = self.database.get_collection_partitions(collection_id)
+        assert ('record', 'record_collection_{}'.format(collection_id)) in partitions
+        assert ('release_check', 'release_check_collection_{}'.format(collection_id)) in partitions
+        assert 7 == len(partitions)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_record.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "record", "utf-8", json_filename)
+
+        # The rows are in the collection's partition.
+        with self.database.get_engine().begin() as connection:
+            result = connection.execute("SELECT count(*) FROM record_collection_{}".format(collection_id))
+            assert 1 == result.scalar()
+
+            result = connection.execute("SELECT count(*) FROM record_default")
+            assert 0 == result.scalar()
+
+        # Delete
+        self.database.mark_collection_deleted_at(collection_id)
+        self.database.delete_collection(collection_id)
+
+        assert [] == self.database.get_collection_partitions(collection_id)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+    def test_partitions_missing(self):
+        # As if the process that created the collection failed to create a partition.
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime(2020, 1, 1), False)
+        with self.database.get_engine().begin() as connection:
+            connection.execute("DROP TABLE record_check_error_collection_{}".format(collection_id))
+        assert 6 == len(self.database.get_collection_partitions(collection_id))
+
+        database = DataBase(self.config)
+        assert collection_id == database.get_or_create_collection_id("test", datetime.datetime(2020, 1, 1), False)
+        assert 7 == len(self.database.get_collection_partitions(collection_id))
+
+    @mock.patch('time.sleep')
+    def test_partitions_lock_timeout(self, sleep):
+        self.database.PARTITION_LOCK_TIMEOUT = '10ms'
+        self.database.PARTITION_LOCK_ATTEMPTS = 2
+
+        # Another transaction holds a lock on a partitioned table.
+        connection = self.database.get_engine().connect()
+        transaction = connection.begin()
+        connection.execute("LOCK TABLE compiled_release IN ACCESS EXCLUSIVE MODE")
+        try:
+            with pytest.raises(sa.exc.OperationalError):
+                self.database.get_or_create_collection_id("test", datetime.datetime(2020, 1, 1), False)
+        finally:
+            transaction.rollback()
+            connection.close()
+
+        assert 1 == sleep.call_count
+        collection_id = self.database.get_collection_id("test", datetime.datetime(2020, 1, 1), False)
+        assert ['record', 'release'] == sorted(table for table, _ in
+                                               self.database.get_collection_partitions(collection_id))
+
+        # The other partitions are created when the collection is next used.
+        assert collection_id == self.database.get_or_create_collection_id("test", datetime.datetime(2020, 1, 1), False)
+        assert 7 == len(self.database.get_collection_partitions(collection_id))
+
+    def test_resume(self):
+        self.config.delete_batch_size = 1
+        self.config.delete_sleep = 0.001
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_record.json'
+        )
+        store.store_file_from_local("test1.json", "http://example.com", "record", "utf-8", json_filename)
+        store.store_file_from_local("test2.json", "http://example.com", "record", "utf-8", json_filename)
+
+        # Interrupt the delete after its first batch.
+        with mock.patch('ocdskingfisherprocess.collection_deleter.time.sleep', side_effect=Exception('interrupted')):
+            with pytest.raises(Exception):
+                self.database.delete_collection(collection_id)
+
+        progress = self.database.get_collection_delete_progress()
+        assert 1 == progress['collections']
+        assert 1 == progress['rows_deleted']
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_item_table])
+            result = connection.execute(s)
+            assert 1 == result.rowcount
+
+            s = sa.sql.select([self.database.collection_delete_progress_table]) \
+                .where(self.database.collection_delete_progress_table.c.table_name == 'collection_file_item')
+            result = connection.execute(s).fetchone()
+            assert not result['done']
+            assert 1 == result['rows_deleted']
+
+        # Resume
+        self.database.delete_collection(collection_id)
+
+        progress = self.database.get_collection_delete_progress()
+        assert 0 == progress['collections']
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+            s = sa.sql.select([self.database.collection_file_item_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+            s = sa.sql.select([self.database.collection_delete_progress_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+    def test_orphan_candidates(self):
+
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_record.json'
+        )
+
+        # Two collections with the same data
+        collection_ids = []
+        for source_id in ("test1", "test2"):
+            collection_id = self.database.get_or_create_collection_id(source_id, datetime.datetime.now(), False)
+            collection_ids.append(collection_id)
+
+            store = Store(self.config, self.database)
+            store.set_collection(self.database.get_collection(collection_id))
+            store.store_file_from_local("test.json", "http://example.com", "record", "utf-8", json_filename)
+
+        # Delete one
+        self.database.mark_collection_deleted_at(collection_ids[0])
+        self.database.delete_collection(collection_ids[0])
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.orphan_candidate_table])
+            result = connection.execute(s)
+            assert [('data', 1), ('package_data', 1)] == sorted(result.fetchall())
+
+        # The data is still used, so it is kept.
+        self.database.delete_orphan_data()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.orphan_candidate_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+            s = sa.sql.select([self.database.data_table])
+            result = connection.execute(s)
+            assert 1 == result.rowcount
+
+        # Delete the other
+        self.database.mark_collection_deleted_at(collection_ids[1])
+        self.database.delete_collection(collection_ids[1])
+        self.database.delete_orphan_data()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.data_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+            s = sa.sql.select([self.database.package_data_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from ocdskingfisherprocess.jsoncodec import CODECS, StdlibCodec, get_codec
+from ocdskingfisherprocess.util import get_json_and_hash_md5_for_data
+
+
+@pytest.mark.parametrize('name', CODECS.keys())
+def test_codec(name):
+    codec = get_codec(name)
+    data = {'a': [1, 1.5, None, True, 'café'], 'b': {'c': 2 ** 70}}
+
+    assert data == codec.loads(StdlibCodec().dumps(data))
+    assert data == StdlibCodec().loads(codec.dumps(data))
+    assert [1] == codec.loads(codec.dumps({1}))
+
+
+@pytest.mark.parametrize('name', CODECS.keys())
+def test_codec_big_integer(name):
+    codec = get_codec(name)
+    for value in (18446744073709551615, 123456789012345678901234567890, -123456789012345678901234567890,
+                  -9999999999999999999, -9223372036854775809):
+        s = '{"v": ' + str(value) + '}'
+
+        assert {'v': value} == codec.loads(s)
+        assert {'v': value} == codec.loads(s.encode('utf-8'))
+        assert get_json_and_hash_md5_for_data(codec.loads(s)) == get_json_and_hash_md5_for_data(json.loads(s))
+
+
+def test_codec_invalid_json():
+    for name in CODECS:
+        with pytest.raises(ValueError):
+            get_codec(name).loads('{')
+
+
+def test_codec_unknown():
+    with pytest.raises(Exception):
+        get_codec('unknown')
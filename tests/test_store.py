@@ -0,0 +1,842 @@
+import bz2
+import datetime
+import gzip
+import json
+import lzma
+import os
+import tempfile
+from unittest import mock
+
+import pytest
+import sqlalchemy as sa
+import zstandard
+
+from ocdskingfisherprocess import parallel_json_lines
+from ocdskingfisherprocess.bulk_store import BulkStore
+from ocdskingfisherprocess.database import DataBase, DatabaseStore
+from ocdskingfisherprocess.id_cache import RedisIdCache
+from ocdskingfisherprocess.signals import KINGFISHER_SIGNALS
+from ocdskingfisherprocess.store import Store
+from ocdskingfisherprocess.util import get_hash_md5_for_data
+from tests.base import BaseDataBaseTest
+
+COMPRESS = {
+    'gzip': gzip.compress,
+    'bz2': bz2.compress,
+    'xz': lzma.compress,
+    'zstd': zstandard.ZstdCompressor().compress,
+}
+
+
+class TestStoreBatched(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.store_batch_size = 4
+
+    def _store_releases(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+        # Store the same data again in another file, to check it is not duplicated in the data tables
+        store.store_file_from_local("test2.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+    def _get_fixture(self):
+        with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures',
+                               'sample_1_1_releases_multiple_with_same_ocid.json')) as f:
+            return json.load(f)
+
+    def test_releases(self):
+        self._store_releases()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_item_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+
+            s = sa.sql.select([self.database.release_table]).order_by(self.database.release_table.c.id)
+            result = connection.execute(s)
+            assert 12 == result.rowcount
+            rows = result.fetchall()
+            release_ids = [row['release_id'] for row in rows]
+            assert 'ocds-213czf-000-00001-01-planning' == release_ids[0]
+            assert 'ocds-213czf-000-00001-06-implementation' == release_ids[5]
+            assert release_ids[:6] == release_ids[6:]
+            assert self._get_fixture()['releases'][0] == self.database.get_data(rows[0]['data_id'])
+
+            s = sa.sql.select([self.database.data_table])
+            result = connection.execute(s)
+            assert 6 == result.rowcount
+
+            s = sa.sql.select([self.database.package_data_table])
+            result = connection.execute(s)
+            assert 1 == result.rowcount
+
+    def test_flush_error(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        engine = self.database.get_engine()
+
+        with mock.patch.object(DatabaseStore, 'flush', side_effect=sa.exc.DBAPIError('', {}, Exception())):
+            with pytest.raises(sa.exc.DBAPIError):
+                with DatabaseStore(self.database, collection_id, "test.json", 0, batch_size=4):
+                    pass
+
+        # The connection is returned to the pool.
+        assert 0 == engine.pool.checkedout()
+
+
+class TestStoreNotBatched(TestStoreBatched):
+
+    def alter_config(self):
+        self.config.store_batch_size = 0
+
+
+class TestBulkStore(BaseDataBaseTest):
+
+    def test_releases_and_records(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        # A small flush_rows, so items are split over several flushes
+        store = BulkStore(self.config, self.database, flush_rows=4)
+        store.set_collection(collection)
+        fixtures = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'fixtures')
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8",
+                                    os.path.join(fixtures, 'sample_1_1_releases_multiple_with_same_ocid.json'))
+        store.store_file_from_local("test2.json", "http://example.com", "release_package", "utf-8",
+                                    os.path.join(fixtures, 'sample_1_1_releases_multiple_with_same_ocid.json'))
+        store.store_file_from_local("test3.json", "http://example.com", "record", "utf-8",
+                                    os.path.join(fixtures, 'sample_1_0_record_with_control_codes.json'))
+        store.flush()
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_table]) \
+                .order_by(self.database.collection_file_table.c.id)
+            result = connection.execute(s)
+            assert 3 == result.rowcount
+            files = result.fetchall()
+            assert ['test.json', 'test2.json', 'test3.json'] == [f['filename'] for f in files]
+            assert files[0]['warnings'] is None
+            assert ['We had to replace control codes: chr(16)'] == files[2]['warnings']
+            assert all(f['store_end_at'] for f in files)
+
+            s = sa.sql.select([self.database.collection_file_item_table])
+            result = connection.execute(s)
+            assert 3 == result.rowcount
+
+            s = sa.sql.select([self.database.release_table]).order_by(self.database.release_table.c.id)
+            result = connection.execute(s)
+            assert 12 == result.rowcount
+            release_ids = [row['release_id'] for row in result]
+            assert 'ocds-213czf-000-00001-01-planning' == release_ids[0]
+            assert release_ids[:6] == release_ids[6:]
+
+            s = sa.sql.select([self.database.record_table])
+            result = connection.execute(s)
+            assert 1 == result.rowcount
+
+            s = sa.sql.select([self.database.data_table])
+            result = connection.execute(s)
+            assert 7 == result.rowcount
+
+            s = sa.sql.select([self.database.package_data_table])
+            result = connection.execute(s)
+            assert 2 == result.rowcount
+
+        collection = self.database.get_collection(collection_id)
+        assert 12 == collection.releases_count
+        assert 1 == collection.records_count
+
+
+class TestStoreStreamed(BaseDataBaseTest):
+
+    def alter_config(self):
+        # Stream every file
+        self.config.store_stream_min_file_size = 1
+
+    def _get_store(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        return store
+
+    def _get_data(self):
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        with open(json_filename) as f:
+            data = json.load(f)
+        # Non-integer numbers must be stored (and hashed) as they would be if the file were not streamed.
+        data['releases'][0]['tender']['value'] = {'amount': 1.5, 'currency': 'GBP'}
+        return data
+
+    def _store(self, data_type, data):
+        store = self._get_store()
+        fd, json_filename = tempfile.mkstemp(prefix='ocdskf-test-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            store.store_file_from_local("test.json", "http://example.com", data_type, "utf-8", json_filename)
+        finally:
+            os.remove(json_filename)
+
+    def _assert_stored(self, data, items):
+        package_data = {k: v for k, v in data.items() if k != 'releases'}
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_table])
+            result = connection.execute(s)
+            assert 1 == result.rowcount
+
+            s = sa.sql.select([self.database.collection_file_item_table])
+            result = connection.execute(s)
+            assert items == result.rowcount
+
+            s = sa.sql.select([self.database.release_table, self.database.data_table.c.hash_md5]) \
+                .select_from(self.database.release_table.join(self.database.data_table)) \
+                .order_by(self.database.release_table.c.id)
+            result = connection.execute(s)
+            assert [get_hash_md5_for_data(release) for release in data['releases']] * items == \
+                [row['hash_md5'] for row in result]
+
+            s = sa.sql.select([self.database.package_data_table])
+            result = connection.execute(s)
+            assert [get_hash_md5_for_data(package_data)] == [row['hash_md5'] for row in result]
+
+    def test_release_package(self):
+        data = self._get_data()
+        self._store('release_package', data)
+        self._assert_stored(data, 1)
+
+    def test_release_package_list(self):
+        data = self._get_data()
+        self._store('release_package_list', [data, data])
+        self._assert_stored(data, 2)
+
+    def test_release_package_list_in_results(self):
+        data = self._get_data()
+        self._store('release_package_list_in_results', {'results': [data, data]})
+        self._assert_stored(data, 2)
+
+    def test_release_package_in_ocdsReleasePackage_in_list_in_results(self):
+        data = self._get_data()
+        self._store('release_package_in_ocdsReleasePackage_in_list_in_results',
+                    {'results': [{'ocdsReleasePackage': data}]})
+        self._assert_stored(data, 1)
+
+    def test_release_package_without_releases(self):
+        data = self._get_data()
+        del data['releases']
+        try:
+            self._store('release_package', data)
+            assert False
+        except Exception as e:
+            assert 'Release list not found' == str(e)
+
+    def test_invalid_json(self):
+        store = self._get_store()
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            f.write('{"releases": [')
+            f.flush()
+            store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", f.name)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_table])
+            result = connection.execute(s)
+            assert 1 == result.rowcount
+            assert 1 == len(result.fetchone()['errors'])
+
+            s = sa.sql.select([self.database.collection_file_item_table])
+            result = connection.execute(s)
+            assert 0 == result.rowcount
+
+
+class TestStoreCompressed(BaseDataBaseTest):
+
+    def _store(self, data_type, data, compression):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        store = Store(self.config, self.database)
+        store.set_collection(self.database.get_collection(collection_id))
+        with tempfile.NamedTemporaryFile('wb') as f:
+            f.write(COMPRESS[compression](data))
+            f.flush()
+            store.store_file_from_local("test.json", "http://example.com", data_type, "utf-8", f.name)
+
+    def _assert_stored(self, items):
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_table])
+            result = connection.execute(s)
+            row = result.fetchone()
+            assert row['errors'] is None
+            assert row['warnings'] == ['We had to replace control codes: chr(16)']
+
+            s = sa.sql.select([self.database.release_table])
+            result = connection.execute(s)
+            assert items == result.rowcount
+
+    @pytest.mark.parametrize('compression', COMPRESS.keys())
+    def test_release_package(self, compression):
+        self._store('release_package', b'{"releases": [{"ocid": "a\x10"}, {"ocid": "b"}]}', compression)
+        self._assert_stored(2)
+
+    @pytest.mark.parametrize('compression', COMPRESS.keys())
+    def test_release_package_json_lines(self, compression):
+        self._store('release_package_json_lines', b'{"releases": [{"ocid": "a\x10"}]}\n{"releases": [{"ocid": "b"}]}',
+                    compression)
+        self._assert_stored(2)
+
+    def test_streamed(self):
+        self.config.store_stream_min_file_size = 1
+        self._store('release_package', b'{"releases": [{"ocid": "a\x10"}, {"ocid": "b"}]}', 'gzip')
+        self._assert_stored(2)
+
+
+class TestCreateCollectionFiles(BaseDataBaseTest):
+
+    def test_create_collection_files(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        self.database.create_collection_files(collection_id, [("b.json", "file:/b.json"), ("a.json", "file:/a.json")])
+        # Creating them again does nothing
+        self.database.create_collection_files(collection_id, [("a.json", "file:/a.json")])
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            f.write('{"releases": [')
+            f.flush()
+            store.store_file_from_local("a.json", "file:/a.json", "release_package", "utf-8", f.name)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_table]) \
+                .order_by(self.database.collection_file_table.c.id)
+            files = connection.execute(s).fetchall()
+            assert ['b.json', 'a.json'] == [f['filename'] for f in files]
+            assert files[0]['errors'] is None
+            assert 1 == len(files[1]['errors'])
+
+
+class TestStoreResume(BaseDataBaseTest):
+
+    def test_resume(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        with open(json_filename) as f:
+            line = json.dumps(json.load(f)) + '\n'
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+        # As if the load stopped after 2 lines
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            f.write(line * 2)
+            f.flush()
+            store.store_file_from_local("test.jsonl", "http://example.com", "release_package_json_lines", "utf-8",
+                                        f.name)
+
+        assert {'test.json': {0}, 'test.jsonl': {0, 1}} == self.database.get_stored_item_numbers(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        store.stored_item_numbers = self.database.get_stored_item_numbers(collection_id)
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            f.write(line * 3)
+            f.flush()
+            store.store_file_from_local("test.jsonl", "http://example.com", "release_package_json_lines", "utf-8",
+                                        f.name)
+
+        assert {'test.json': {0}, 'test.jsonl': {0, 1, 2}} == self.database.get_stored_item_numbers(collection_id)
+
+    def test_stored_filenames(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        store = Store(self.config, self.database)
+        store.set_collection(self.database.get_collection(collection_id))
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            f.write('[{"ocid": "a"}, {"ocid": "b"}]')
+            f.flush()
+            store.store_file_from_local("test.json", "http://example.com", "release_list", "utf-8", f.name)
+        # As if the load stopped after the first item
+        store.store_file_item("test2.json", "http://example.com", "release", {"ocid": "a"}, 0)
+
+        assert {'test.json': {0, 1}, 'test2.json': {0}} == self.database.get_stored_item_numbers(collection_id)
+        assert {'test.json'} == self.database.get_stored_filenames(collection_id)
+
+
+class TestParallelJSONLines(BaseDataBaseTest):
+
+    def test_get_byte_ranges(self):
+        with tempfile.NamedTemporaryFile('wb') as f:
+            f.write(b'a\nbb\nccc\ndddd')
+            f.flush()
+            for number_of_ranges in range(1, 8):
+                byte_ranges = parallel_json_lines.get_byte_ranges(f.name, number_of_ranges)
+                assert 0 == byte_ranges[0][0]
+                assert 13 == byte_ranges[-1][1]
+                for (_, end), (start, _) in zip(byte_ranges, byte_ranges[1:]):
+                    assert end == start
+                    assert start in (2, 5, 9)
+
+    def test_store_file_from_local(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        store.stored_item_numbers = {'test.jsonl': {1}}
+        with tempfile.NamedTemporaryFile('wb', suffix='.json') as f:
+            for i in range(10):
+                release = {'ocid': 'ocds-213czf-{}'.format(i), 'id': str(i)}
+                f.write(json.dumps({'uri': 'http://example.com', 'releases': [release]}).encode('utf-8') + b'\n')
+            f.write(b'{"releases": [{"ocid": "ocds-213czf-10", "id": "\x1010"}]}')
+            f.flush()
+            parallel_json_lines.store_file_from_local(store, "test.jsonl", "http://example.com",
+                                                      "release_package_json_lines", "utf-8", f.name, 2)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_table])
+            result = connection.execute(s)
+            assert ['We had to replace control codes: chr(16)'] == result.fetchone()['warnings']
+
+            s = sa.sql.select([self.database.collection_file_item_table.c.number,
+                               self.database.release_table.c.ocid]) \
+                .select_from(self.database.release_table.join(self.database.collection_file_item_table)) \
+                .order_by(self.database.collection_file_item_table.c.number)
+            result = connection.execute(s)
+            assert [(i, 'ocds-213czf-{}'.format(i)) for i in range(11) if i != 1] == \
+                [(row['number'], row['ocid']) for row in result]
+
+
+class TestStoreItemsPerTransaction(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.store_items_per_transaction = 3
+
+    def test_json_lines(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+
+        signalled = []
+
+        def receiver(sender, collection_id=None, collection_file_item_id=None):
+            signalled.append(collection_file_item_id)
+
+        KINGFISHER_SIGNALS.signal('collection-data-store-finished').connect(receiver)
+        try:
+            with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+                for i in range(4):
+                    f.write(json.dumps({'releases': [{'ocid': 'ocds-213czf-{}'.format(i), 'id': str(i)}]}) + '\n')
+                f.write('{\n')
+                f.flush()
+                try:
+                    store.store_file_from_local("test.jsonl", "http://example.com", "release_package_json_lines",
+                                                "utf-8", f.name)
+                    assert False
+                except ValueError:
+                    pass
+        finally:
+            KINGFISHER_SIGNALS.signal('collection-data-store-finished').disconnect(receiver)
+
+        # The first transaction was committed, and the second rolled back.
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_item_table]) \
+                .order_by(self.database.collection_file_item_table.c.number)
+            result = connection.execute(s)
+            rows = result.fetchall()
+            assert [0, 1, 2] == [row['number'] for row in rows]
+            assert [row['id'] for row in rows] == signalled
+
+
+class TestStoreItemsPerTransactionMapped(TestStoreItemsPerTransaction):
+
+    def alter_config(self):
+        super().alter_config()
+        # Read every JSON Lines file from a memory map
+        self.config.store_mmap_min_file_size = 1
+
+
+class TestStoreMapped(BaseDataBaseTest):
+
+    def alter_config(self):
+        self.config.store_mmap_min_file_size = 1
+
+    def test_json_lines(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        store.stored_item_numbers = {'test.jsonl': {1}}
+        with tempfile.NamedTemporaryFile('wb', suffix='.json') as f:
+            for i in range(3):
+                f.write(json.dumps({'Release': {'ocid': 'ocds-213czf-{}'.format(i), 'id': str(i)}}).encode() + b'\n')
+            f.write(b'{"Release": {"ocid": "ocds-213czf-3", "id": "\x103"}}')
+            f.flush()
+            store.store_file_from_local("test.jsonl", "http://example.com", "release_in_Release_json_lines", "utf-8",
+                                        f.name)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_table])
+            result = connection.execute(s)
+            assert ['We had to replace control codes: chr(16)'] == result.fetchone()['warnings']
+
+            s = sa.sql.select([self.database.collection_file_item_table.c.number,
+                               self.database.release_table.c.release_id]) \
+                .select_from(self.database.release_table.join(self.database.collection_file_item_table)) \
+                .order_by(self.database.collection_file_item_table.c.number)
+            result = connection.execute(s)
+            assert [(0, '0'), (2, '2'), (3, '3')] == [(row['number'], row['release_id']) for row in result]
+
+
+class TestCollectionFileIdCache(BaseDataBaseTest):
+
+    def test_cache(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        with open(json_filename) as f:
+            data = json.load(f)
+
+        # If an item is rolled back, its new file is not cached.
+        with pytest.raises(Exception, match='Row in data is not a object'):
+            store.store_file_item("test.json", "http://example.com", "release_package", {'releases': [1]}, 0)
+        assert self.database.collection_file_ids.get((collection_id, "test.json")) is None
+
+        store.store_file_item("test.json", "http://example.com", "release_package", data, 0)
+        collection_file_id = self.database.collection_file_ids.get((collection_id, "test.json"))
+        assert collection_file_id
+        store.store_file_item("test.json", "http://example.com", "release_package", data, 1)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.collection_file_item_table.c.collection_file_id])
+            assert [collection_file_id, collection_file_id] == [row[0] for row in connection.execute(s)]
+
+        self.database.delete_collection(collection_id)
+        assert self.database.collection_file_ids.get((collection_id, "test.json")) is None
+
+
+class TestPackageDataIdCache(BaseDataBaseTest):
+
+    def test_cache(self):
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        collection = self.database.get_collection(collection_id)
+
+        store = Store(self.config, self.database)
+        store.set_collection(collection)
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        with open(json_filename) as f:
+            data = json.load(f)
+        package_data_hash_md5 = get_hash_md5_for_data({k: v for k, v in data.items() if k != 'releases'})
+
+        # If an item is rolled back, its new package data is not cached.
+        with pytest.raises(Exception, match='Row in data is not a object'):
+            store.store_file_item("test.json", "http://example.com", "release_package",
+                                  dict(data, releases=data['releases'] + [1]), 0)
+        assert self.database.package_data_ids.get(package_data_hash_md5) is None
+
+        store.store_file_item("test.json", "http://example.com", "release_package", data, 0)
+        package_data_id = self.database.package_data_ids.get(package_data_hash_md5)
+        assert package_data_id
+        store.store_file_item("test.json", "http://example.com", "release_package", data, 1)
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table.c.package_data_id])
+            assert [package_data_id] * 12 == [row[0] for row in connection.execute(s)]
+
+        self.database.delete_orphan_data()
+        assert self.database.package_data_ids.get(package_data_hash_md5) is None
+
+    def test_deleted_by_other_process(self):
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        with open(json_filename) as f:
+            data = json.load(f)
+        package_data_hash_md5 = get_hash_md5_for_data({k: v for k, v in data.items() if k != 'releases'})
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        store = Store(self.config, self.database)
+        store.set_collection(self.database.get_collection(collection_id))
+        store.store_file_item("test.json", "http://example.com", "release_package", data, 0)
+        assert self.database.package_data_ids.get(package_data_hash_md5)
+
+        # Another process deletes the collection and its package data, so this process's cached ID is stale.
+        other_database = DataBase(self.config)
+        other_database.mark_collection_deleted_at(collection_id)
+        other_database.delete_collection(collection_id)
+        other_database.delete_orphan_data()
+        other_database.get_engine().dispose()
+
+        # The same package data, with new data.
+        for release in data['releases']:
+            release['id'] += '-new'
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        store.set_collection(self.database.get_collection(collection_id))
+        store.store_file_item("test.json", "http://example.com", "release_package", data, 0)
+
+        # The item is stored again, after the caches are cleared.
+        package_data_id = self.database.package_data_ids.get(package_data_hash_md5)
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table.c.package_data_id])
+            assert [package_data_id] * 6 == [row[0] for row in connection.execute(s)]
+
+
+class TestDataIdCache(BaseDataBaseTest):
+
+    def test_deleted_by_other_process(self):
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        with open(json_filename) as f:
+            data = json.load(f)
+        data_hash_md5 = get_hash_md5_for_data(data['releases'][0])
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        store = Store(self.config, self.database)
+        store.set_collection(self.database.get_collection(collection_id))
+        store.store_file_item("test.json", "http://example.com", "release_package", data, 0)
+        assert self.database.data_ids.get(data_hash_md5)
+
+        # Another process deletes the collection and its data, so this process's cached IDs are stale.
+        other_database = DataBase(self.config)
+        other_database.mark_collection_deleted_at(collection_id)
+        other_database.delete_collection(collection_id)
+        other_database.delete_orphan_data()
+        other_database.get_engine().dispose()
+
+        # The same data, with new package data.
+        data['uri'] = 'http://example.com/new'
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        store.set_collection(self.database.get_collection(collection_id))
+        store.store_file_item("test.json", "http://example.com", "release_package", data, 0)
+
+        # The item is stored again, after the caches are cleared.
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table.c.data_id])
+            assert 6 == connection.execute(s).rowcount
+            assert self.database.data_ids.get(data_hash_md5) in [row[0] for row in connection.execute(s)]
+
+
+class TestGetIdsForDocuments(BaseDataBaseTest):
+
+    def test_get_ids_for_documents(self):
+        documents = [{'a': 1}, {'b': 2}, {'a': 1}]
+        ids = self.database.get_ids_for_documents(self.database.data_table, documents)
+        assert ids[0] == ids[2]
+        assert ids[0] != ids[1]
+
+        assert [ids[1], ids[0]] == self.database.get_ids_for_documents(self.database.data_table, [{'b': 2}, {'a': 1}])
+
+        # Existing and new documents together
+        with self.database.get_engine().begin() as connection:
+            ids2 = self.database.get_ids_for_documents(self.database.data_table, [{'c': 3}, {'a': 1}], connection)
+        assert ids[0] == ids2[1]
+        assert ids2[0] not in ids
+        assert {'c': 3} == self.database.get_data(ids2[0])
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.data_table])
+            assert 3 == connection.execute(s).rowcount
+
+
+class TestStoreWithDataHashFilter(TestStoreBatched):
+
+    def alter_config(self):
+        self.config.store_batch_size = 4
+        self.config.store_data_hash_filter = 'source'
+
+    def test_releases(self):
+        super().test_releases()
+
+        # The first file's data is new, and the second file's data is the same, so is in the local cache.
+        stats = self.database.data_hash_filter_stats
+        assert 6 == stats['lookups_saved']
+        assert 0 == stats['maybe']
+        assert 0 == stats['false_positives']
+        assert 0 == stats['conflicts']
+        assert 0 == self.database.get_data_hash_filter_false_positive_rate()
+
+    def test_other_source(self):
+        # Data stored by another source isn't in the filter, so fails to insert and is then looked up.
+        self.database.get_ids_for_documents(self.database.data_table, self._get_fixture()['releases'])
+
+        self._store_releases()
+
+        stats = self.database.data_hash_filter_stats
+        assert 6 == stats['lookups_saved']
+        assert 6 == stats['conflicts']
+        # No data was new.
+        assert self.database.get_data_hash_filter_false_positive_rate() is None
+
+    def test_global(self):
+        self.database.get_ids_for_documents(self.database.data_table, self._get_fixture()['releases'][:2])
+
+        with tempfile.TemporaryDirectory() as directory:
+            self.config.store_data_hash_filter = 'global'
+            self.config.store_data_hash_filter_snapshot = os.path.join(directory, 'filter')
+            self.database.save_data_hash_filter(self.config.store_data_hash_filter_snapshot)
+
+            # Data stored after the snapshot is added when it is loaded.
+            self.database.get_ids_for_documents(self.database.data_table, self._get_fixture()['releases'][2:3])
+
+            self._store_releases()
+
+        stats = self.database.data_hash_filter_stats
+        assert 3 == stats['lookups_saved']
+        assert 3 == stats['maybe']
+        assert 0 == stats['conflicts']
+
+
+class FakeRedis:
+    """Just enough of a Redis client for RedisIdCache."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None):
+        self.data[key] = str(value).encode()
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+
+class FakeRedisPipeline:
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def set(self, *args, **kwargs):
+        self.commands.append((args, kwargs))
+
+    def execute(self):
+        for args, kwargs in self.commands:
+            self.redis.set(*args, **kwargs)
+
+
+class TestRedisIdCache(BaseDataBaseTest):
+
+    def _use_id_cache(self, database, redis):
+        database.id_cache = RedisIdCache(self.config)
+        database.id_cache.redis = redis
+
+    def test_cache(self):
+        redis = FakeRedis()
+        self._use_id_cache(self.database, redis)
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        store = Store(self.config, self.database)
+        store.set_collection(self.database.get_collection(collection_id))
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_1_releases_multiple_with_same_ocid.json'
+        )
+        store.store_file_from_local("test.json", "http://example.com", "release_package", "utf-8", json_filename)
+
+        with self.database.get_engine().begin() as connection:
+            data_ids = {row['hash_md5']: row['id'] for row in connection.execute(
+                sa.sql.select([self.database.data_table.c.hash_md5, self.database.data_table.c.id]))}
+            package_data_ids = {row['hash_md5']: row['id'] for row in connection.execute(
+                sa.sql.select([self.database.package_data_table.c.hash_md5, self.database.package_data_table.c.id]))}
+        assert 6 == len(data_ids)
+
+        # Another process gets the IDs from Redis.
+        other_database = DataBase(self.config)
+        self._use_id_cache(other_database, redis)
+        other_database.check_id_cache_generation()
+        assert data_ids == other_database.get_cached_ids(self.database.data_table, list(data_ids))
+        assert package_data_ids == other_database.get_cached_ids(self.database.package_data_table,
+                                                                 list(package_data_ids))
+        assert 6 == len(other_database.data_ids)
+
+        # Deleted rows are removed from Redis, and other processes clear their local caches.
+        self.database.mark_collection_deleted_at(collection_id)
+        self.database.delete_collection(collection_id)
+        self.database.delete_orphan_data()
+        assert {} == other_database.id_cache.get_many('data', list(data_ids))
+        assert {} == other_database.id_cache.get_many('package_data', list(package_data_ids))
+        other_database.check_id_cache_generation()
+        assert 0 == len(other_database.data_ids)
+        assert {} == other_database.get_cached_ids(self.database.data_table, list(data_ids))
+
+    def test_stale(self):
+        redis = FakeRedis()
+        self._use_id_cache(self.database, redis)
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        release = {'ocid': 'ocds-213czf-000-00001', 'id': 'ocds-213czf-000-00001-01'}
+        hash_md5 = get_hash_md5_for_data(release)
+
+        # The data was deleted by another process, but its ID is still in Redis.
+        self.database.id_cache.set_many('data', {hash_md5: 999999})
+
+        with pytest.raises(sa.exc.IntegrityError):
+            with DatabaseStore(self.database, collection_id, "test.json", 0) as store:
+                store.insert_release(release, {})
+
+        # The stale ID is removed from Redis, so the next attempt looks the data up.
+        assert {} == self.database.id_cache.get_many('data', [hash_md5])
+
+        with DatabaseStore(self.database, collection_id, "test.json", 0) as store:
+            store.insert_release(release, {})
+        assert hash_md5 in self.database.id_cache.get_many('data', [hash_md5])
+
+    def test_delete_orphan_data_after_commit(self):
+        redis = FakeRedis()
+        self._use_id_cache(self.database, redis)
+
+        collection_id = self.database.get_or_create_collection_id("test", datetime.datetime.now(), False)
+        with DatabaseStore(self.database, collection_id, "test.json", 0) as store:
+            store.insert_release({'ocid': 'ocds-213czf-000-00001', 'id': 'ocds-213czf-000-00001-01'}, {})
+
+        # When IDs are removed from Redis, their rows are already deleted, for every other transaction.
+        counts = []
+
+        def delete(*keys):
+            table_name = keys[0].split(':')[1]
+            with self.database.get_engine().begin() as connection:
+                counts.append(connection.execute('SELECT count(*) FROM ' + table_name).scalar())
+            FakeRedis.delete(redis, *keys)
+
+        redis.delete = delete
+        self.database.mark_collection_deleted_at(collection_id)
+        self.database.delete_collection(collection_id)
+        self.database.delete_orphan_data()
+        # Data, then package data.
+        assert [0, 0] == counts
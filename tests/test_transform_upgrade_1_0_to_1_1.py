@@ -136,6 +136,11 @@ class TestTransformUpgrade10To11(BaseDataBaseTest):
             result = connection.execute(s)
             assert 2 == result.rowcount
 
+            # The file item's releases are stored in one transaction.
+            s = sa.sql.select([self.database.collection_count_delta_table.c.releases]) \
+                .where(self.database.collection_count_delta_table.c.collection_id == destination_collection_id)
+            assert [2] == [row['releases'] for row in connection.execute(s)]
+
         # transform again! This should be fine
         transform = Upgrade10To11Transform(self.config, self.database, destination_collection)
         transform.process()
@@ -1,8 +1,18 @@
+import bz2
+import gzip
+import hashlib
+import io
+import json
+import lzma
 import os
+import tempfile
 
-from ocdskingfisherprocess.util import (FileToStore, control_code_to_filter_out_to_human_readable,
-                                        control_codes_to_filter_out, parse_string_to_boolean,
-                                        parse_string_to_date_time)
+import pytest
+import zstandard
+
+from ocdskingfisherprocess.util import (FileToStore, SanitizingReader, control_code_to_filter_out_to_human_readable,
+                                        control_codes_to_filter_out, get_json_and_hash_md5_for_data, has_control_codes,
+                                        iter_lines, open_mapped, parse_string_to_boolean, parse_string_to_date_time)
 
 
 def test_parse_string_to_boolean_1():
@@ -64,6 +74,106 @@ def test_file_to_store_sample_1_0_record():
         assert len(file_to_store.get_warnings()) == 0
 
 
+def test_file_to_store_open_sample_1_0_record_with_control_codes():
+    json_filename = os.path.join(os.path.dirname(
+        os.path.realpath(__file__)), 'fixtures', 'sample_1_0_record_with_control_codes.json'
+    )
+
+    with FileToStore(json_filename) as file_to_store:
+        with file_to_store.open() as f:
+            data = f.read()
+
+        assert b'\x10' not in data
+        assert file_to_store.get_warnings() == ['We had to replace control codes: chr(16)']
+
+
+def test_file_to_store_fileobj():
+    fileobj = io.BytesIO(b'{"a": "x\x10y"}')
+
+    with FileToStore(None, fileobj=fileobj) as file_to_store:
+        assert file_to_store.get_size() == 12
+        for _ in range(2):
+            with file_to_store.open() as f:
+                assert f.read() == b'{"a": "xy"}'
+
+        # The file object is read as is, and left open.
+        assert not fileobj.closed
+        assert file_to_store.get_warnings() == ['We had to replace control codes: chr(16)']
+
+
+@pytest.mark.parametrize('compression,compress', [('gzip', gzip.compress), ('bz2', bz2.compress),
+                                                  ('xz', lzma.compress),
+                                                  ('zstd', zstandard.ZstdCompressor().compress)])
+def test_file_to_store_compressed(compression, compress):
+    data = compress(b'{"a": "x\x10y"}')
+
+    with tempfile.NamedTemporaryFile('wb') as f:
+        f.write(data)
+        f.flush()
+        with FileToStore(f.name) as file_to_store:
+            assert file_to_store.get_compression() == compression
+            with file_to_store.open() as f_read:
+                assert f_read.read() == b'{"a": "xy"}'
+            with open(file_to_store.get_filename(), 'rb') as f_read:
+                assert f_read.read() == b'{"a": "xy"}'
+
+    # A file object that isn't seekable
+    class Stream:
+        def __init__(self, data):
+            self.fileobj = io.BytesIO(data)
+
+        def read(self, size=-1):
+            return self.fileobj.read(size)
+
+        def seekable(self):
+            return False
+
+    with FileToStore(None, fileobj=Stream(data)) as file_to_store:
+        assert file_to_store.get_compression() == compression
+        with file_to_store.open() as f_read:
+            assert f_read.read() == b'{"a": "xy"}'
+
+    # Detection can be turned off.
+    with FileToStore(None, fileobj=io.BytesIO(data), compression='none') as file_to_store:
+        assert file_to_store.get_compression() is None
+        with file_to_store.open() as f_read:
+            assert f_read.read() != b'{"a": "xy"}'
+
+
+def test_iter_lines():
+    assert list(iter_lines(b'a\nbb\n\nccc')) == [b'a\n', b'bb\n', b'\n', b'ccc']
+    assert list(iter_lines(b'a\nbb\n')) == [b'a\n', b'bb\n']
+    assert list(iter_lines(b'a\nbb\nccc', 2, 7)) == [b'bb\n', b'cc']
+    assert list(iter_lines(b'')) == []
+
+
+def test_open_mapped():
+    with tempfile.NamedTemporaryFile('wb') as f:
+        with open_mapped(f.name) as buffer:
+            assert len(buffer) == 0
+
+        f.write(b'{"a": "x\\u0000y"}\n{"b": "z"}')
+        f.flush()
+        with open_mapped(f.name) as buffer:
+            assert list(iter_lines(buffer)) == [b'{"a": "x\\u0000y"}\n', b'{"b": "z"}']
+            assert has_control_codes(buffer)
+            assert has_control_codes(buffer, 0, 17)
+            assert not has_control_codes(buffer, 17)
+
+
+def test_sanitizing_reader_control_codes_across_chunks():
+    class SmallChunkSanitizingReader(SanitizingReader):
+        CHUNK_SIZE = 3
+
+    for data in (b'{"a": "x\\u0000y\x10z"}', b'\\u0000\\u0000\x10\x10', b'\\u000', b'\\'):
+        expected = data.replace(b'\\u0000', b'').replace(b'\x10', b'')
+        warnings = []
+        with SmallChunkSanitizingReader(io.BytesIO(data), warnings) as f:
+            assert f.read() == expected
+        assert ('We had to replace control codes: \\u0000' in warnings) == (b'\\u0000' in data)
+        assert ('We had to replace control codes: chr(16)' in warnings) == (b'\x10' in data)
+
+
 def test_control_code_to_filter_out_to_human_readable():
     for control_code_to_filter_out in control_codes_to_filter_out:
         # This test just calls it and make sure it runs without crashing
@@ -71,3 +181,11 @@ def test_control_code_to_filter_out_to_human_readable():
         # We add it to a string, as this is what happens in real code.
         # This catches any "must be str, not bytes" errors.
         print(" " + control_code_to_filter_out_to_human_readable(control_code_to_filter_out))
+
+
+def test_get_json_and_hash_md5_for_data():
+    data = {'b': [1, 1.5, None, True], 'a': {'z': 'caf\u00e9 \u2603', 'y': '"\\\n'}}
+    # The hashes of data already in the database are of this.
+    expected = json.dumps(data, sort_keys=True)
+
+    assert (expected, hashlib.md5(expected.encode('utf-8')).hexdigest()) == get_json_and_hash_md5_for_data(data)
@@ -1,10 +1,13 @@
+import gzip
 import io
 import json
+import lzma
 import os
 import random
 
 import sqlalchemy as sa
 
+from ocdskingfisherprocess.ingest_job import ProcessIngestJobs
 from tests.base import BaseWebTest
 
 
@@ -406,3 +409,280 @@ class TestWebAPIV1(BaseWebTest):
 
         notes = self.database.get_all_notes_in_collection(collection_id)
         assert len(notes) == 0
+
+    def test_api_v1_submit_file_async(self):
+        # Call
+        data = {
+            'collection_source': 'test',
+            'collection_data_version': '2018-10-10 00:12:23',
+            'collection_sample': 'true',
+            'file_name': 'test.json',
+            'url': 'http://example.com',
+            'data_type': 'release_package',
+            'async': 'true',
+            'file': (io.BytesIO(b'{"releases": [{"ocid": "a"}, {"ocid": "b"}]}'), "data.json")
+        }
+
+        result = self.flaskclient.post('/api/v1/submit/file/',
+                                       data=data,
+                                       content_type='multipart/form-data',
+                                       headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+
+        assert result.status_code == 202
+        job_id = result.get_json()['job_id']
+        assert result.headers['Location'].endswith('/api/v1/job/{}'.format(job_id))
+
+        # Nothing is stored yet
+        collection_id = self.database.get_collection_id('test', '2018-10-10 00:12:23', True)
+        assert len(self.database.get_all_files_in_collection(collection_id)) == 0
+
+        result = self.flaskclient.get('/api/v1/job/{}'.format(job_id),
+                                      headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+        assert result.status_code == 200
+        assert result.get_json()['status'] == 'queued'
+        assert result.get_json()['items_stored'] == 0
+        local_file_name = self.database.claim_ingest_job()['local_file_name']
+        assert os.path.exists(local_file_name)
+
+        # Process the job, as the process-ingest-jobs command would
+        with self.database.get_engine().begin() as connection:
+            connection.execute("UPDATE ingest_job SET status = 'queued'")
+        assert ProcessIngestJobs(self.config, self.database).process_next()
+        assert not ProcessIngestJobs(self.config, self.database).process_next()
+
+        result = self.flaskclient.get('/api/v1/job/{}'.format(job_id),
+                                      headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+        job = result.get_json()
+        assert job['status'] == 'done'
+        assert job['items_stored'] == 1
+        assert job['errors'] is None
+        assert job['ended_at']
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table])
+            assert 2 == connection.execute(s).rowcount
+
+        # The upload is removed once stored
+        assert not os.path.exists(local_file_name)
+
+    def test_api_v1_submit_file_body(self):
+        # The file is the request body, with a control code that is removed as it is read.
+        body = b'{"releases": [{"ocid": "a"}]}\n{"releases": [{"ocid": "b\x10"}]}\n'
+
+        result = self.flaskclient.post('/api/v1/submit/file/?collection_source=test&'
+                                       'collection_data_version=2018-10-10%2000:12:23&collection_sample=true&'
+                                       'file_name=test.json&url=http://example.com&'
+                                       'data_type=release_package_json_lines',
+                                       data=body,
+                                       content_type='application/x-ndjson',
+                                       headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+
+        assert result.status_code == 200
+
+        # Check
+        collection_id = self.database.get_collection_id('test', '2018-10-10 00:12:23', True)
+        files = self.database.get_all_files_in_collection(collection_id)
+        assert len(files) == 1
+        assert files[0].filename == 'test.json'
+        assert files[0].url == 'http://example.com'
+        assert files[0].warnings == ['We had to replace control codes: chr(16)']
+        assert len(self.database.get_all_files_items_in_file(files[0])) == 2
+
+    def test_api_v1_submit_file_body_package(self):
+        body = b'{"releases": [{"ocid": "a"}, {"ocid": "b"}]}'
+
+        result = self.flaskclient.post('/api/v1/submit/file/?collection_source=test&'
+                                       'collection_data_version=2018-10-10%2000:12:23&collection_sample=true&'
+                                       'file_name=test.json&url=http://example.com&data_type=release_package',
+                                       data=body,
+                                       content_type='application/json',
+                                       headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+
+        assert result.status_code == 200
+
+        # Check
+        collection_id = self.database.get_collection_id('test', '2018-10-10 00:12:23', True)
+        files = self.database.get_all_files_in_collection(collection_id)
+        assert len(files) == 1
+        assert files[0].errors is None
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table])
+            assert 2 == connection.execute(s).rowcount
+
+    def test_api_v1_submit_file_body_gzip(self):
+        url = '/api/v1/submit/file/?collection_source=test&collection_data_version=2018-10-10%2000:12:23&' \
+            'file_name=test.json&url=http://example.com&data_type=release_package_json_lines'
+        body = gzip.compress(b'{"releases": [{"ocid": "a"}]}\n{"releases": [{"ocid": "b"}]}\n')
+
+        result = self.flaskclient.post(url,
+                                       data=body,
+                                       content_type='application/x-ndjson',
+                                       headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0],
+                                                'Content-Encoding': 'gzip'})
+
+        assert result.status_code == 200
+
+        result = self.flaskclient.post(url,
+                                       data=body,
+                                       content_type='application/x-ndjson',
+                                       headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0],
+                                                'Content-Encoding': 'br'})
+
+        assert result.status_code == 415
+
+        # Check
+        collection_id = self.database.get_collection_id('test', '2018-10-10 00:12:23', False)
+        files = self.database.get_all_files_in_collection(collection_id)
+        assert len(files) == 1
+        assert len(self.database.get_all_files_items_in_file(files[0])) == 2
+
+    def test_api_v1_submit_file_compressed(self):
+        # The compression of an upload is detected.
+        data = {
+            'collection_source': 'test',
+            'collection_data_version': '2018-10-10 00:12:23',
+            'file_name': 'test.json',
+            'url': 'http://example.com',
+            'data_type': 'release_package',
+            'file': (io.BytesIO(lzma.compress(b'{"releases": [{"ocid": "a"}, {"ocid": "b"}]}')), "data.json.xz")
+        }
+
+        result = self.flaskclient.post('/api/v1/submit/file/',
+                                       data=data,
+                                       content_type='multipart/form-data',
+                                       headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+
+        assert result.status_code == 200
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table])
+            assert 2 == connection.execute(s).rowcount
+
+    def test_api_v1_submit_file_async_compressed(self):
+        # The compression of a queued file is saved, and used when it is stored.
+        body = gzip.compress(b'{"releases": [{"ocid": "a"}]}\n{"releases": [{"ocid": "b"}]}\n')
+
+        result = self.flaskclient.post('/api/v1/submit/file/?collection_source=test'
+                                       '&collection_data_version=2018-10-10%2000:12:23&file_name=test.json'
+                                       '&url=http://example.com&data_type=release_package_json_lines&async=true',
+                                       data=body,
+                                       content_type='application/x-ndjson',
+                                       headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0],
+                                                'Content-Encoding': 'gzip'})
+
+        assert result.status_code == 202
+        assert self.database.claim_ingest_job()['compression'] == 'gzip'
+
+        with self.database.get_engine().begin() as connection:
+            connection.execute("UPDATE ingest_job SET status = 'queued'")
+        assert ProcessIngestJobs(self.config, self.database).process_next()
+
+        result = self.flaskclient.get(result.headers['Location'],
+                                      headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+        assert result.get_json()['status'] == 'done'
+        assert result.get_json()['items_stored'] == 2
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table])
+            assert 2 == connection.execute(s).rowcount
+
+    def test_api_v1_job(self):
+        result = self.flaskclient.get('/api/v1/job/1')
+        assert result.status_code == 401
+
+        result = self.flaskclient.get('/api/v1/job/1',
+                                      headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+        assert result.status_code == 404
+
+    def test_api_v1_submit_items(self):
+        json_filename = os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'fixtures', 'sample_1_0_releases.json'
+        )
+        with open(json_filename) as f:
+            release_package = json.load(f)
+
+        lines = [
+            {'file_name': 'test.json', 'url': 'http://example.com', 'data_type': 'release_package', 'number': 0,
+             'data': release_package},
+            # Invalid data doesn't stop other items being stored
+            {'file_name': 'test.json', 'url': 'http://example.com', 'data_type': 'release_package', 'number': 1,
+             'data': {'missing': 'A release key'}},
+            {'file_name': 'test2.json', 'url': 'http://example.com/2', 'data_type': 'release_package', 'number': 0,
+             'data': json.dumps(release_package)},
+        ]
+        body = '\n'.join(json.dumps(line) for line in lines) + '\nnot json\n'
+
+        result = self.flaskclient.post('/api/v1/submit/items/?collection_source=test&'
+                                       'collection_data_version=2018-10-10%2000:12:23&collection_sample=true',
+                                       data=body.encode('utf-8'),
+                                       content_type='application/x-ndjson',
+                                       headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+
+        assert result.status_code == 200
+        results = result.get_json()
+        assert len(results) == 4
+        assert results[0] == {'file_name': 'test.json', 'number': 0, 'stored': True}
+        assert results[1] == {'file_name': 'test.json', 'number': 1, 'stored': False,
+                              'errors': ['Release list not found']}
+        assert results[2] == {'file_name': 'test2.json', 'number': 0, 'stored': True}
+        assert results[3]['stored'] is False
+
+        # Check
+        collection_id = self.database.get_collection_id('test', '2018-10-10 00:12:23', True)
+        files = self.database.get_all_files_in_collection(collection_id)
+        assert [file.filename for file in files] == ['test.json', 'test2.json']
+        file_items = self.database.get_all_files_items_in_file(files[0])
+        assert len(file_items) == 2
+        assert file_items[0].errors is None
+        assert file_items[1].errors == ['Release list not found']
+
+        with self.database.get_engine().begin() as connection:
+            s = sa.sql.select([self.database.release_table])
+            assert 2 * len(release_package['releases']) == connection.execute(s).rowcount
+
+    def test_api_v1_submit_items_again(self):
+        lines = [
+            {'file_name': 'test.json', 'url': 'http://example.com', 'data_type': 'release', 'number': 0,
+             'data': {'ocid': 'ocds-213czf-000-00001', 'id': '1'}},
+            {'file_name': 'test.json', 'url': 'http://example.com', 'data_type': 'release_package', 'number': 1,
+             'data': {'missing': 'A release key'}},
+        ]
+        body = '\n'.join(json.dumps(line) for line in lines).encode('utf-8')
+
+        def post(body):
+            return self.flaskclient.post('/api/v1/submit/items/?collection_source=test&'
+                                         'collection_data_version=2018-10-10%2000:12:23&collection_sample=true',
+                                         data=body,
+                                         content_type='application/x-ndjson',
+                                         headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+
+        result = post(body)
+        assert result.status_code == 200
+
+        # Submit the items again, with a new item.
+        lines.append({'file_name': 'test.json', 'url': 'http://example.com', 'data_type': 'release', 'number': 2,
+                      'data': {'ocid': 'ocds-213czf-000-00001', 'id': '2'}})
+        result = post('\n'.join(json.dumps(line) for line in lines).encode('utf-8'))
+
+        assert result.status_code == 200
+        results = result.get_json()
+        assert len(results) == 3
+        for i in range(2):
+            assert results[i]['stored'] is False
+            assert len(results[i]['errors']) == 1
+            assert results[i]['errors'][0].startswith('DatabaseStore class tried to insert a duplicate')
+        assert results[2] == {'file_name': 'test.json', 'number': 2, 'stored': True}
+
+        # Check
+        collection_id = self.database.get_collection_id('test', '2018-10-10 00:12:23', True)
+        files = self.database.get_all_files_in_collection(collection_id)
+        file_items = self.database.get_all_files_items_in_file(files[0])
+        assert [file_item.errors for file_item in file_items] == [None, ['Release list not found'], None]
+
+    def test_api_v1_submit_items_no_collection(self):
+        result = self.flaskclient.post('/api/v1/submit/items/',
+                                       data=b'',
+                                       content_type='application/x-ndjson',
+                                       headers={'Authorization': 'ApiKey ' + self.config.web_api_keys[0]})
+        assert result.status_code == 400